@@ -1,19 +1,77 @@
 """Functions to compute the outputs that will be saved."""
 
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
 import logging
 import os
 import re
+import sys
+import threading
 import time
 
 import cv2
 import numpy as np
 import pandas as pd
-from bacolonyzer import filesystem, image_processing
+from bacolonyzer import (
+    filesystem,
+    image_cache,
+    image_processing,
+    output_store,
+    profiling,
+    quantiles,
+    stabilization,
+)
 from scipy.signal import find_peaks
 
+try:
+    import resource
+except ImportError:  # Not available on Windows: memory is not reported.
+    resource = None
+
 logger = logging.getLogger(__name__)
 
 
+# Everything needed to analyse any image of a plate once the grid is located.
+# It is shared by all the images of the series (and all the worker processes).
+PlateSetup = collections.namedtuple(
+    "PlateSetup",
+    [
+        "nrow",
+        "ncol",
+        "min_loc",
+        "pat_h",
+        "pat_w",
+        "agar",
+        "spots",
+        "block_size",
+        "min_ref",
+        "max_ref",
+        "light_correction",
+        "low_contrasts",
+        "crop_first",
+        "analysis_scale",
+        "low_memory",
+        "image_cache",
+        "sensitivity",
+        "integral_metrics",
+    ],
+)
+
+# Half the size of the Gaussian kernel used to blur each image at full
+# resolution. With crop_first, only this border around the grid is read and
+# blurred.
+_BLUR_BORDER = 7
+
+# Buffers reused by the images analysed in each thread with low_memory.
+_buffers = threading.local()
+
+# Setup of the plate analysed by each worker process. See `analyse_images`.
+_worker_setup = None
+
+
 def analyse_timeseries_qfa(
     images_paths,
     nrow,
@@ -24,9 +82,33 @@ def analyse_timeseries_qfa(
     reference_image="",
     low_contrasts=False,
     grid_by_peaks=False,
+    jobs=1,
+    prefetch=2,
+    search_scale=1.0,
+    grid_threads=1,
+    recompute_grid=False,
+    crop_first=False,
+    analysis_scale=1.0,
+    low_memory=False,
+    incremental=False,
+    output_format="tsv",
+    mask_scale=1.0,
+    png_compression=None,
+    write_queue=4,
+    profile=False,
+    stabilize=False,
+    stabilized_dir=None,
+    image_cache_dir=None,
+    image_cache_size=4096,
+    sensitivity=image_processing.SENSITIVITY,
+    integral_metrics=False,
 ):
     # Set timer
     start_time = time.time()
+    if profile:
+        # Time each stage of the analysis of each image.
+        profiling.reset()
+        profiling.enable()
 
     # Obtain first and last image
     latest_image = images_paths[-1]
@@ -42,28 +124,391 @@ def analyse_timeseries_qfa(
     logger.debug("This may take a few seconds...")
     logger.debug("")
 
+    if stabilize and crop_first:
+        raise ValueError("Images can't be stabilized with --crop_first.")
+    # Fail before locating the grid if the outputs can't be saved.
+    output_store.store_class(output_format)
+
+    # Outputs that are up to date with the current analysis.
+    record = filesystem.load_analysis_record(output_dir)
+    grid_image = latest_image
+    if incremental and not recompute_grid:
+        grid_image = previous_grid_image(record, output_dir) or latest_image
+        if grid_image != latest_image:
+            logger.debug("Using the grid of the previous analysis: %s", grid_image)
+
+    setup = locate_plate(
+        grid_image,
+        nrow,
+        ncol,
+        output_dir,
+        light_correction=light_correction,
+        fraction=fraction,
+        reference_image=reference_image,
+        low_contrasts=low_contrasts,
+        grid_by_peaks=grid_by_peaks,
+        search_scale=search_scale,
+        grid_threads=grid_threads,
+        recompute_grid=recompute_grid,
+        crop_first=crop_first,
+        analysis_scale=analysis_scale,
+        low_memory=low_memory,
+        sensitivity=sensitivity,
+        integral_metrics=integral_metrics,
+    )
+
+    if image_cache_dir is not None:
+        # Decoded images are cached (by default, in Output_Data), and reused
+        # by later analyses of the same images.
+        setup = setup._replace(
+            image_cache=(
+                image_cache_dir
+                or os.path.join(output_dir, "Output_Data", "image_cache"),
+                int(image_cache_size * (1 << 20)),
+            )
+        )
+
+    store = output_store.open_store(
+        output_dir, output_format, mask_scale, png_compression, write_queue
+    )
+    fingerprint = setup_fingerprint(setup, stabilize)
+    all_images = images_paths
+    if incremental:
+        images_paths = outdated_images(images_paths, store, record, fingerprint)
+        logger.debug("%s images need to be analysed.", len(images_paths))
+    record["grid_image"] = os.path.basename(grid_image)
+
+    preprocess = None
+    if stabilize:
+        # Images are stabilized with respect to the image used to locate the
+        # grid, which is then valid for all of them.
+        stabilized = filesystem.load_stabilization_record(output_dir)
+        preprocess = image_stabilizer(
+            all_images, grid_image, setup, stabilized, stabilized_dir, prefetch
+        )
+        if jobs != 1:
+            logger.debug("Images are analysed one after another to stabilize them.")
+
+    logger.debug("Analysing each of the images:")
+    results = analyse_images(images_paths, setup, jobs, prefetch, preprocess)
+    # Memory is reported for this process or for the workers.
+    parallel = (jobs or os.cpu_count()) > 1 and len(images_paths) > 1
+    saved = output_recorder(record, fingerprint)
+    try:
+        for file_name, df, mask in results:
+            logger.debug(
+                "Analysis complete for %s%s",
+                os.path.basename(file_name),
+                _memory_message() if not parallel else "",
+            )
+
+            # Saving output.
+            store.write(file_name, df, mask, on_saved=saved)
+    finally:
+        try:
+            store.close()
+        finally:
+            # Only the outputs that were saved are recorded.
+            filesystem.save_analysis_record(output_dir, record)
+            if stabilize:
+                filesystem.save_stabilization_record(output_dir, stabilized)
+            if profile:
+                profiling.enable(False)
+
+    logger.debug(
+        "All analyses finished in {:.2f} seconds".format(time.time() - start_time)
+    )
+    if profile:
+        profiling.save(output_dir)
+    if parallel and peak_memory(children=True):
+        logger.debug(
+            "Peak memory of the largest worker process: {:.0f} MB".format(
+                peak_memory(children=True)
+            )
+        )
+
+
+def locate_plate(
+    latest_image,
+    nrow,
+    ncol,
+    output_dir,
+    light_correction=False,
+    fraction=0.8,
+    reference_image="",
+    low_contrasts=False,
+    grid_by_peaks=False,
+    search_scale=1.0,
+    grid_threads=1,
+    recompute_grid=False,
+    crop_first=False,
+    analysis_scale=1.0,
+    low_memory=False,
+    sensitivity=image_processing.SENSITIVITY,
+    integral_metrics=False,
+):
+    """Locate the grid, the spots and the agar using the latest image, and
+    calibrate the intensities with the reference image (if any).
+    The grid found by a previous analysis of the same latest image with the
+    same parameters is reused, unless recompute_grid is True.
+    Return the PlateSetup needed to analyse each image of the series.
+    """
+    key = grid_cache_key(
+        latest_image,
+        nrow,
+        ncol,
+        fraction,
+        low_contrasts,
+        grid_by_peaks,
+        search_scale,
+        sensitivity,
+    )
+    grid = None if recompute_grid else filesystem.load_grid_cache(output_dir, key)
+    if grid is None:
+        with profiling.stage("find_grid"):
+            grid = find_grid(
+                latest_image,
+                nrow,
+                ncol,
+                output_dir,
+                fraction=fraction,
+                low_contrasts=low_contrasts,
+                grid_by_peaks=grid_by_peaks,
+                search_scale=search_scale,
+                grid_threads=grid_threads,
+                sensitivity=sensitivity,
+            )
+        filesystem.save_grid_cache(output_dir, key, grid)
+    else:
+        logger.debug("Using the grid found in a previous analysis.")
+
+    # Obtain maximum and minimum intensity that we can observe with camera
+    if reference_image:
+        with profiling.stage("calibration"):
+            min_ref, max_ref = image_processing.calibration_maxmin(reference_image)
+    else:
+        min_ref, max_ref = 0, 255
+
+    return plate_setup(
+        grid,
+        min_ref,
+        max_ref,
+        light_correction=light_correction,
+        low_contrasts=low_contrasts,
+        crop_first=crop_first,
+        analysis_scale=analysis_scale,
+        low_memory=low_memory,
+        sensitivity=sensitivity,
+        integral_metrics=integral_metrics,
+    )
+
+
+def plate_setup(
+    grid,
+    min_ref=0,
+    max_ref=255,
+    light_correction=False,
+    low_contrasts=False,
+    crop_first=False,
+    analysis_scale=1.0,
+    low_memory=False,
+    sensitivity=image_processing.SENSITIVITY,
+    integral_metrics=False,
+):
+    """PlateSetup to analyse the images with the grid found by `find_grid`
+    (at full resolution) and the calibration (min_ref, max_ref)."""
+    if analysis_scale != 1:
+        grid = scale_grid(grid, analysis_scale)
+    return PlateSetup(
+        nrow=int(grid["nrow"]),
+        ncol=int(grid["ncol"]),
+        min_loc=tuple(int(x) for x in grid["min_loc"]),
+        pat_h=int(grid["pat_h"]),
+        pat_w=int(grid["pat_w"]),
+        agar=grid["agar"],
+        spots=grid["spots"],
+        block_size=int(grid["block_size"]) or None,
+        min_ref=min_ref,
+        max_ref=max_ref,
+        light_correction=light_correction,
+        low_contrasts=low_contrasts,
+        crop_first=crop_first,
+        analysis_scale=analysis_scale,
+        low_memory=low_memory,
+        image_cache=None,
+        sensitivity=sensitivity,
+        integral_metrics=integral_metrics,
+    )
+
+
+def scale_grid(grid, scale):
+    """Rescale the grid and the masks found by `find_grid` at full resolution
+    to analyse images downscaled by the given scale."""
+    grid = dict(grid)
+    grid["min_loc"] = tuple(int(round(x * scale)) for x in grid["min_loc"])
+    grid["pat_h"] = int(round(grid["pat_h"] * scale))
+    grid["pat_w"] = int(round(grid["pat_w"] * scale))
+    for name in ("agar", "spots"):
+        h, w = grid[name].shape
+        size = (int(round(w * scale)), int(round(h * scale)))
+        grid[name] = cv2.resize(
+            grid[name].astype(np.uint8), size, interpolation=cv2.INTER_NEAREST
+        ).astype(bool)
+    if grid["block_size"]:
+        # The block size of the adaptive threshold must be odd and > 1.
+        block_size = int(round(grid["block_size"] * scale))
+        grid["block_size"] = max(block_size + block_size % 2 - 1, 3)
+    return grid
+
+
+def setup_fingerprint(setup, stabilize=False):
+    """Identify the outputs of the analysis of any image with the given setup:
+    the grid, the masks, the calibration and the corrections applied, and
+    whether the images are stabilized. The image cache doesn't change them."""
+    key = hashlib.sha256()
+    for value in setup._replace(image_cache=None):
+        if isinstance(value, np.ndarray):
+            key.update(value.tobytes())
+        else:
+            key.update(repr(value).encode())
+    if stabilize:
+        key.update(b"stabilize")
+    return key.hexdigest()
+
+
+def previous_grid_image(record, output_dir):
+    """Image used to locate the grid by the previous analysis, if it still
+    exists. Reusing it keeps the outputs of previous analyses valid."""
+    if record["grid_image"]:
+        grid_image = os.path.join(output_dir, record["grid_image"])
+        if os.path.isfile(grid_image):
+            return grid_image
+    return None
+
+
+def output_recorder(record, fingerprint):
+    """Callback for the `write` of a store that records the fingerprint of the
+    analysis of an image once its outputs are saved."""
+
+    def saved(file_name):
+        record["outputs"][filesystem.get_file_name(file_name)] = fingerprint
+
+    return saved
+
+
+def outdated_images(images_paths, store, record, fingerprint):
+    """Images without outputs in the store that are newer than the image and
+    that were obtained with the analysis identified by the given fingerprint."""
+    return [
+        file_name
+        for file_name in images_paths
+        if record["outputs"].get(filesystem.get_file_name(file_name)) != fingerprint
+        or not store.is_up_to_date(file_name)
+    ]
+
+
+def grid_cache_key(latest_image, *parameters):
+    """Identify the grid found on the content of the latest image with the
+    given parameters."""
+    key = hashlib.sha256()
+    with open(latest_image, "rb") as image_file:
+        for block in iter(lambda: image_file.read(1 << 20), b""):
+            key.update(block)
+    key.update(repr(parameters).encode())
+    return key.hexdigest()
+
+
+def find_grid(
+    latest_image,
+    nrow,
+    ncol,
+    output_dir,
+    fraction=0.8,
+    low_contrasts=False,
+    grid_by_peaks=False,
+    search_scale=1.0,
+    grid_threads=1,
+    sensitivity=image_processing.SENSITIVITY,
+):
+    """Locate the grid, the spots and the agar using the latest image.
+    Return a dictionary with the grid, the masks and the parameters used.
+    """
     # Get latest image to detect culture locations
+    im_n = read_grid_image(latest_image)
+    grid = fit_grid(
+        im_n, nrow, ncol, fraction, grid_by_peaks, search_scale, grid_threads
+    )
+
+    # Show the position of the pattern for visualization
+    image_processing.show_grid_result(
+        latest_image,
+        grid["min_loc"],
+        grid["pat_h"],
+        grid["pat_w"],
+        nrow,
+        ncol,
+        output_dir,
+    )
+    grid.update(grid_masks(im_n, grid, low_contrasts, sensitivity))
+    return grid
+
+
+def fit_grid(
+    im_n,
+    nrow,
+    ncol,
+    fraction=0.8,
+    grid_by_peaks=False,
+    search_scale=1.0,
+    grid_threads=1,
+):
+    """Locate the grid in the image read by `read_grid_image`.
+    Return a dictionary with the grid and the parameters used."""
+    _, min_loc, pat_h, pat_w = image_processing.get_position_grid(
+        im_n,
+        nrow,
+        ncol,
+        fraction,
+        grid_by_peaks,
+        search_scale=search_scale,
+        threads=grid_threads,
+    )
+    return {
+        "min_loc": min_loc,
+        "pat_h": pat_h,
+        "pat_w": pat_w,
+        "nrow": nrow,
+        "ncol": ncol,
+        "fraction": fraction,
+        "method": "peaks" if grid_by_peaks else "template",
+    }
+
+
+def read_grid_image(latest_image):
+    """Read the image used to locate the grid, without outliers and noise."""
     im_n = cv2.imread(latest_image, cv2.IMREAD_GRAYSCALE)
 
     # Perform some normalization in order to remove outliers and noise.
     # The 1% and 99% quantile clipping is a good option.
-    quants = np.quantile(im_n.ravel(), [0.01, 0.99])
+    quants = quantiles.image_quantiles(im_n, [0.01, 0.99])
     im_n = np.clip(im_n, *quants)
-    im_n = np.array(im_n, dtype=np.uint8)
+    return np.array(im_n, dtype=np.uint8)
 
-    _, min_loc, pat_h, pat_w = image_processing.get_position_grid(
-        im_n, nrow, ncol, fraction, grid_by_peaks
-    )
 
+def grid_masks(
+    im_n, grid, low_contrasts=False, sensitivity=image_processing.SENSITIVITY
+):
+    """Locate the spots and the agar in the grid of the image read by
+    `read_grid_image`. Return a dictionary with the masks and the block size
+    of the adaptive threshold (0 unless low_contrasts)."""
+    nrow, ncol = grid["nrow"], grid["ncol"]
+    min_loc = grid["min_loc"]
     # Cut the original image with the size of the best pattern match.
-    w_right = int(min_loc[0] + pat_w)
-    h_bottom = int(min_loc[1] + pat_h)
+    w_right = int(min_loc[0] + grid["pat_w"])
+    h_bottom = int(min_loc[1] + grid["pat_h"])
     im_ = im_n[min_loc[1] : h_bottom, min_loc[0] : w_right]
-    # Show the position of the pattern for visualization
-    image_processing.show_grid_result(
-        latest_image, min_loc, pat_h, pat_w, nrow, ncol, output_dir
-    )
 
+    block_size = 0
     if not low_contrasts:
         # Find spots and agar based on an automatic threshold and last image
         _, mask_base = cv2.threshold(
@@ -72,7 +517,7 @@ def analyse_timeseries_qfa(
             255,
             cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU,
         )
-        mask = image_processing.get_mask(mask_base, nrow, ncol)
+        mask = image_processing.get_mask(mask_base, nrow, ncol, sensitivity)
     else:
         # Get the block size for one element in the grid
         block_size = (im_.shape / np.asarray([nrow, ncol])).astype(int).min()
@@ -87,170 +532,884 @@ def analyse_timeseries_qfa(
             block_size,
             0,
         )
-        mask = image_processing.get_mask(mask_base, nrow, ncol)
+        mask = image_processing.get_mask(mask_base, nrow, ncol, sensitivity)
 
     # Locate the position of the spots and the agar into different masks.
     grd = np.ones(mask.shape, dtype=bool)
     spots = np.logical_and(grd, ~mask)
     agar = np.logical_and(grd, mask)
 
-    # Reset mask to avoid problems in future iterations.
-    mask = None
+    return {
+        "block_size": block_size,
+        "agar": agar,
+        "spots": spots,
+    }
 
-    # Obtain maximum and minimum intensity that we can observe with camera
-    if reference_image:
-        min_ref, max_ref = image_processing.calibration_maxmin(reference_image)
-    else:
-        min_ref, max_ref = 0, 255
 
-    logger.debug("Analysing each of the images:")
-    for file_name in images_paths:
-        img = cv2.imread(file_name, cv2.IMREAD_GRAYSCALE)
-        arr = img[min_loc[1] : h_bottom, min_loc[0] : w_right]
-
-        # Assume area of spots will always be =< spots at last image, so
-        # set all pixels that are not spots to agar to remove noise
-        color_agar = np.mean(arr[agar])
-        arr_modified = cv2.GaussianBlur(img, (15, 15), 0)
-
-        if not low_contrasts:
-            # Set threshold automatically
-            thresh, _ = cv2.threshold(
-                np.array(arr_modified, dtype=np.uint8),
-                0,
-                255,
-                cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU,
+def analyse_images(images_paths, setup, jobs=1, prefetch=2, preprocess=None):
+    """Analyse the given images of a plate.
+    Yield tuples (file_name, output data-frame, mask) in the order of the
+    images. If jobs > 1 (or 0, meaning all cores), the images are analysed
+    by a pool of worker processes. Otherwise, the next `prefetch` images are
+    read in the background while an image is analysed.
+
+    If given, preprocess(file_name, img) returns the image to analyse (e.g.
+    stabilized, see `image_stabilizer`). It is called for each image in
+    order, so the images are then analysed one after another.
+    """
+    jobs = jobs or os.cpu_count()
+    if jobs == 1 or len(images_paths) == 1 or preprocess is not None:
+        for file_name, img in filesystem.prefetch_images(
+            images_paths, functools.partial(read_image, setup=setup), prefetch
+        ):
+            if preprocess is not None:
+                img = preprocess(file_name, img)
+            yield (file_name,) + analyse_image(file_name, setup, img)
+        return
+
+    # The setup is sent only once to each worker. Only a limited number of
+    # images is submitted in advance to bound the memory used by the results.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_worker,
+        initargs=(setup, profiling.is_enabled()),
+    ) as executor:
+        pending = collections.deque()
+        for file_name in images_paths:
+            pending.append((file_name, executor.submit(_analyse_in_worker, file_name)))
+            if len(pending) > 2 * jobs:
+                yield _worker_result(*pending.popleft())
+        while pending:
+            yield _worker_result(*pending.popleft())
+
+
+def analyse_plates(
+    plates,
+    nrow,
+    ncol,
+    light_correction=False,
+    fraction=0.8,
+    reference_image="",
+    low_contrasts=False,
+    grid_by_peaks=False,
+    jobs=0,
+    chunk_size=8,
+    prefetch=2,
+    search_scale=1.0,
+    grid_threads=1,
+    recompute_grid=False,
+    crop_first=False,
+    analysis_scale=1.0,
+    low_memory=False,
+    incremental=False,
+    output_format="tsv",
+    mask_scale=1.0,
+    png_compression=None,
+    write_queue=4,
+    sensitivity=image_processing.SENSITIVITY,
+    integral_metrics=False,
+):
+    """Analyse many plates sharing a single pool of worker processes.
+    `plates` is a list of tuples (plate directory, images paths). The grid
+    of each plate is located in the pool, and the images are then sent to
+    the pool in chunks of `chunk_size` images together with its setup. Each
+    worker reads the next `prefetch` images of its chunk in the background.
+    Outputs are saved in each plate directory.
+
+    A failure in one plate, while analysing it or saving its outputs, doesn't
+    stop the analysis of the others.
+    Return a dictionary with the error of each plate that failed.
+    """
+    # Fail before locating any grid if the outputs can't be saved.
+    output_store.store_class(output_format)
+    jobs = jobs or os.cpu_count()
+    failures = {}
+    # Number of images of each plate analysed so far.
+    done = {plate_dir: 0 for plate_dir, _ in plates}
+    total = {plate_dir: len(images) for plate_dir, images in plates}
+    # Chunks of images waiting to be submitted: (plate directory, setup, chunk)
+    queued = collections.deque()
+    # Outputs that are up to date, and fingerprint of the analysis of each plate
+    records = {}
+    fingerprints = {}
+    stores = {}
+
+    def fail(plate_dir, error, action="Analysis"):
+        """Record the first error of a plate, which won't be analysed any more."""
+        logger.error("%s of %s failed: %s", action, plate_dir, error)
+        failures.setdefault(plate_dir, error)
+
+    def finish(plate_dir):
+        """Complete the outputs of a plate that won't be analysed any more."""
+        try:
+            stores.pop(plate_dir).close()
+        except Exception as error:
+            fail(plate_dir, error, "Saving outputs")
+        if plate_dir in fingerprints:
+            filesystem.save_analysis_record(plate_dir, records[plate_dir])
+
+    with contextlib.ExitStack() as stack:
+        executor = stack.enter_context(
+            concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, initializer=_init_worker
+            )
+        )
+        # Stores that are still open are closed also if an error occurs.
+        stack.callback(lambda: [store.close() for store in stores.values()])
+        # Locate the grid of all the plates. Each future maps to its plate.
+        running = {}
+        for plate_dir, images_paths in plates:
+            stores[plate_dir] = output_store.open_store(
+                plate_dir, output_format, mask_scale, png_compression, write_queue
+            )
+            records[plate_dir] = filesystem.load_analysis_record(plate_dir)
+            grid_image = images_paths[-1]
+            if incremental and not recompute_grid:
+                grid_image = (
+                    previous_grid_image(records[plate_dir], plate_dir) or grid_image
+                )
+            records[plate_dir]["grid_image"] = os.path.basename(grid_image)
+            future = executor.submit(
+                locate_plate,
+                grid_image,
+                nrow,
+                ncol,
+                plate_dir,
+                light_correction=light_correction,
+                fraction=fraction,
+                reference_image=reference_image,
+                low_contrasts=low_contrasts,
+                grid_by_peaks=grid_by_peaks,
+                search_scale=search_scale,
+                grid_threads=grid_threads,
+                recompute_grid=recompute_grid,
+                crop_first=crop_first,
+                analysis_scale=analysis_scale,
+                low_memory=low_memory,
+                sensitivity=sensitivity,
+                integral_metrics=integral_metrics,
+            )
+            running[future] = (plate_dir, images_paths)
+
+        while running or queued:
+            # Keep a limited number of chunks in the pool to bound the memory
+            # used by results that are not saved yet.
+            while queued and len(running) < 2 * jobs:
+                plate_dir, setup, chunk = queued.popleft()
+                if plate_dir not in failures:
+                    future = executor.submit(_analyse_chunk, chunk, setup, prefetch)
+                    running[future] = (plate_dir, chunk)
+            if not running:
+                continue
+
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                plate_dir, images_paths = running.pop(future)
+                if plate_dir in failures:
+                    continue
+                try:
+                    result = future.result()
+                except Exception as error:
+                    fail(plate_dir, error)
+                    # Keep track of the outputs that were saved before failing.
+                    finish(plate_dir)
+                    continue
+
+                if isinstance(result, PlateSetup):
+                    # The grid is located, the images can be analysed.
+                    logger.debug("Grid located for %s", plate_dir)
+                    fingerprints[plate_dir] = setup_fingerprint(result)
+                    if incremental:
+                        images_paths = outdated_images(
+                            images_paths,
+                            stores[plate_dir],
+                            records[plate_dir],
+                            fingerprints[plate_dir],
+                        )
+                        total[plate_dir] = len(images_paths)
+                    if not images_paths:
+                        logger.debug("%s: all images are up to date", plate_dir)
+                        finish(plate_dir)
+                    for i in range(0, len(images_paths), chunk_size):
+                        chunk = images_paths[i : i + chunk_size]
+                        queued.append((plate_dir, result, chunk))
+                    continue
+
+                try:
+                    saved = output_recorder(records[plate_dir], fingerprints[plate_dir])
+                    for file_name, df, mask in result:
+                        stores[plate_dir].write(file_name, df, mask, on_saved=saved)
+                except Exception as error:
+                    # E.g. the disk of the plate is full.
+                    fail(plate_dir, error, "Saving outputs")
+                    finish(plate_dir)
+                    continue
+                done[plate_dir] += len(result)
+                logger.debug(
+                    "%s: %s/%s images analysed",
+                    plate_dir,
+                    done[plate_dir],
+                    total[plate_dir],
+                )
+                if done[plate_dir] == total[plate_dir]:
+                    finish(plate_dir)
+    if peak_memory(children=True):
+        logger.debug(
+            "Peak memory of the largest worker process: {:.0f} MB".format(
+                peak_memory(children=True)
+            )
+        )
+    return failures
+
+
+def _init_worker(setup=None, profile=False):
+    """Keep the plate setup in the worker process, and time the stages of the
+    analysis if profile is True."""
+    global _worker_setup
+    _worker_setup = setup
+    profiling.enable(profile)
+    # Processes already run in parallel, avoid oversubscription of threads.
+    cv2.setNumThreads(1)
+
+
+def _analyse_in_worker(file_name):
+    df, mask = analyse_image(file_name, _worker_setup)
+    return df, mask, profiling.pop(file_name)
+
+
+def _worker_result(file_name, future):
+    """Outputs of an image analysed by `_analyse_in_worker`. The stages timed
+    by the worker are added to the timings of this process."""
+    df, mask, timings = future.result()
+    profiling.add(timings, file_name)
+    return file_name, df, mask
+
+
+def _analyse_chunk(images_paths, setup, prefetch=0):
+    return [
+        (f,) + analyse_image(f, setup, img)
+        for f, img in filesystem.prefetch_images(
+            images_paths, functools.partial(read_image, setup=setup), prefetch
+        )
+    ]
+
+
+def image_stabilizer(
+    images_paths, grid_image, setup, stabilized, output_dir=None, prefetch=2
+):
+    """Return a function that stabilizes each image read by `read_image`
+    with respect to the grid image, to preprocess the images given to
+    `analyse_images`.
+
+    The transform of each image with respect to the earliest one is
+    estimated by tracking the images in order from the earliest (see
+    `stabilization.Stabilizer`), and kept in the record `stabilized` (see
+    `filesystem.load_stabilization_record`), at full resolution. The
+    transforms of the record are reused if it has all the images, otherwise
+    all the images are tracked again. Each image is then warped by its
+    transform followed by the inverse of that of the grid image; images that
+    didn't move with respect to the grid image are analysed as they are.
+    Stabilized images are saved in output_dir, if given.
+    """
+    if grid_image not in images_paths:
+        images_paths = sorted(images_paths + [grid_image])
+    names = [filesystem.get_file_name(path) for path in images_paths]
+    transforms = stabilized["transforms"]
+    if stabilized["reference"] != names[0] or not all(
+        name in transforms for name in names
+    ):
+        logger.debug("Tracking the images to stabilize them.")
+        stabilized["reference"] = names[0]
+        transforms.clear()
+        images = filesystem.prefetch_images(
+            images_paths, functools.partial(read_image, setup=setup), prefetch
+        )
+        _, reference = next(images)
+        stabilizer = stabilization.Stabilizer(reference)
+        transforms[names[0]] = np.eye(2, 3).tolist()
+        for name, (file_name, img) in zip(names[1:], images):
+            with profiling.stage("stabilize", file_name):
+                transform = stabilizer.estimate(img)
+            transforms[name] = stabilization.rescale_transform(
+                transform, setup.analysis_scale
+            ).tolist()
+        logger.debug("Features detected %s times.", stabilizer.detections)
+
+    def to_3x3(name):
+        return np.vstack([transforms[name], [0, 0, 1]])
+
+    # Transform from the grid image to the reference.
+    inverse = np.linalg.inv(to_3x3(filesystem.get_file_name(grid_image)))
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    def stabilize(file_name, img):
+        with profiling.stage("stabilize", file_name):
+            transform = (to_3x3(filesystem.get_file_name(file_name)) @ inverse)[:2]
+            if file_name != grid_image and not np.array_equal(
+                transform, np.eye(2, 3)
+            ):
+                # Transform of the image read at the analysis scale.
+                transform = stabilization.rescale_transform(
+                    transform, 1 / setup.analysis_scale
+                )
+                img = stabilization.warp_image(img, transform)
+        if output_dir:
+            cv2.imwrite(os.path.join(output_dir, os.path.basename(file_name)), img)
+        return img
+
+    return stabilize
+
+
+def read_image(file_name, setup):
+    """Read the grayscale image to analyse with the given setup: the whole
+    image, or only the grid and the border needed by the blur if crop_first.
+    If the setup has an image cache (directory, maximum size), images are
+    loaded from it (read-only) and decoded only if they are not cached.
+    """
+    with profiling.stage("decode", file_name):
+        box = None
+        if setup.crop_first:
+            top, left = _crop_origin(setup)
+            border = _blur_border(setup)
+            box = (
+                left,
+                top,
+                setup.min_loc[0] + setup.pat_w + border,
+                setup.min_loc[1] + setup.pat_h + border,
+            )
+        if setup.image_cache is None:
+            return _decode_image(file_name, box, setup.analysis_scale)
+        cache = image_cache.open_cache(*setup.image_cache)
+        key = cache.key(file_name, box, setup.analysis_scale)
+        img = cache.load(key)
+        if img is None:
+            img = _decode_image(file_name, box, setup.analysis_scale)
+            cache.save(key, img)
+        return img
+
+
+def _decode_image(file_name, box, scale):
+    """Decode the whole image, or the region (left, top, right, bottom) if
+    given, downscaled by the given scale."""
+    if box is None:
+        return filesystem.read_gray(file_name, scale)
+    return filesystem.read_gray_region(file_name, box, scale)
+
+
+def _crop_origin(setup):
+    """Position (top, left) in the image of the first pixel read."""
+    if not setup.crop_first:
+        return 0, 0
+    border = _blur_border(setup)
+    return (
+        max(setup.min_loc[1] - border, 0),
+        max(setup.min_loc[0] - border, 0),
+    )
+
+
+def _blur_border(setup):
+    """Half the size of the blur kernel, scaled as the analysed images."""
+    return max(int(round(_BLUR_BORDER * setup.analysis_scale)), 1)
+
+
+def analyse_image(file_name, setup, img=None, blurred=None, otsu=None):
+    """Analyse a single image of the plate described by the given setup.
+    The image is read with `read_image` if not given. The blurred image and
+    its Otsu threshold can be given if they are already known (see
+    `segment_image`).
+    Return the output data-frame and the mask of the spots.
+    """
+    if img is None:
+        img = read_image(file_name, setup)
+    arr, agar, thresh, mask = segment_image(file_name, setup, img, blurred, otsu)
+    # Gray levels of the image, to get its quantiles from histograms.
+    codes = arr if arr.dtype == np.uint8 else None
+    if mask is None:
+        # Create mask to detect spots in each image (pixels >= thresh), to be
+        # saved for a visual check. This will be used only to compute the area
+        # of the spots. Pixels are integers, so p >= thresh iff
+        # p > ceil(thresh) - 1.
+        with profiling.stage("mask", file_name):
+            _, mask = cv2.threshold(
+                np.ascontiguousarray(arr), np.ceil(thresh) - 1, 255, cv2.THRESH_BINARY
             )
-            # Define threshold value between agar color and automatic threshold
-            thresh = max((thresh + color_agar) / 2, color_agar + 1)
-            # Create mask to detect spots in each image.
-            # This will be used only to compute the area of the spots.
-            mask = np.ones(arr.shape, dtype=bool)
-            mask[arr < thresh] = False
             # Make sure that agar is not considered as spot
-            mask[agar] = False
-            # Save mask for a visual check.
-            mask = mask.astype(np.uint8) * 255
+            mask[agar] = 0
+
+    # Normalize image by using reference picture provided. The integral
+    # metrics are computed from the gray levels.
+    with profiling.stage("normalize", file_name):
+        if setup.integral_metrics and codes is not None:
+            pass
+        elif setup.low_memory:
+            # Single precision, in the buffer of the previous image.
+            normalized = _buffer("normalized", arr.shape, np.float32)
+            np.subtract(arr, setup.min_ref, out=normalized, dtype=np.float32)
+            arr = np.divide(normalized, setup.max_ref - setup.min_ref, out=normalized)
         else:
-            # Set threshold based on an adaptive threshold
-            mask_img_modi = cv2.adaptiveThreshold(
-                np.array(
-                    arr_modified[min_loc[1] : h_bottom, min_loc[0] : w_right],
-                    dtype=np.uint8,
-                ),
-                255,
-                cv2.ADAPTIVE_THRESH_MEAN_C,
-                cv2.THRESH_BINARY,
-                block_size,
-                0,
-            )
-            mask = image_processing.get_mask(mask_img_modi, nrow, ncol)
+            arr = (arr - setup.min_ref) / (setup.max_ref - setup.min_ref)
+
+    # Measure culture phenotypes.
+    df = measure_outputs(
+        arr,
+        mask,
+        setup.pat_h,
+        setup.pat_w,
+        setup.nrow,
+        setup.ncol,
+        file_name,
+        setup.spots,
+        setup.light_correction,
+        setup.integral_metrics,
+        codes=codes,
+        levels=normalized_levels(setup),
+    )
+    return df, mask
+
 
-        # Normalize image by using reference picture provided
-        arr = (arr - min_ref) / (max_ref - min_ref)
+def normalized_levels(setup):
+    """Normalized value of each gray level, computed exactly as the images
+    are normalized by `analyse_image`."""
+    levels = np.arange(256, dtype=np.uint8)
+    if setup.low_memory:
+        normalized = np.subtract(levels, setup.min_ref, dtype=np.float32)
+        return np.divide(normalized, setup.max_ref - setup.min_ref, out=normalized)
+    return (levels - setup.min_ref) / (setup.max_ref - setup.min_ref)
 
-        # Measure culture phenotypes.
-        df = measure_outputs(
-            arr, mask, pat_h, pat_w, nrow, ncol, file_name, spots, light_correction
+
+def segment_image(file_name, setup, img, blurred=None, otsu=None):
+    """Find the spots in an image read by `read_image`.
+    Return the grid region of the image, the agar mask fitted to it, and
+    either the threshold of the spots (pixels >= threshold that are not agar)
+    and no mask, or no threshold and the mask of the spots if low_contrasts.
+    The image blurred by `blur_image` and its threshold given by
+    `otsu_threshold` are computed if not given, e.g. to share them between
+    several setups.
+    """
+    # Position of the grid in the image that was read.
+    top, left = _crop_origin(setup)
+    min_loc = (setup.min_loc[0] - left, setup.min_loc[1] - top)
+    w_right = int(min_loc[0] + setup.pat_w)
+    h_bottom = int(min_loc[1] + setup.pat_h)
+
+    arr = img[min_loc[1] : h_bottom, min_loc[0] : w_right]
+
+    # Assume area of spots will always be =< spots at last image, so
+    # set all pixels that are not spots to agar to remove noise
+    agar = setup.agar
+    if agar.shape != arr.shape:
+        # Downscaled images and masks can differ by a pixel when the grid
+        # runs past the image.
+        h = min(arr.shape[0], agar.shape[0])
+        w = min(arr.shape[1], agar.shape[1])
+        agar = np.zeros(arr.shape, dtype=bool)
+        agar[:h, :w] = setup.agar[:h, :w]
+    color_agar = np.mean(arr[agar])
+    if blurred is None:
+        blurred = blur_image(file_name, setup, img)
+    arr_modified = blurred
+
+    if not setup.low_contrasts:
+        # Set threshold automatically
+        if otsu is None:
+            otsu = otsu_threshold(file_name, arr_modified)
+        # Define threshold value between agar color and automatic threshold
+        thresh = max((otsu + color_agar) / 2, color_agar + 1)
+        return arr, agar, thresh, None
+
+    # Set threshold based on an adaptive threshold
+    with profiling.stage("threshold", file_name):
+        mask_img_modi = cv2.adaptiveThreshold(
+            np.array(
+                arr_modified[min_loc[1] : h_bottom, min_loc[0] : w_right],
+                dtype=np.uint8,
+            ),
+            255,
+            cv2.ADAPTIVE_THRESH_MEAN_C,
+            cv2.THRESH_BINARY,
+            setup.block_size,
+            0,
+        )
+    with profiling.stage("mask", file_name):
+        mask = image_processing.get_mask(
+            mask_img_modi, setup.nrow, setup.ncol, setup.sensitivity
         )
+    return arr, agar, None, mask
 
-        logger.debug("Analysis complete for %s", os.path.basename(file_name))
 
-        # Saving output.
-        base_name = filesystem.get_file_name(file_name)
-        filesystem.save_output(base_name, df, mask, output_dir)
+def blur_image(file_name, setup, img):
+    """Blur an image read by `read_image` to find the spots."""
+    kernel_size = 2 * _blur_border(setup) + 1
+    blurred = None
+    if setup.low_memory:
+        # The blurred image is written in the buffer of the previous image.
+        blurred = _buffer("blurred", img.shape, img.dtype)
+    with profiling.stage("blur", file_name):
+        return cv2.GaussianBlur(img, (kernel_size, kernel_size), 0, blurred)
 
-    logger.debug(
-        "All analyses finished in {:.2f} seconds".format(time.time() - start_time)
+
+def otsu_threshold(file_name, blurred):
+    """Automatic threshold of a blurred image."""
+    with profiling.stage("threshold", file_name):
+        thresh, _ = cv2.threshold(
+            blurred,
+            0,
+            255,
+            cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU,
+        )
+    return thresh
+
+
+def _buffer(name, shape, dtype):
+    """Array reused by the images analysed in the current thread. It is
+    allocated again only if the shape or the type change."""
+    array = getattr(_buffers, name, None)
+    if array is None or array.shape != shape or array.dtype != dtype:
+        array = np.empty(shape, dtype=dtype)
+        setattr(_buffers, name, array)
+    return array
+
+
+def peak_memory(children=False):
+    """Peak resident memory (MB) of this process, or the largest of its
+    terminated child processes (e.g. workers). None if it is not available."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(
+        resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
     )
+    # Kilobytes in Linux, bytes in macOS.
+    scale = 1 << 20 if sys.platform == "darwin" else 1 << 10
+    return usage.ru_maxrss / scale
 
 
-def measure_outputs(im, mask, pat_h, pat_w, nrow, ncol, file_name, spots, correction):
+def _memory_message():
+    """Peak memory of this process so far, to be added to the log messages.
+    It is the largest memory used since the process started, not the memory
+    used by the image that was just analysed."""
+    memory = peak_memory()
+    return " (process peak memory: {:.0f} MB)".format(memory) if memory else ""
+
+
+def measure_outputs(
+    im,
+    mask,
+    pat_h,
+    pat_w,
+    nrow,
+    ncol,
+    file_name,
+    spots,
+    correction,
+    integral=False,
+    codes=None,
+    levels=None,
+):
     """Add intensity measures and other measurements to a final dictionary.
     This dictionary will be outputed as a data-frame.
-    """
-    # Outputs will be saved in a dictionary with the following features.
-    allrows, allcols, allintensities, allareas = [], [], [], []
-    allcolonymeans, allcolonyvariance, allbackgroundmeans = [], [], []
 
+    All the spots are measured at once: the image, the mask and the spots are
+    arranged as blocks of shape (nrow, ncol, pixels per patch) and every metric
+    is computed with array reductions over the last axis. If integral is True
+    and the gray levels of the image (codes) are given, the metrics are
+    computed from the sums of the gray levels of each patch instead (see
+    `integral_spot_metrics`), and the image itself is not used.
+
+    If the 8-bit gray levels of the image (codes) are given, with the value of
+    each level in the image (levels), the 1% and 99% quantiles used to clip
+    the patches are computed from the histograms of the levels (see
+    `quantiles.block_quantiles`) instead of sorting the pixels. They are the
+    same as those of `np.quantile` (up to rounding in single precision).
+    """
     # Extract the windows for each spot. First get the window widht and heigh.
     d_x = int(pat_h / nrow)
     d_y = int(pat_w / ncol)
 
-    # From now on: reference point is the top left corner of the rectangle.
-    for i in range(nrow):
-        for j in range(ncol):
-            # Compute position x of each window or patch
-            p_x = j * d_x  # Position x = ncol x dimension_x of window (d_x)
-            p_y = i * d_y  # Position y = nrow x dimension_y of window (d_y)
-            # Get window of this specific colony
-            patch = im[p_y : p_y + d_y, p_x : p_x + d_x]
-            mask_patch = mask[p_y : p_y + d_y, p_x : p_x + d_x]
-            spots_patch = spots[p_y : p_y + d_y, p_x : p_x + d_x]
-
-            # Perform some normalization in order to remove outliers and noise.
-            # The 1% and 99% quantile clipping is a good option.
-            quants = np.quantile(patch.ravel(), [0.01, 0.99])
-            patch = np.clip(patch, *quants)
-
-            # Compute area of colony based on the mask_patch
-            area_patch = np.sum(mask_patch) / patch.size
-            # Compute background mean of patch that will be useful to correct
-            # for differences in intensity between AND within images
-            if correction:
-                backgr = np.mean(patch[~spots_patch])
-                if np.isnan(backgr):
-                    backgr = 0
+    with profiling.stage("measure", file_name):
+        if integral and codes is not None:
+            metrics = integral_spot_metrics(
+                codes, mask, spots, nrow, ncol, d_y, d_x, correction, levels
+            )
+        else:
+            # Arrange all the patches as blocks. Pixels of patches that fall
+            # outside the image (if any) are marked as not valid and ignored.
+            patches = grid_blocks(im, nrow, ncol, d_y, d_x, fill=np.nan)
+            if np.may_share_memory(patches, im):
+                # The patches are modified by spot_metrics.
+                patches = patches.copy()
+            mask_patches = grid_blocks(mask, nrow, ncol, d_y, d_x, fill=0)
+            spots_patches = grid_blocks(spots, nrow, ncol, d_y, d_x, fill=False)
+            if im.shape[-2] >= nrow * d_y and im.shape[-1] >= ncol * d_x:
+                valid = None
+                quantile = np.quantile
             else:
-                backgr = 0
-
-            # Compute tiles intensities and filter only according to spots
-            tile = patch - backgr
-            spot_intensities = tile[spots_patch]
-
-            # If there are colonies in the window or patch, compute metrics
-            if spot_intensities.size > 1:
-                # Compute the mean of the intensity (Normalized from 0 to 1)
-                colony_mean_patch = np.mean(spot_intensities)
-                # Compute the variance of the intensity
-                colony_variance_patch = np.var(spot_intensities)
-            else:  # If there aren't colonies in the window, intensities are 0
-                colony_mean_patch = colony_variance_patch = 0
-
-            # Compute all intensity values normalized by the size of window
-            intens_patch = np.sum(tile) / tile.size
-
-            # Compute agar information (agar is the opposite to the mask)
-            bkgrnd = tile[~spots_patch]
-
-            # If there is background in the patch, compute mean of intensities
-            if bkgrnd.size > 1:
-                background_mean_patch = np.mean(bkgrnd)
-            else:  # If there is no background in the patch, intensities are 0
-                background_mean_patch = 0
-
-            # Save all variables in the final lists
-            allrows.append(i + 1)
-            allcols.append(j + 1)
-            allintensities.append(intens_patch)
-            allareas.append(area_patch)
-            allcolonymeans.append(colony_mean_patch)
-            allcolonyvariance.append(colony_variance_patch)
-            allbackgroundmeans.append(background_mean_patch)
+                valid = ~np.isnan(patches)
+                quantile = np.nanquantile
+            bounds = None
+            if codes is not None:
+                code_patches = grid_blocks(codes, nrow, ncol, d_y, d_x, fill=0)
+                bounds = quantiles.block_quantiles(
+                    code_patches, [0.01, 0.99], levels, valid=valid
+                )
+
+            metrics = spot_metrics(patches, mask_patches, spots_patches, correction,
+                                   valid=valid, quantile=quantile, bounds=bounds)
+        # Outputs are always saved in double precision.
+        metrics = {name: values.astype(np.float64) for name, values in metrics.items()}
 
     # Save final outputs
     fname = filesystem.get_file_name(file_name)
     brcod = re.sub("\D[\d]+-[\d]+-[\d]+.*", "", fname)
-    return pd.DataFrame(
-        {
-            "Row": allrows,
-            "Column": allcols,
-            "Intensity": allintensities,
-            "Area": allareas,
-            "ColonyMean": allcolonymeans,
-            "ColonyVariance": allcolonyvariance,
-            "BackgroundMean": allbackgroundmeans,
-            "Barcode": [brcod] * len(allrows),
-            "Filename": [fname] * len(allrows),
-        }
+    with profiling.stage("dataframe", file_name):
+        return pd.DataFrame(
+            {
+                "Row": np.repeat(np.arange(1, nrow + 1), ncol),
+                "Column": np.tile(np.arange(1, ncol + 1), nrow),
+                "Intensity": metrics["Intensity"].ravel(),
+                "Area": metrics["Area"].ravel(),
+                "ColonyMean": metrics["ColonyMean"].ravel(),
+                "ColonyVariance": metrics["ColonyVariance"].ravel(),
+                "BackgroundMean": metrics["BackgroundMean"].ravel(),
+                "Barcode": [brcod] * (nrow * ncol),
+                "Filename": [fname] * (nrow * ncol),
+            }
+        )
+
+
+def grid_blocks(arr, nrow, ncol, d_y, d_x, fill=0):
+    """Arrange the patches of a grid as an array of shape
+    (..., nrow, ncol, d_y * d_x), where the last axis holds the pixels of
+    each patch. Leading dimensions of the given array (e.g. time) are kept.
+
+    Patches falling partially outside the array are completed with `fill`.
+    """
+    arr = np.asarray(arr)
+    lead = arr.shape[:-2]
+    h, w = nrow * d_y, ncol * d_x
+    if arr.shape[-2] < h or arr.shape[-1] < w:
+        full = np.full(lead + (h, w), fill, dtype=np.result_type(arr, fill))
+        h_in, w_in = min(arr.shape[-2], h), min(arr.shape[-1], w)
+        full[..., :h_in, :w_in] = arr[..., :h_in, :w_in]
+        arr = full
+    blocks = arr[..., :h, :w].reshape(lead + (nrow, d_y, ncol, d_x))
+    return np.swapaxes(blocks, -3, -2).reshape(lead + (nrow, ncol, d_y * d_x))
+
+
+def spot_metrics(patches, mask_patches, spots_patches, correction, valid=None,
+                 quantile=np.quantile, bounds=None):
+    """Compute the metrics of all the spots given as blocks (see `grid_blocks`).
+    Returns a dictionary with one array of shape (..., nrow, ncol) per metric.
+    The patches are modified in place to avoid copies of the image.
+    The 1% and 99% quantiles of the patches are computed with `quantile`,
+    unless they are given as bounds.
+    """
+    # Perform some normalization in order to remove outliers and noise.
+    # The 1% and 99% quantile clipping is a good option.
+    if bounds is None:
+        bounds = quantile(patches, [0.01, 0.99], axis=-1, keepdims=True)
+    low, high = bounds
+    patches = np.clip(patches, low, high, out=patches)
+
+    # Number of pixels of each patch. Pixels outside of the image are ignored.
+    if valid is None:
+        size = np.full(patches.shape[:-1], patches.shape[-1])
+        agar_patches = ~spots_patches
+    else:
+        size = np.count_nonzero(valid, axis=-1)
+        patches[~valid] = 0
+        spots_patches = spots_patches & valid
+        agar_patches = ~spots_patches & valid
+
+    # Compute area of colony based on the mask_patch
+    areas = np.sum(mask_patches, axis=-1) / size
+
+    n_spots = np.count_nonzero(spots_patches, axis=-1)
+    n_agar = np.count_nonzero(agar_patches, axis=-1)
+
+    # Compute background mean of patch that will be useful to correct
+    # for differences in intensity between AND within images
+    if correction:
+        backgr = _masked_mean(patches, agar_patches, n_agar)
+    else:
+        backgr = np.zeros(patches.shape[:-1])
+
+    # Compute tiles intensities and filter only according to spots
+    tiles = np.subtract(patches, backgr[..., np.newaxis], out=patches)
+    if valid is not None:
+        tiles[~valid] = 0
+
+    # If there are colonies in the window or patch, compute metrics.
+    # If there aren't colonies in the window, intensities are 0.
+    colony_means = _masked_mean(tiles, spots_patches, n_spots)
+    deviations = np.subtract(tiles, colony_means[..., np.newaxis], dtype=tiles.dtype)
+    deviations = np.square(deviations, out=deviations)
+    colony_variances = _masked_mean(deviations, spots_patches, n_spots)
+    colony_means[n_spots <= 1] = 0
+    colony_variances[n_spots <= 1] = 0
+
+    # Compute all intensity values normalized by the size of window
+    intensities = np.sum(tiles, axis=-1) / size
+
+    # Compute agar information (agar is the opposite to the mask).
+    # If there is no background in the patch, intensities are 0.
+    background_means = _masked_mean(tiles, agar_patches, n_agar)
+    background_means[n_agar <= 1] = 0
+
+    return {
+        "Intensity": intensities,
+        "Area": areas,
+        "ColonyMean": colony_means,
+        "ColonyVariance": colony_variances,
+        "BackgroundMean": background_means,
+    }
+
+
+def integral_spot_metrics(
+    codes, mask, spots, nrow, ncol, d_y, d_x, correction, levels, bounds=None
+):
+    """Compute the same metrics as `spot_metrics` for the patches of size
+    (d_y, d_x) of the grid from the sums over each patch of the 8-bit gray
+    levels of the image (codes), whose values are given by `levels`. Sorted,
+    the values must be evenly spaced, as those of `normalized_levels` (where
+    levels below min_ref wrap around). The levels are replaced by their rank,
+    clipped with lookup tables and summed by OpenCV (see `_patch_sums`), so
+    the image is never converted to floating point.
+
+    This is an approximation: instead of clipping each patch to its own 1%
+    and 99% quantiles, the whole grid is clipped to its 1% and 99% quantiles
+    once, so outliers that are only extreme within their patch are kept.
+    These quantiles can be given as bounds of shape (2, ..., 1, 1).
+    """
+    h, w = codes.shape[-2:]
+    # Limits of the patches, within the image.
+    ys = np.minimum(np.arange(nrow + 1) * d_y, h)
+    xs = np.minimum(np.arange(ncol + 1) * d_x, w)
+    levels = np.asarray(levels, dtype=np.float64)
+    # Rank of each level in the sorted values: slope * rank + offset is the
+    # value of the level.
+    order = np.argsort(levels, kind="stable")
+    ranks = np.empty(len(levels), dtype=np.uint8)
+    ranks[order] = np.arange(len(levels))
+    offset = levels[order[0]]
+    slope = (levels[order[-1]] - offset) / (len(levels) - 1)
+    squares_lut = np.square(np.arange(len(levels))).astype(np.uint16)
+
+    # Spots fitted to the image, as 0 or 255.
+    spots_fit = np.zeros((h, w), dtype=np.uint8)
+    s_h, s_w = min(h, spots.shape[0]), min(w, spots.shape[1])
+    spots_fit[:s_h, :s_w] = spots[:s_h, :s_w]
+    spots_fit *= 255
+
+    # Number of pixels of each patch. Pixels outside of the image are ignored.
+    size = np.outer(np.diff(ys), np.diff(xs))
+    n_spots = _patch_sums(spots_fit, ys, xs) // 255
+    n_agar = size - n_spots
+
+    lead = codes.shape[:-2]
+    low, high = np.empty((2,) + lead + (1, 1))
+    # Sums over each patch, of the whole patch and of its spots, of the gray
+    # levels within the bounds and of the numbers of pixels below and above
+    # them, then of the squares of the gray levels of the spots and the mask.
+    sums = np.empty((8,) + lead + size.shape, dtype=np.int64)
+    for index in np.ndindex(lead):
+        image = codes[index]
+        if bounds is None:
+            # Quantiles of the grid, from its histogram.
+            counts = quantiles.image_histogram(image[: ys[-1], : xs[-1]])
+            low[index], high[index] = quantiles.histogram_quantiles(
+                counts[np.newaxis], [0.01, 0.99], levels
+            )
+        else:
+            low[index], high[index] = bounds[0][index], bounds[1][index]
+        below = (levels < low[index].item()).astype(np.uint8)
+        above = (levels > high[index].item()).astype(np.uint8)
+        inside = np.where(below | above, 0, ranks).astype(np.uint8)
+        clipped = [cv2.LUT(image, lut) for lut in (inside, below, above)]
+        for i, arr in enumerate(clipped):
+            sums[(i,) + index] = _patch_sums(arr, ys, xs)
+            cv2.bitwise_and(arr, spots_fit, dst=arr)
+            sums[(i + 3,) + index] = _patch_sums(arr, ys, xs)
+        sums[(6,) + index] = _patch_sums(cv2.LUT(clipped[0], squares_lut), ys, xs)
+        sums[(7,) + index] = _patch_sums(_as_uint8(mask[index]), ys, xs)
+
+    def clipped_sum(sums, n_below, n_above, n_pixels):
+        n_inside = n_pixels - n_below - n_above
+        return slope * sums + offset * n_inside + low * n_below + high * n_above
+
+    total = clipped_sum(sums[0], sums[1], sums[2], size)
+    spots_sum = clipped_sum(sums[3], sums[4], sums[5], n_spots)
+    spots_squares = (
+        slope**2 * sums[6]
+        + 2 * slope * offset * sums[3]
+        + offset**2 * (n_spots - sums[4] - sums[5])
+        + low**2 * sums[4]
+        + high**2 * sums[5]
     )
+    agar_sum = total - spots_sum
+
+    # Compute area of colony based on the mask
+    areas = _divide(sums[7], size)
+
+    # Background mean of each patch, to correct for differences in intensity
+    # between AND within images.
+    if correction:
+        backgr = _divide(agar_sum, n_agar)
+    else:
+        backgr = np.zeros(total.shape)
+
+    # The metrics of the tiles (image minus background) are derived from the
+    # sums of the image.
+    colony_means = _divide(spots_sum, n_spots)
+    colony_variances = np.maximum(
+        _divide(spots_squares, n_spots) - np.square(colony_means), 0
+    )
+    colony_means -= backgr
+    colony_means[n_spots <= 1] = 0
+    colony_variances[n_spots <= 1] = 0
+    intensities = _divide(total, size) - backgr
+    background_means = _divide(agar_sum, n_agar) - backgr
+    background_means[n_agar <= 1] = 0
+
+    return {
+        "Intensity": intensities,
+        "Area": areas,
+        "ColonyMean": colony_means,
+        "ColonyVariance": colony_variances,
+        "BackgroundMean": background_means,
+    }
+
+
+def _patch_sums(image, ys, xs):
+    """Sums of the pixels of a 2-D 8-bit or 16-bit image over the patches
+    between consecutive limits ys and xs, as an array of shape
+    (len(ys) - 1, len(xs) - 1) of integers. Each row of patches is summed
+    over its rows by OpenCV, and then over the columns of each patch.
+    """
+    # OpenCV sums 16-bit images only in floating point, which is exact.
+    depth = cv2.CV_32S if image.dtype == np.uint8 else cv2.CV_64F
+    columns = np.zeros((len(ys) - 1, image.shape[1] + 1), dtype=np.int64)
+    for i, (y0, y1) in enumerate(zip(ys[:-1], ys[1:])):
+        if y1 > y0:
+            band = cv2.reduce(image[y0:y1], 0, cv2.REDUCE_SUM, dtype=depth)
+            np.cumsum(band[0].astype(np.int64), out=columns[i, 1:])
+    return columns[:, xs[1:]] - columns[:, xs[:-1]]
+
+
+def _as_uint8(arr):
+    return arr.view(np.uint8) if arr.dtype == bool else arr
+
+
+def _divide(total, count):
+    """Divide, giving 0 where the count is 0."""
+    total = np.asarray(total, dtype=np.float64)
+    return np.divide(total, count, out=np.zeros(total.shape), where=count > 0)
+
+
+def _masked_mean(values, where, count):
+    """Mean over the last axis of the values selected by `where`.
+    Patches without any selected value get a mean of 0."""
+    total = np.sum(values * where, axis=-1)
+    return np.divide(total, count, out=np.zeros(total.shape), where=count > 0)
@@ -1,3 +1,7 @@
 from .analyse import *
+from .analyse_batch import *
+from .convert_outputs import *
 from .rename_images import *
 from .stabilize_images import *
+from .sweep import *
+from .watch import *
@@ -3,7 +3,13 @@ import abc
 
 class AbstractCommand:
     """Abstract class used to define shared logic for all commands in
-    bacolonyzer."""
+    bacolonyzer.
+
+    All the commands are registered every time bacolonyzer runs, so modules
+    that import heavy dependencies (OpenCV, pandas, SciPy...) are imported
+    in `run`: the command line starts quickly and only the command used pays
+    for its dependencies.
+    """
 
     # Name for the command.
     _SUBCOMMAND = None
@@ -2,7 +2,7 @@
 
 import logging
 
-from bacolonyzer import analysis, filesystem, utils
+from bacolonyzer import utils
 from bacolonyzer.commands import abstract
 
 logger = logging.getLogger(__name__)
@@ -26,6 +26,71 @@ class AnalyseCommand(abstract.AbstractCommand):
             Default: current directory.""",
             default=".",
         )
+        self.register_analysis_arguments(parser)
+        self.register_series_arguments(parser)
+        parser.add_argument(
+            "--stabilize",
+            help="""Stabilize each image in memory before analysing it, with
+            respect to the image used to locate the grid (see
+            stabilize_images). The images are first tracked in order from
+            the earliest one, and the transform of each image is saved in
+            Output_Data/stabilization.json. Images are then analysed one
+            after another.
+            Default: False. Analyse the images as they are.""",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--stabilized_dir",
+            type=str,
+            help="""Directory where the stabilized images are saved (in
+            grayscale, as analysed), if --stabilize is used.
+            Default: Stabilized images are not saved.""",
+            default=None,
+        )
+        parser.add_argument(
+            "--image_cache",
+            type=str,
+            nargs="?",
+            const="",
+            help="""Cache the decoded images (only the grid, with
+            --crop_first) in the given directory, or in
+            Output_Data/image_cache if no directory is given. Later analyses
+            of the same images with any other parameters (e.g.
+            --low_contrasts or --reference_image) read them from the cache
+            instead of decoding them.
+            Default: Images are not cached.""",
+            default=None,
+        )
+        parser.add_argument(
+            "--image_cache_size",
+            type=utils.non_negative_int,
+            help="""Maximum size of the image cache in MB. The images used
+            least recently are removed when the cache is larger.
+            Default: 4096.""",
+            default=4096,
+        )
+        parser.add_argument(
+            "--profile",
+            help="""Time each stage of the analysis of each image (decoding,
+            blur, threshold, measures, writing of the outputs...), and the
+            location of the grid. The times are saved in
+            Output_Data/profile_images.tsv, with a summary of each stage in
+            Output_Data/profile_summary.tsv.
+            Default: False. Stages are not timed.""",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--profile_dump",
+            type=str,
+            help="""Profile the analysis with cProfile and save the statistics
+            in the given file, e.g. to inspect them with snakeviz or
+            "python -m pstats".
+            Default: No profile is saved.""",
+            default=None,
+        )
+
+    def register_analysis_arguments(self, parser):
+        """Register the arguments that control the analysis of a plate."""
         parser.add_argument(
             "-c",
             "--light_correction_off",
@@ -52,14 +117,6 @@ class AnalyseCommand(abstract.AbstractCommand):
             Default: show messages.""",
             action="store_true",
         )
-        parser.add_argument(
-            "-e",
-            "--endpoint",
-            help="""Analyses only the final image in the series.
-            It is useful to test single images.
-            Default: False. Analyse all images in the directory.""",
-            action="store_true",
-        )
         parser.add_argument(
             "-g",
             "--grid_format",
@@ -88,6 +145,14 @@ class AnalyseCommand(abstract.AbstractCommand):
             Default: False. Do not perform adaptive segmentation.""",
             action="store_true",
         )
+        parser.add_argument(
+            "--sensitivity",
+            type=utils.range_float,
+            help="""Fraction of the size of a patch by which the spots are
+            dilated when they are detected (and the agar is reduced).
+            Default: 0.05.""",
+            default=0.05,
+        )
         parser.add_argument(
             "-p",
             "--grid_by_peaks",
@@ -95,8 +160,152 @@ class AnalyseCommand(abstract.AbstractCommand):
             higher in intensity than the spots. You might need to provide a fake image with white spots drawn onto real spots.""",
             action="store_true",
         )
+        parser.add_argument(
+            "-s",
+            "--grid_search_scale",
+            type=utils.scale_float,
+            help="""Scale used to search the grid pattern in a downscaled image
+            before refining it at full resolution. Smaller values are faster
+            but less accurate (e.g. 0.25).
+            Default: 1. Search the pattern at full resolution only.""",
+            default=1.0,
+        )
+        parser.add_argument(
+            "--grid_threads",
+            type=utils.non_negative_int,
+            help="""Number of threads used to try the different sizes of the
+            grid pattern in parallel. Use 0 to use all the available cores.
+            Default: 1.""",
+            default=1,
+        )
+        parser.add_argument(
+            "--recompute_grid",
+            help="""Locate the grid again even if it was already found by a
+            previous analysis of the same latest image with the same
+            parameters.
+            Default: False. Reuse the grid of previous analyses.""",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--analysis_scale",
+            type=utils.scale_float,
+            help="""Scale of the images analysed (e.g. 0.5). The grid is
+            located at full resolution and each image is downscaled before
+            analysing it. Smaller values are faster but less precise.
+            Default: 1. Analyse the images at full resolution.""",
+            default=1.0,
+        )
+        parser.add_argument(
+            "--low_memory",
+            help="""Analyse each image in single precision, reusing the same
+            memory for all the images. It needs about half the memory, and the
+            outputs differ from the default analysis by about 1e-7.
+            Default: False. Analyse the images in double precision.""",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--integral_metrics",
+            help="""Compute the outputs from the sums of the gray levels of
+            each spot, without converting the images to floating point,
+            which is faster and uses less memory. Instead of removing the
+            outliers of each spot (1%% and 99%% quantiles), the outliers of
+            the whole grid are removed, so outputs may differ slightly from
+            the default analysis.
+            Default: False. Remove the outliers of each spot.""",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--crop_first",
+            help="""Read, blur and threshold only the grid (plus a small
+            border) of each image instead of the whole image. It is faster
+            when the plate is surrounded by a large border, but the automatic
+            threshold is computed on the grid only, so outputs may differ
+            slightly from the default analysis.
+            Default: False. Process the whole image.""",
+            action="store_true",
+        )
+        parser.add_argument(
+            "-o",
+            "--output_format",
+            choices=utils.OUTPUT_FORMATS,
+            help="""Format of the output data. "tsv" saves a tab delimited
+            file per image. "parquet", "feather" and "hdf5" save the outputs
+            of all images in a single file per plate ("columnar" uses parquet
+            if pyarrow is installed and hdf5 otherwise).
+            Default: tsv.""",
+            default="tsv",
+        )
+        parser.add_argument(
+            "--mask_scale",
+            type=utils.mask_scale_float,
+            help="""Scale of the images of the spots saved in Output_Images
+            (e.g. 0.25). Use 0 to not save them.
+            Default: 1. Save the images at full resolution.""",
+            default=1.0,
+        )
+        parser.add_argument(
+            "--png_compression",
+            type=int,
+            choices=range(10),
+            metavar="{0-9}",
+            help="""Compression level of the images saved in Output_Images,
+            from 0 (fastest) to 9 (smallest files).
+            Default: the default level of OpenCV.""",
+            default=None,
+        )
+        parser.add_argument(
+            "--write_queue",
+            type=utils.non_negative_int,
+            help="""Maximum number of outputs waiting to be saved in the
+            background while the next images are analysed. Use 0 to save
+            each output before analysing the next image.
+            Default: 4.""",
+            default=4,
+        )
+
+    def register_series_arguments(self, parser):
+        """Register the arguments that control which images of the series
+        are analysed and how."""
+        parser.add_argument(
+            "-e",
+            "--endpoint",
+            help="""Analyses only the final image in the series.
+            It is useful to test single images.
+            Default: False. Analyse all images in the directory.""",
+            action="store_true",
+        )
+        parser.add_argument(
+            "-i",
+            "--incremental",
+            help="""Analyses only the images without up to date outputs, i.e.
+            new or modified images, or images analysed with other parameters.
+            The grid of the previous analysis is kept (unless
+            --recompute_grid is given).
+            Default: False. Analyse all images.""",
+            action="store_true",
+        )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=utils.non_negative_int,
+            help="""Number of processes used to analyse the images in
+            parallel. Use 0 to use all the available cores.
+            Default: 1. Analyse the images one after another.""",
+            default=1,
+        )
+        parser.add_argument(
+            "--prefetch",
+            type=utils.non_negative_int,
+            help="""Number of images read in the background while another
+            image is analysed. It limits the number of images kept in memory
+            by each process. Use 0 to read each image when it is needed.
+            Default: 2.""",
+            default=2,
+        )
 
     def run(self, args):
+        from bacolonyzer import analysis, filesystem, profiling
+
         # Setup logger
         if args.quiet:
             logging.basicConfig(format="%(message)s", level=logging.INFO)
@@ -117,16 +326,37 @@ class AnalyseCommand(abstract.AbstractCommand):
         imanalyse = filesystem.get_images(fdir, args.endpoint, args.reference_image)
 
         # Perform main logic.
-        analysis.analyse_timeseries_qfa(
-            imanalyse,
-            nrow,
-            ncol,
-            fdir,
-            light_correction=args.light_correction_off,
-            fraction=args.fraction,
-            reference_image=args.reference_image,
-            low_contrasts=args.low_contrasts,
-            grid_by_peaks=args.grid_by_peaks,
-        )
+        with profiling.cprofile(args.profile_dump):
+            analysis.analyse_timeseries_qfa(
+                imanalyse,
+                nrow,
+                ncol,
+                fdir,
+                light_correction=args.light_correction_off,
+                fraction=args.fraction,
+                reference_image=args.reference_image,
+                low_contrasts=args.low_contrasts,
+                grid_by_peaks=args.grid_by_peaks,
+                jobs=args.jobs,
+                prefetch=args.prefetch,
+                search_scale=args.grid_search_scale,
+                grid_threads=args.grid_threads,
+                recompute_grid=args.recompute_grid,
+                crop_first=args.crop_first,
+                analysis_scale=args.analysis_scale,
+                low_memory=args.low_memory,
+                sensitivity=args.sensitivity,
+                integral_metrics=args.integral_metrics,
+                output_format=args.output_format,
+                mask_scale=args.mask_scale,
+                png_compression=args.png_compression,
+                write_queue=args.write_queue,
+                incremental=args.incremental,
+                profile=args.profile,
+                stabilize=args.stabilize,
+                stabilized_dir=args.stabilized_dir,
+                image_cache_dir=args.image_cache,
+                image_cache_size=args.image_cache_size,
+            )
 
         logger.info("No more images to analyse. I'm done")
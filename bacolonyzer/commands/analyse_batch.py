@@ -0,0 +1,97 @@
+"""Definition of all commands available in BaColonyzer."""
+
+import logging
+
+from bacolonyzer import utils
+from bacolonyzer.commands import analyse
+
+logger = logging.getLogger(__name__)
+
+
+class AnalyseBatchCommand(analyse.AnalyseCommand):
+    _SUBCOMMAND = "analyse_batch"
+    _DESCRIPTION = """\
+    Analyse timeseries of QFA images of many plates at once: each directory is
+    analysed as a plate with its own grid and outputs, and all the images are
+    shared by a single pool of processes.
+    """
+
+    def register_arguments(self, parser):
+        parser.add_argument(
+            "-d",
+            "--directories",
+            type=str,
+            nargs="+",
+            help="""Directories (or glob patterns matching directories) in
+            which to search for image files that need to be analysed. Each
+            directory is analysed as a different plate.
+            Default: all directories inside the current directory.""",
+            default=["*"],
+        )
+        self.register_analysis_arguments(parser)
+        self.register_series_arguments(parser)
+        # Plates are analysed in parallel using all the cores by default.
+        parser.set_defaults(jobs=0)
+
+    def run(self, args):
+        from bacolonyzer import analysis, filesystem
+
+        # Setup logger
+        if args.quiet:
+            logging.basicConfig(format="%(message)s", level=logging.INFO)
+        else:
+            logging.basicConfig(format="%(message)s", level=logging.DEBUG)
+
+        # Print information of inputs to users.
+        utils.summarise(args)
+        filesystem.reference_info(args.reference_image)
+
+        nrow, ncol = utils.get_grid_format(args.grid_format)
+
+        # Find the images of each plate and create the output directories.
+        plates = []
+        for fdir in filesystem.get_directories(args.directories):
+            try:
+                imanalyse = filesystem.get_images(
+                    fdir, args.endpoint, args.reference_image)
+            except ValueError:
+                logger.debug("Skipping %s: no images found.", fdir)
+                continue
+            filesystem.arrange_directories(fdir)
+            plates.append((fdir, imanalyse))
+        if not plates:
+            raise ValueError("No images to analyse. Check --directories.")
+        logger.info("Analysing %s plates.", len(plates))
+
+        # Perform main logic.
+        failures = analysis.analyse_plates(
+            plates,
+            nrow,
+            ncol,
+            light_correction=args.light_correction_off,
+            fraction=args.fraction,
+            reference_image=args.reference_image,
+            low_contrasts=args.low_contrasts,
+            grid_by_peaks=args.grid_by_peaks,
+            jobs=args.jobs,
+            prefetch=args.prefetch,
+            search_scale=args.grid_search_scale,
+            grid_threads=args.grid_threads,
+            recompute_grid=args.recompute_grid,
+            crop_first=args.crop_first,
+            analysis_scale=args.analysis_scale,
+            low_memory=args.low_memory,
+            sensitivity=args.sensitivity,
+            integral_metrics=args.integral_metrics,
+            output_format=args.output_format,
+            mask_scale=args.mask_scale,
+            png_compression=args.png_compression,
+            write_queue=args.write_queue,
+            incremental=args.incremental,
+        )
+
+        if failures:
+            raise RuntimeError(
+                "Analysis failed for {} of {} plates: {}".format(
+                    len(failures), len(plates), ", ".join(sorted(failures))))
+        logger.info("No more images to analyse. I'm done")
@@ -0,0 +1,62 @@
+"""Definition of all commands available in BaColonyzer."""
+
+import logging
+
+from bacolonyzer import utils
+from bacolonyzer.commands import abstract
+
+logger = logging.getLogger(__name__)
+
+
+class ConvertOutputsCommand(abstract.AbstractCommand):
+    _SUBCOMMAND = "convert_outputs"
+    _DESCRIPTION = """\
+    Convert the output data of a directory between the tab delimited files
+    of each image and a single columnar file (Parquet, Feather or HDF5).
+    """
+
+    def register_arguments(self, parser):
+        parser.add_argument(
+            "-d",
+            "--directory",
+            type=str,
+            help="""Directory that was analysed, i.e. that contains the
+            Output_Data folder. Default: current directory.""",
+            default=".",
+        )
+        parser.add_argument(
+            "-f",
+            "--from_format",
+            choices=utils.OUTPUT_FORMATS,
+            help="Format of the existing outputs. Default: tsv.",
+            default="tsv",
+        )
+        parser.add_argument(
+            "-t",
+            "--to_format",
+            choices=utils.OUTPUT_FORMATS,
+            help="Format of the new outputs. Default: parquet.",
+            default="parquet",
+        )
+        parser.add_argument(
+            "-q",
+            "--quiet",
+            help="""Suppresses messages printed during the conversion.
+            Default: show messages.""",
+            action="store_true",
+        )
+
+    def run(self, args):
+        from bacolonyzer import filesystem, output_store
+
+        # Setup logger
+        if args.quiet:
+            logging.basicConfig(format="%(message)s", level=logging.INFO)
+        else:
+            logging.basicConfig(format="%(message)s", level=logging.DEBUG)
+
+        fdir = filesystem.get_directory(args.directory)
+        logger.debug("Converting outputs of %s from %s to %s.", fdir,
+                     args.from_format, args.to_format)
+        output_store.convert_outputs(fdir, args.from_format, args.to_format)
+        logger.info("All outputs converted.")
@@ -22,8 +22,12 @@ def run():
     # Register all possible commands of BaColonyzer to the main inputs parser.
     subparsers = parser.add_subparsers()
     commands.AnalyseCommand().register_parser(subparsers)
+    commands.AnalyseBatchCommand().register_parser(subparsers)
+    commands.ConvertOutputsCommand().register_parser(subparsers)
     commands.RenameImagesCommand().register_parser(subparsers)
     commands.StabilizeImagesCommand().register_parser(subparsers)
+    commands.SweepCommand().register_parser(subparsers)
+    commands.WatchCommand().register_parser(subparsers)
 
     # Actually parsing the inputs given by the user.
     options = parser.parse_args()
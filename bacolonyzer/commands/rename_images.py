@@ -3,8 +3,8 @@ import glob
 import os
 import time
 
+from bacolonyzer import utils
 from bacolonyzer.commands import abstract
-from PIL import Image
 
 
 class RenameImagesCommand(abstract.AbstractCommand):
@@ -56,13 +56,69 @@ class RenameImagesCommand(abstract.AbstractCommand):
             help="Time interval between files in minutes. Default: 30.",
             type=int,
             default=30)
+        parser.add_argument(
+            "-t",
+            "--threads",
+            help="""Number of threads used to read the metadata of the images.
+            Use 0 to use as many as Python recommends. Default: 8.""",
+            type=utils.non_negative_int,
+            default=8)
         parser.add_argument(
             "--no_dry_run",
             help="""By default the change of names won't take place.
             If you specify this flag the renaming will take place.""",
             action="store_true")
+        parser.add_argument(
+            "--manifest",
+            help="""File where the renaming is saved (old name, new name and
+            timestamp of each file) to audit it or revert it. An existing
+            file is never replaced. Default:
+            rename_manifest_YYYY-MM-DD_hh-mm-ss.tsv in the directory (with a
+            number added if it exists).""",
+            default=None)
+        parser.add_argument(
+            "--revert",
+            metavar="MANIFEST",
+            help="""Give back the old names to the files renamed as saved in
+            the given manifest, instead of renaming the images. Use it with
+            --no_dry_run to apply it. The revert is saved in a new manifest
+            in the same directory.""",
+            default=None)
 
     def run(self, args):
+        from bacolonyzer import renaming
+
+        if args.revert:
+            # Give back the old names to the files renamed in the manifest.
+            plan = renaming.check_renames([
+                (new, old) for old, new in renaming.read_manifest(args.revert)
+            ])
+            timestamps = None
+            print('Found {} files to rename back.'.format(len(plan)))
+        else:
+            plan, timestamps = self.plan_renames(args)
+
+        # Show the renaming to the user.
+        for old_path, new_path in plan:
+            print("{} -> {}".format(old_path, new_path))
+
+        # If specified by users, perform the actual renaming of files.
+        if args.no_dry_run and plan:
+            # The manifest of a revert is saved next to the one reverted.
+            directory = (os.path.dirname(os.path.abspath(args.revert))
+                         if args.revert else args.directory)
+            manifest = args.manifest or renaming.new_manifest_path(directory)
+            # The manifest is saved first to be able to revert any renaming.
+            renaming.save_manifest(manifest, plan, timestamps)
+            renaming.apply_renames(plan)
+            print("All files renamed! The renaming is saved in {}. "
+                  "Use --revert to undo it.".format(manifest))
+
+    def plan_renames(self, args):
+        """Find the files to rename and their new names.
+        Return the planned renames and the timestamp of each file."""
+        from bacolonyzer import renaming
+
         # Get list of files to rename.
         file_names = glob.glob(os.path.join(args.directory, args.glob))
         file_names.sort()
@@ -73,42 +129,31 @@ class RenameImagesCommand(abstract.AbstractCommand):
                     args.glob))
         print('Found {} files to rename.'.format(len(file_names)))
 
-        # Define starting date time and time interval according to -s and -i
-        current_datetime = args.start_time
-        delta_time = datetime.timedelta(minutes=args.interval)
-
-        for file_path in file_names:
-            # Get extension of the files
-            extension = os.path.splitext(file_names[0])[1]
-
-            if args.no_read_metadata:
-                # Use default or imputed values of date and time
-                date_time = current_datetime.strftime("%Y-%m-%d_%H-%M-%S")
-                current_datetime += delta_time
-            else:
-                # Obtain date and time from image metadata
-                exif_data = Image.open(file_path)._getexif()
-                if not exif_data:
-                    raise RuntimeError(
-                        '''Metadata is not available from these images.
-                        Please, use parameters -m, -s and -i
-                        to properly rename your images.''')
-                else:
-                    exif_data = exif_data[36867]
-                    d_t = datetime.datetime.strptime(exif_data,
-                                                     '%Y:%m:%d %H:%M:%S')
-                    date_time = d_t.strftime("%Y-%m-%d_%H-%M-%S")
-
-            # Create new file name
-            new_file_name = args.prefix + date_time + extension
-            new_path = os.path.join(os.path.dirname(file_path), new_file_name)
-
-            # Show the renaming to the user.
-            print("{} -> {}".format(file_path, new_path))
-            # If specified by users, perform the actual renaming of files.
-            if args.no_dry_run:
-                os.rename(file_path, new_path)
+        if args.no_read_metadata:
+            # Use default or imputed values of date and time, defined
+            # according to -s and -i
+            delta_time = datetime.timedelta(minutes=args.interval)
+            timestamps = [
+                args.start_time + i * delta_time
+                for i in range(len(file_names))
+            ]
+        else:
+            # Obtain date and time from image metadata
+            timestamps = renaming.read_timestamps(file_names, args.threads)
+            missing = [
+                f for f, t in zip(file_names, timestamps) if t is None
+            ]
+            if missing:
+                raise RuntimeError(
+                    '''Metadata is not available from these images: {}.
+                    Please, use parameters -m, -s and -i
+                    to properly rename your images.'''.format(
+                        ", ".join(missing)))
 
-        # Print information to users
-        if args.no_dry_run:
-            print("All files renamed!")
+        # Create new file names, keeping the extension of each file.
+        new_names = [
+            args.prefix + t.strftime("%Y-%m-%d_%H-%M-%S") +
+            os.path.splitext(f)[1] for f, t in zip(file_names, timestamps)
+        ]
+        plan = renaming.plan_renames(file_names, new_names)
+        return plan, dict(zip(file_names, timestamps))
@@ -2,11 +2,7 @@
 import logging
 import os
 
-import cv2
-import numpy as np
-from tqdm import tqdm
-
-from bacolonyzer import analysis, filesystem, utils
+from bacolonyzer import utils
 from bacolonyzer.commands import abstract
 
 logger = logging.getLogger(__name__)
@@ -44,8 +40,36 @@ class StabilizeImagesCommand(abstract.AbstractCommand):
             help="""Suppresses messages printed during the analysis.
             Default: show messages.""",
             action="store_true")
+        parser.add_argument(
+            "-s",
+            "--scale",
+            type=utils.scale_float,
+            help="""Scale of the images used to estimate the movements (e.g.
+            0.5). Smaller values are faster but less precise. The stabilized
+            images are always saved at full resolution.
+            Default: 1. Use the images at full resolution.""",
+            default=1.0)
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=utils.non_negative_int,
+            help="""Number of threads that rotate and save the stabilized
+            images while the movement of the next images is estimated. Use 0
+            to use all the available cores.
+            Default: 1.""",
+            default=1)
+        parser.add_argument(
+            "--prefetch",
+            type=utils.non_negative_int,
+            help="""Number of images read in the background while another
+            image is stabilized. Use 0 to read each image when it is needed.
+            Default: 2.""",
+            default=2)
 
     def run(self, args):
+        from bacolonyzer import filesystem, stabilization
+        from tqdm import tqdm
+
         # Setup logger
         if args.quiet:
             logging.basicConfig(format="%(message)s", level=logging.INFO)
@@ -65,66 +89,15 @@ class StabilizeImagesCommand(abstract.AbstractCommand):
             for p in input_images_paths
         ]
 
-        # Load first frame to use as first reference and save it as it is.
-        prev, prev_gray = load_image_color_gray(input_images_paths[0])
-        cv2.imwrite(output_images_paths[0], prev)
-
-        # Get image sizes
-        h, w, _ = prev.shape
-
-        # Initial Affine Transformation matrix.
-        M = np.eye(2, 3, dtype=np.float32)
-
         # Method for stabilization:
         logger.debug('Starting stabilizing images.')
 
-        for input_img_path, output_img_path in tqdm(
-                zip(input_images_paths[1:], output_images_paths[1:])):
-
-            # Compute previous image features.
-            prev_pts = cv2.goodFeaturesToTrack(prev_gray,
-                                               maxCorners=400,
-                                               qualityLevel=0.001,
-                                               minDistance=20,
-                                               blockSize=5,
-                                               useHarrisDetector=True)
-            # Upload new image at each step
-            curr, curr_gray = load_image_color_gray(input_img_path)
-
-            # Calculate optical flow (i.e. track feature points)
-            curr_pts, status, err = cv2.calcOpticalFlowPyrLK(
-                prev_gray, curr_gray, prev_pts, None)
-
-            # Sanity check
-            assert prev_pts.shape == curr_pts.shape
-
-            # Filter only valid points
-            idx = np.where(status == 1)[0]
-            prev_pts = prev_pts[idx]
-            curr_pts = curr_pts[idx]
-
-            # Estimate the transformation that is needed
-            M_iter, _ = cv2.estimateAffinePartial2D(prev_pts, curr_pts)
-            # Update global Affine transformation matrix
-            M[:2, :2] = np.dot(M[:2, :2], M_iter[:2, :2])
-            M[:, 2:] += M_iter[:, 2:]
-
-            # Stabilize image
-            img_stabilized = cv2.warpAffine(curr,
-                                            M, (w, h),
-                                            flags=cv2.WARP_INVERSE_MAP)
-
-            # Write stabilized image to new folder and update img to consider
-            cv2.imwrite(output_img_path, img_stabilized)
-            prev_gray = curr_gray
+        # The first image is the reference and it is saved as it is.
+        for _ in tqdm(stabilization.stabilize_images(input_images_paths,
+                                                     output_images_paths,
+                                                     args.scale, args.jobs,
+                                                     args.prefetch),
+                      total=len(input_images_paths)):
+            pass
 
         logger.debug('Finished stabilizing images.')
-
-
-def load_image_color_gray(img_path):
-    """Read an original image of the time-series as well as the
-    black-and-white version of this image.
-    """
-    img_color = cv2.imread(img_path, cv2.IMREAD_COLOR)
-    img_gray = cv2.cvtColor(img_color, cv2.COLOR_BGR2GRAY)
-    return img_color, img_gray
@@ -0,0 +1,206 @@
+"""Definition of all commands available in BaColonyzer."""
+
+import logging
+import os
+
+from bacolonyzer import utils
+from bacolonyzer.commands import abstract
+
+__all__ = ["SweepCommand"]
+
+logger = logging.getLogger(__name__)
+
+# Values of the on/off settings for each choice of the command line.
+_SWITCH = {"on": [True], "off": [False], "both": [False, True]}
+
+
+class SweepCommand(abstract.AbstractCommand):
+    _SUBCOMMAND = "sweep"
+    _DESCRIPTION = """\
+    Analyse a timeseries of QFA images with many combinations of settings
+    (fraction of the grid, segmentation, sensitivity and lighting correction)
+    at once, decoding each image only once, and save the outputs of all of
+    them in a single table to compare them.
+    """
+
+    def register_arguments(self, parser):
+        parser.add_argument(
+            "-d",
+            "--directory",
+            type=str,
+            help="""Directory in which to search for image files that need to be
+            analysed.
+            Default: current directory.""",
+            default=".",
+        )
+        parser.add_argument(
+            "-r",
+            "--reference_image",
+            type=str,
+            help="""Path to a reference image to calibrate the results (see
+            bacolonyzer analyse).
+            Default: No reference image is used.""",
+            default="",
+        )
+        parser.add_argument(
+            "-q",
+            "--quiet",
+            help="""Suppresses messages printed during the analysis.
+            Default: show messages.""",
+            action="store_true",
+        )
+        parser.add_argument(
+            "-g",
+            "--grid_format",
+            type=str,
+            nargs="+",
+            help="""Specifies rectangular grid format (e.g. -g 8x12 or
+            -g 8 12).
+            Default: 8x12.""",
+            default=["8x12"],
+        )
+        parser.add_argument(
+            "-f",
+            "--fractions",
+            type=utils.range_float,
+            nargs="+",
+            help="""Minimum fractions of the image that corresponds to the
+            grid to try.
+            Default: 0.8.""",
+            default=[0.8],
+        )
+        parser.add_argument(
+            "-l",
+            "--low_contrasts",
+            choices=sorted(_SWITCH),
+            help="""Whether to perform the adaptive segmentation for low
+            contrasts, not to perform it, or to try both.
+            Default: both.""",
+            default="both",
+        )
+        parser.add_argument(
+            "--sensitivities",
+            type=utils.range_float,
+            nargs="+",
+            help="""Dilatations of the spots to try, as fractions of the size
+            of a patch (see --sensitivity in bacolonyzer analyse).
+            Default: 0.05.""",
+            default=[0.05],
+        )
+        parser.add_argument(
+            "-c",
+            "--light_correction",
+            choices=sorted(_SWITCH),
+            help="""Whether to perform the lighting correction, not to
+            perform it, or to try both.
+            Default: both.""",
+            default="both",
+        )
+        parser.add_argument(
+            "-p",
+            "--grid_by_peaks",
+            help="""Use peak detection to locate the grid instead of template
+            matching.""",
+            action="store_true",
+        )
+        parser.add_argument(
+            "-s",
+            "--grid_search_scale",
+            type=utils.scale_float,
+            help="""Scale used to search the grid pattern in a downscaled image
+            before refining it at full resolution.
+            Default: 1. Search the pattern at full resolution only.""",
+            default=1.0,
+        )
+        parser.add_argument(
+            "--grid_threads",
+            type=utils.non_negative_int,
+            help="""Number of threads used to try the different sizes of the
+            grid pattern in parallel. Use 0 to use all the available cores.
+            Default: 1.""",
+            default=1,
+        )
+        parser.add_argument(
+            "--analysis_scale",
+            type=utils.scale_float,
+            help="""Scale of the images analysed (e.g. 0.5).
+            Default: 1. Analyse the images at full resolution.""",
+            default=1.0,
+        )
+        parser.add_argument(
+            "--low_memory",
+            help="""Analyse each image in single precision.
+            Default: False. Analyse the images in double precision.""",
+            action="store_true",
+        )
+        parser.add_argument(
+            "-e",
+            "--endpoint",
+            help="""Analyses only the final image in the series.
+            Default: False. Analyse all images in the directory.""",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--prefetch",
+            type=utils.non_negative_int,
+            help="""Number of images read in the background while another
+            image is analysed.
+            Default: 2.""",
+            default=2,
+        )
+        parser.add_argument(
+            "-o",
+            "--output",
+            type=str,
+            help="""Tab delimited file where the outputs of all the settings
+            are saved.
+            Default: Output_Data/sweep.tsv in the directory.""",
+            default=None,
+        )
+
+    def run(self, args):
+        from bacolonyzer import filesystem, sweep
+
+        # Setup logger
+        if args.quiet:
+            logging.basicConfig(format="%(message)s", level=logging.INFO)
+        else:
+            logging.basicConfig(format="%(message)s", level=logging.DEBUG)
+        filesystem.reference_info(args.reference_image)
+
+        # Get working directory.
+        fdir = filesystem.get_directory(args.directory)
+        nrow, ncol = utils.get_grid_format(args.grid_format)
+
+        # Create needed directories to save outputs.
+        filesystem.arrange_directories(fdir)
+        output = args.output or os.path.join(fdir, "Output_Data", "sweep.tsv")
+        # Obtain list of images to analyse.
+        imanalyse = filesystem.get_images(fdir, args.endpoint,
+                                          args.reference_image)
+
+        configs = sweep.configurations(args.fractions,
+                                       _SWITCH[args.low_contrasts],
+                                       args.sensitivities,
+                                       _SWITCH[args.light_correction])
+        logger.debug("Analysing %s images with %s configurations:",
+                     len(imanalyse), len(configs))
+        for number, config in enumerate(configs, 1):
+            logger.debug("  %s: %s", number, config)
+
+        # Perform main logic.
+        sweep.sweep_plate(
+            imanalyse,
+            nrow,
+            ncol,
+            output,
+            configs,
+            reference_image=args.reference_image,
+            grid_by_peaks=args.grid_by_peaks,
+            search_scale=args.grid_search_scale,
+            grid_threads=args.grid_threads,
+            analysis_scale=args.analysis_scale,
+            low_memory=args.low_memory,
+            prefetch=args.prefetch,
+        )
+        logger.info("Outputs of all the configurations saved in %s", output)
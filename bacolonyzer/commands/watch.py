@@ -0,0 +1,112 @@
+"""Definition of all commands available in BaColonyzer."""
+
+import logging
+import signal
+import threading
+
+from bacolonyzer import utils
+from bacolonyzer.commands import analyse
+
+__all__ = ["WatchCommand"]
+
+logger = logging.getLogger(__name__)
+
+
+class WatchCommand(analyse.AnalyseCommand):
+    _SUBCOMMAND = "watch"
+    _DESCRIPTION = """\
+    Watch a directory and analyse each new QFA image as soon as it has been
+    completely written (e.g. by a scanner). Images without up to date outputs
+    are analysed first. Stop it with Ctrl+C.
+    """
+
+    def register_arguments(self, parser):
+        parser.add_argument(
+            "-d",
+            "--directory",
+            type=str,
+            help="""Directory to watch for new image files.
+            Default: current directory.""",
+            default=".",
+        )
+        self.register_analysis_arguments(parser)
+        parser.add_argument(
+            "--interval",
+            type=float,
+            help="""Seconds between checks of the directory when inotify is
+            not available. Default: 1.""",
+            default=1.0,
+        )
+        parser.add_argument(
+            "--settle_time",
+            type=float,
+            help="""Seconds that the size of a new image must remain
+            unchanged to consider that it has been completely written.
+            Default: 2.""",
+            default=2.0,
+        )
+        parser.add_argument(
+            "--queue_size",
+            type=utils.positive_int,
+            help="""Maximum number of complete images waiting to be analysed.
+            Default: 8.""",
+            default=8,
+        )
+
+    def run(self, args):
+        from bacolonyzer import filesystem, watch
+
+        # Setup logger
+        if args.quiet:
+            logging.basicConfig(format="%(message)s", level=logging.INFO)
+        else:
+            logging.basicConfig(format="%(message)s", level=logging.DEBUG)
+
+        # Print information of inputs to users.
+        utils.summarise(args)
+        filesystem.reference_info(args.reference_image)
+
+        # Get working directory.
+        fdir = filesystem.get_directory(args.directory)
+        nrow, ncol = utils.get_grid_format(args.grid_format)
+
+        # Create needed directories to save outputs.
+        filesystem.arrange_directories(fdir)
+
+        # Stop cleanly when the user presses Ctrl+C or the process is killed.
+        stop_event = threading.Event()
+
+        def stop(signum, frame):
+            logger.info("Stopping after the images already written...")
+            stop_event.set()
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+
+        # Perform main logic.
+        watch.watch_plate(
+            fdir,
+            nrow,
+            ncol,
+            stop_event,
+            light_correction=args.light_correction_off,
+            fraction=args.fraction,
+            reference_image=args.reference_image,
+            low_contrasts=args.low_contrasts,
+            grid_by_peaks=args.grid_by_peaks,
+            search_scale=args.grid_search_scale,
+            grid_threads=args.grid_threads,
+            recompute_grid=args.recompute_grid,
+            crop_first=args.crop_first,
+            analysis_scale=args.analysis_scale,
+            low_memory=args.low_memory,
+            sensitivity=args.sensitivity,
+            integral_metrics=args.integral_metrics,
+            output_format=args.output_format,
+            mask_scale=args.mask_scale,
+            png_compression=args.png_compression,
+            write_queue=args.write_queue,
+            queue_size=args.queue_size,
+            interval=args.interval,
+            settle_time=args.settle_time,
+        )
@@ -1,10 +1,17 @@
 """Functions to prepare de directories and to obtain the files for analysis.
 """
 
+import collections
+import concurrent.futures
+import glob
+import json
 import logging
 import os
 
 import cv2
+import numpy as np
+from bacolonyzer import profiling
+from PIL import Image
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +42,21 @@ def get_directory(directory=None):
     return fdir
 
 
+def get_directories(patterns):
+    """Get the directories matching any of the given paths or glob patterns.
+    Output folders of BaColonyzer are never considered."""
+    directories = set()
+    for pattern in patterns:
+        for path in glob.glob(os.path.expanduser(pattern)):
+            if os.path.isdir(path) and os.path.basename(
+                    os.path.normpath(path)) not in {"Output_Images",
+                                                    "Output_Data"}:
+                directories.add(os.path.realpath(path))
+    if not directories:
+        raise ValueError("No directories found. Check --directories.")
+    return sorted(directories)
+
+
 def arrange_directories(directory):
     """Creates directories to save output files."""
     # Set directories to keep or create.
@@ -49,18 +71,20 @@ def arrange_directories(directory):
     logger.debug("Outputs will be saved in " + imdir + " & " + datdir)
 
 
-def get_all_images(directory):
-    """Returns an ordered list of images paths present in a given directory."""
+def is_image(file_name):
+    """Check if the file has any of the image formats that are considered."""
     # Set image formats that will be considered.
     image_formats = {".jpg", ".jpeg", ".tif", ".tiff", ".png"}
+    return os.path.splitext(file_name.lower())[1] in image_formats
+
+
+def get_all_images(directory):
+    """Returns an ordered list of images paths present in a given directory."""
     # Obtain all file names in the specified directory
     filenames = os.listdir(directory)
 
     # Take only the images from the directory (images have any image_formats)
-    allfiles = [
-        newfile for newfile in filenames
-        if os.path.splitext(newfile.lower())[1] in image_formats
-    ]
+    allfiles = [newfile for newfile in filenames if is_image(newfile)]
     allfiles.sort()
 
     all_file_names = [os.path.join(directory, p) for p in allfiles]
@@ -91,21 +115,188 @@ def get_images(directory, endpoint, reference_image):
     return imanalyse
 
 
+def read_gray(image_path, scale=1.0):
+    """Read an image in grayscale, downscaled by the given scale with area
+    interpolation. JPEG images are decoded directly at 1/2, 1/4 or 1/8 of
+    their size when the scale allows it, which is much faster."""
+    if scale == 1:
+        return cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    reduction, flag = 1, cv2.IMREAD_GRAYSCALE
+    if os.path.splitext(image_path.lower())[1] in {".jpg", ".jpeg"}:
+        for reduction, flag in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                                (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                                (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+                                (1, cv2.IMREAD_GRAYSCALE)):
+            if scale * reduction <= 1:
+                break
+    image = cv2.imread(image_path, flag)
+    if image is None or scale * reduction == 1:
+        return image
+    return cv2.resize(image, None, fx=scale * reduction, fy=scale * reduction,
+                      interpolation=cv2.INTER_AREA)
+
+
+def read_gray_region(image_path, box, scale=1.0):
+    """Read the region (left, top, right, bottom) of an image in grayscale,
+    downscaled as in `read_gray` (the region is given in the coordinates of
+    the downscaled image). The region is clipped to the size of the image.
+    Only the tiles or strips of 8-bit grayscale TIFF images that overlap the
+    region are decoded; other images are read completely and then cropped."""
+    left, top, right, bottom = box
+    if scale == 1 and os.path.splitext(image_path.lower())[1] in {".tif",
+                                                                  ".tiff"}:
+        with Image.open(image_path) as image:
+            # Images that OpenCV would convert or rotate are read as usual.
+            if (image.mode == "L" and len(image.tile) > 1
+                    and image.getexif().get(0x0112, 1) == 1):
+                image.tile = [
+                    tile for tile in image.tile
+                    if tile[1][0] < right and tile[1][2] > left
+                    and tile[1][1] < bottom and tile[1][3] > top
+                ]
+                image.load()
+                return np.array(np.asarray(image)[top:bottom, left:right])
+    return np.array(read_gray(image_path, scale)[top:bottom, left:right])
+
+
+def prefetch_images(images_paths, read_image=read_gray, prefetch=2):
+    """Iterate over tuples (image path, image) in the order of the paths.
+    While an image is processed, the next `prefetch` images are read by
+    background threads, so at most prefetch + 1 images are kept in memory.
+    If prefetch is 0, each image is read when it is needed."""
+    if not prefetch:
+        for image_path in images_paths:
+            yield image_path, read_image(image_path)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=prefetch) as executor:
+        pending = collections.deque()
+        for image_path in images_paths:
+            pending.append(
+                (image_path, executor.submit(read_image, image_path)))
+            if len(pending) > prefetch:
+                image_path, future = pending.popleft()
+                yield image_path, future.result()
+        while pending:
+            image_path, future = pending.popleft()
+            yield image_path, future.result()
+
+
 def get_file_name(image_path):
     """Get file names from given path removing extension and directories."""
     return os.path.basename(os.path.splitext(image_path)[0])
 
 
-def save_output(file_name, output_df, output_image, output_base_dir):
+def save_output(file_name, output_df, output_image, output_base_dir,
+                mask_scale=1.0, png_compression=None):
     """Saves output."""
 
     # Save DataFrame of output metrics.
-    output_df.to_csv(
-        os.path.join(output_base_dir, "Output_Data",
-                     "{}.out".format(file_name)),
-        sep="\t",
-        index=False)
+    with profiling.stage("write_data", file_name):
+        output_df.to_csv(
+            os.path.join(output_base_dir, "Output_Data",
+                         "{}.out".format(file_name)),
+            sep="\t",
+            index=False)
     # Save Image mask
-    img_outputs_dir = os.path.join(output_base_dir, "Output_Images",
-                                   "{}.png".format(file_name))
-    cv2.imwrite(img_outputs_dir, output_image)
+    if output_image is not None:
+        save_mask(file_name, output_image, output_base_dir, mask_scale,
+                  png_compression)
+
+
+def save_mask(file_name, output_image, output_base_dir, scale=1.0,
+              compression=None):
+    """Saves the mask of the spots for a visual check. The mask is
+    downscaled by the given scale (0 skips it), and the PNG compression
+    level (0-9) is the default of OpenCV if not given."""
+    if not scale:
+        return
+    with profiling.stage("write_png", file_name):
+        if scale != 1:
+            # Nearest neighbours keep the mask binary.
+            output_image = cv2.resize(output_image, None, fx=scale, fy=scale,
+                                      interpolation=cv2.INTER_NEAREST)
+        params = []
+        if compression is not None:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, compression]
+        img_outputs_dir = os.path.join(output_base_dir, "Output_Images",
+                                       "{}.png".format(file_name))
+        cv2.imwrite(img_outputs_dir, output_image, params)
+
+
+def load_grid_cache(output_base_dir, key):
+    """Load the grid saved by a previous analysis with the same key.
+    Returns a dictionary, or None if there is no such grid."""
+    path = os.path.join(output_base_dir, "Output_Data", "grid_cache.npz")
+    if not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path) as cache:
+            if str(cache["key"]) != key:
+                return None
+            return {name: cache[name] for name in cache.files if name != "key"}
+    except (OSError, ValueError, KeyError):
+        logger.debug("Ignoring unreadable grid cache %s", path)
+        return None
+
+
+def save_grid_cache(output_base_dir, key, grid):
+    """Saves the grid (a dictionary of arrays) to be reused by later analyses
+    with the same key."""
+    path = os.path.join(output_base_dir, "Output_Data", "grid_cache.npz")
+    # Write to a temporary file first so that the cache is never incomplete.
+    with open(path + ".tmp", "wb") as cache_file:
+        np.savez_compressed(cache_file, key=key, **grid)
+    os.replace(path + ".tmp", path)
+
+
+def output_is_newer(image_path, output_base_dir):
+    """Check if the output data of the image exists and is newer than it."""
+    output_path = os.path.join(output_base_dir, "Output_Data",
+                               "{}.out".format(get_file_name(image_path)))
+    return (os.path.isfile(output_path)
+            and os.path.getmtime(output_path) >= os.path.getmtime(image_path))
+
+
+def load_analysis_record(output_base_dir):
+    """Load the record of the image used to locate the grid and the analysis
+    (fingerprint) that produced each output of the directory."""
+    path = os.path.join(output_base_dir, "Output_Data", "analysis_record.json")
+    try:
+        with open(path) as record_file:
+            record = json.load(record_file)
+        if isinstance(record.get("outputs"), dict):
+            return record
+    except (OSError, ValueError):
+        pass
+    return {"grid_image": None, "outputs": {}}
+
+
+def save_analysis_record(output_base_dir, record):
+    """Saves the record of the analysis of the directory."""
+    path = os.path.join(output_base_dir, "Output_Data", "analysis_record.json")
+    with open(path + ".tmp", "w") as record_file:
+        json.dump(record, record_file, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def load_stabilization_record(output_base_dir):
+    """Load the image used as reference to stabilize the images of the
+    directory and the transform (2x3 matrix) of each image."""
+    path = os.path.join(output_base_dir, "Output_Data", "stabilization.json")
+    try:
+        with open(path) as record_file:
+            record = json.load(record_file)
+        if isinstance(record.get("transforms"), dict):
+            return record
+    except (OSError, ValueError):
+        pass
+    return {"reference": None, "transforms": {}}
+
+
+def save_stabilization_record(output_base_dir, record):
+    """Saves the transforms used to stabilize the images of the directory."""
+    path = os.path.join(output_base_dir, "Output_Data", "stabilization.json")
+    with open(path + ".tmp", "w") as record_file:
+        json.dump(record, record_file, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,123 @@
+"""Cache of the decoded grayscale images, to analyse the same images again
+(e.g. with other parameters) without decoding them.
+
+Each image is saved in its own .npy file, named after the content of the
+image file and the region and scale that were read, and it is loaded again
+as a read-only memory map. When the cache grows larger than its maximum
+size, the images that were used least recently are removed.
+"""
+
+import functools
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def open_cache(directory, max_size):
+    """Cache of the images in the given directory, with a maximum size in
+    bytes. The same cache is returned for the same arguments in each
+    process."""
+    return ImageCache(directory, max_size)
+
+
+class ImageCache:
+    """Decoded images saved in a directory, up to max_size bytes."""
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # Size of the cache, updated when this process saves an image. It is
+        # measured again before removing any image.
+        self._size = self._measure()[0]
+        # The cache may have been used with a larger maximum size.
+        if self._size > self.max_size:
+            self._evict()
+
+    def key(self, image_path, *geometry):
+        """Identify the image read from the content of the file with the
+        given geometry (e.g. the region read and the scale)."""
+        key = hashlib.sha256()
+        with open(image_path, "rb") as image_file:
+            for block in iter(lambda: image_file.read(1 << 20), b""):
+                key.update(block)
+        key.update(repr(geometry).encode())
+        return key.hexdigest()
+
+    def load(self, key):
+        """Load the image saved with the given key as a read-only memory map,
+        or None if it is not in the cache."""
+        path = self._path(key)
+        try:
+            image = np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        try:
+            # The modification time tells which images were used last.
+            os.utime(path)
+        except OSError:
+            pass
+        return image
+
+    def save(self, key, image):
+        """Save an image with the given key, and remove the images used
+        least recently if the cache is too large. Images larger than the
+        cache are not saved."""
+        if image is None:
+            return
+        if image.nbytes > self.max_size:
+            with self._lock:
+                if self._size > self.max_size:
+                    self._evict()
+            return
+        path = self._path(key)
+        # Each thread writes its own temporary file, so the cache never has
+        # incomplete images.
+        tmp_path = "{}.{}-{}.tmp".format(path, os.getpid(),
+                                         threading.get_ident())
+        with open(tmp_path, "wb") as cache_file:
+            np.save(cache_file, image)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._size += os.path.getsize(path)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def _measure(self):
+        """Return the size of the cache and its files (modification time,
+        size, path)."""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                try:
+                    stat = entry.stat()
+                except OSError:  # Removed by another process.
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return sum(size for _, size, _ in files), files
+
+    def _evict(self):
+        """Remove the images used least recently until the cache fits in its
+        maximum size."""
+        self._size, files = self._measure()
+        removed = 0
+        for _, size, path in sorted(files):
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:  # E.g. in use on Windows, or already removed.
+                continue
+            self._size -= size
+            removed += 1
+        logger.debug("Removed %s images from the image cache.", removed)
@@ -2,14 +2,19 @@
 calibrate the image colors according to a black and white reference picture.
 """
 
+import concurrent.futures
 import itertools
 import os
 
 import cv2
 import numpy as np
+from bacolonyzer import quantiles
 from scipy.signal import find_peaks
 from tqdm import tqdm
 
+# Default dilatation of the spots by `get_mask`, as a fraction of a patch.
+SENSITIVITY = 0.05
+
 
 def get_agar_spot_color(im):
     """Get the color value of the agar and the spots.
@@ -46,10 +51,16 @@ def get_agar_spot_color(im):
     return int(color_agar), int(color_spot)
 
 
-def get_position_grid(im, nrow, ncol, frac, grid_by_peaks=False, image_path=None):
+def get_position_grid(im, nrow, ncol, frac, grid_by_peaks=False, image_path=None,
+                      search_scale=1.0, threads=1):
     """Get the position of the grid in the image.
     Use an artificial pattern and the normalized squared difference to find it,
     or use peak detection if grid_by_peaks is True.
+    If search_scale < 1, the pattern is first searched in the image downscaled
+    by this factor, and then refined at full resolution around the best
+    candidates only. Values closer to 1 are more accurate but slower.
+    The different sizes of the pattern are tried by `threads` threads
+    (0 means one per core).
     Return the position of the grid and the size of the scaled the pattern.
     """
     # Find color values of agar and spots
@@ -119,36 +130,118 @@ def get_position_grid(im, nrow, ncol, frac, grid_by_peaks=False, image_path=None
 
     # Check for structure using iterations by increasing 0.2% of the image
     iterations = int((max_fraction - min_fraction) * 100 / 0.2)
+    fractions = np.linspace(min_fraction, max_fraction, iterations)
+    if search_scale < 1:
+        return _coarse_to_fine_search(im, pattern, nrow, ncol, fractions,
+                                      search_scale, threads)
+
     found = None
-    for fraction in tqdm(
-        np.linspace(min_fraction, max_fraction, iterations),
-        desc="Fitting grid pattern...",
-    ):
-        # Scale the pattern to the fraction of the given image.
-        pat_w = int(w * fraction)
-        pat_h = int(pat_w * nrow / ncol)
-        # Fix bug that might appear in images with special proportions
-        if pat_h > h:
-            pat_h = int(h * fraction)
-            pat_w = int(pat_h * ncol / nrow)
-        pattern_scaled = cv2.resize(pattern, (pat_w, pat_h))
-        # Match the scaled pattern with the image.
-        res = cv2.matchTemplate(im, pattern_scaled, cv2.TM_SQDIFF_NORMED)
-        # The function gives the map of squared difference, so optimal location
-        # will be the one with minimum value.
-        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
+    for match in _sweep_fractions(im, pattern, nrow, ncol, fractions, threads,
+                                  "Fitting grid pattern..."):
         # Store the info about the best scale where pattern fits the image.
-        if found is None or min_val < found[0]:
-            found = (min_val, min_loc, pat_h, pat_w)
+        if found is None or match[0] < found[0]:
+            found = match
+    return found
+
+
+def _sweep_fractions(im, pattern, nrow, ncol, fractions, threads, desc):
+    """Match the pattern scaled to each of the fractions of the image.
+    Return a list of (min_val, min_loc, pat_h, pat_w) in the same order as
+    the fractions. OpenCV releases the GIL, so threads run in parallel.
+    """
+    h, w = im.shape
+
+    def match(fraction):
+        pat_h, pat_w = _pattern_size(h, w, nrow, ncol, fraction)
+        return _match_pattern(im, pattern, pat_h, pat_w) + (pat_h, pat_w)
+
+    threads = threads or os.cpu_count()
+    if threads == 1:
+        return [match(fraction) for fraction in tqdm(fractions, desc=desc)]
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        return list(tqdm(executor.map(match, fractions), total=len(fractions),
+                         desc=desc))
+
+
+def _pattern_size(h, w, nrow, ncol, fraction):
+    """Size of the pattern scaled to the fraction of an image of size h, w."""
+    pat_w = int(w * fraction)
+    pat_h = int(pat_w * nrow / ncol)
+    # Fix bug that might appear in images with special proportions
+    if pat_h > h:
+        pat_h = int(h * fraction)
+        pat_w = int(pat_h * ncol / nrow)
+    return pat_h, pat_w
+
+
+def _match_pattern(im, pattern, pat_h, pat_w):
+    """Match the pattern scaled to pat_h, pat_w with the image.
+    Return the minimum normalized squared difference and its location."""
+    pattern_scaled = cv2.resize(pattern, (pat_w, pat_h))
+    res = cv2.matchTemplate(im, pattern_scaled, cv2.TM_SQDIFF_NORMED)
+    # The function gives the map of squared difference, so optimal location
+    # will be the one with minimum value.
+    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
+    return min_val, min_loc
+
+
+def _coarse_to_fine_search(im, pattern, nrow, ncol, fractions, scale,
+                           threads=1, candidates=3):
+    """Search the pattern in the image downscaled by `scale` for all the
+    fractions, and refine the best `candidates` at full resolution only for
+    the neighbouring fractions and in a small window around their location.
+    """
+    h, w = im.shape
+    small = cv2.resize(im, (max(1, int(round(w * scale))),
+                            max(1, int(round(h * scale)))),
+                       interpolation=cv2.INTER_AREA)
+
+    # Coarse search over all the fractions.
+    coarse = [
+        (min_val, k, min_loc) for k, (min_val, min_loc, _, _) in enumerate(
+            _sweep_fractions(small, pattern, nrow, ncol, fractions, threads,
+                             "Fitting grid pattern (coarse)..."))
+    ]
+
+    # Fractions that can't be told apart at the coarse resolution.
+    step = abs(fractions[1] - fractions[0]) * w if len(fractions) > 1 else w
+    window = max(2, int(np.ceil(2 / (scale * step))))
+
+    # Take the best candidates, with fractions far enough from each other.
+    chosen = []
+    for min_val, k, min_loc in sorted(coarse):
+        if all(abs(k - c[0]) > window for c in chosen):
+            chosen.append((k, min_loc))
+        if len(chosen) == candidates:
+            break
+
+    found = None
+    for k, (s_x, s_y) in chosen:
+        for fraction in fractions[max(0, k - window):k + window + 1]:
+            pat_h, pat_w = _pattern_size(h, w, nrow, ncol, fraction)
+            # The coarse location may be one spot away when spots are only a
+            # few pixels wide, so the window also includes a whole spot.
+            margin = int(np.ceil(2 / scale)) + 2 + int(pat_w / ncol)
+            # Window of the image around the coarse location.
+            x0 = min(max(0, int(round(s_x / scale)) - margin), w - pat_w)
+            y0 = min(max(0, int(round(s_y / scale)) - margin), h - pat_h)
+            x1 = min(w, x0 + pat_w + 2 * margin)
+            y1 = min(h, y0 + pat_h + 2 * margin)
+            min_val, min_loc = _match_pattern(im[y0:y1, x0:x1], pattern,
+                                              pat_h, pat_w)
+            min_loc = (min_loc[0] + x0, min_loc[1] + y0)
+            if found is None or min_val < found[0]:
+                found = (min_val, min_loc, pat_h, pat_w)
     return found
 
 
-def get_mask(original_mask, nrow, ncol, sensitivity=0.05):
+def get_mask(original_mask, nrow, ncol, sensitivity=SENSITIVITY):
     """Perform dilatation of the spots (and therefore reduction of the agar)."""
     # Calculate patch size x,y
     d_y = original_mask.shape[0] / nrow
     d_x = original_mask.shape[1] / ncol
-    # Perform dilatation increasing the thickness by 5% of a patch size
+    # Perform dilatation increasing the thickness by a fraction of a patch
+    # size (5% by default)
     kernel = np.ones((int(d_y * sensitivity), int(d_x * sensitivity)), np.uint8)
     mymask = ~(cv2.dilate(~original_mask, kernel, iterations=1))
     return mymask
@@ -165,7 +258,7 @@ def calibration_maxmin(ref_img):
         reference_image = cv2.imread(ref_img, cv2.IMREAD_GRAYSCALE)
 
         # # Take 1% and 99% quantiles of the reference image to remove noise
-        quants = np.quantile(reference_image.ravel(), [0.01, 0.99])
+        quants = quantiles.image_quantiles(reference_image, [0.01, 0.99])
         reference_image = np.clip(reference_image, *quants)
 
         min_ref = reference_image.min()
@@ -0,0 +1,355 @@
+"""Stores that save the output data of the analysis of each image: one tab
+delimited file per image (default), or a single columnar file per plate.
+"""
+
+import importlib.util
+import logging
+import os
+import queue
+import re
+import threading
+
+import pandas as pd
+from bacolonyzer import filesystem, profiling, utils
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # pyarrow is only needed for Parquet and Feather outputs.
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = utils.OUTPUT_FORMATS
+
+
+def open_store(output_base_dir, output_format="tsv", mask_scale=1.0,
+               png_compression=None, write_queue=0):
+    """Open the store of the outputs of a plate for the given format (see
+    `store_class`). Masks are saved as in `filesystem.save_mask`. If
+    write_queue > 0, outputs are saved in the background, with at most
+    write_queue of them waiting.
+    """
+    store = store_class(output_format)(output_base_dir, mask_scale,
+                                       png_compression)
+    if write_queue:
+        store = BackgroundStore(store, write_queue)
+    return store
+
+
+def store_class(output_format):
+    """Class of the store of the given output format. "columnar" uses Parquet
+    if pyarrow is installed, and HDF5 otherwise. Raise a ValueError if the
+    format is unknown or the package it needs is not installed, so that it
+    can be checked before the analysis starts."""
+    if output_format == "columnar":
+        output_format = "parquet" if pyarrow is not None else "hdf5"
+    stores = {
+        "tsv": TsvStore,
+        "parquet": ParquetStore,
+        "feather": FeatherStore,
+        "hdf5": Hdf5Store,
+    }
+    if output_format not in stores:
+        raise ValueError("Unknown output format: {}.".format(output_format))
+    if output_format in ("parquet", "feather") and pyarrow is None:
+        raise ValueError(
+            "pyarrow is needed to save {} outputs. Install it or use "
+            "--output_format hdf5.".format(output_format))
+    if output_format == "hdf5" and importlib.util.find_spec("tables") is None:
+        raise ValueError(
+            "PyTables (tables) is needed to save hdf5 outputs. Install it or "
+            "use --output_format tsv.")
+    return stores[output_format]
+
+
+def get_timepoint(file_name):
+    """Get the date and time of an image from its name, as given by
+    `bacolonyzer rename_images` (..._YYYY-MM-DD_hh-mm-ss). NaT if missing."""
+    date_time = re.search(r"\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}", file_name)
+    if date_time is None:
+        return pd.NaT
+    return pd.to_datetime(date_time.group(), format="%Y-%m-%d_%H-%M-%S")
+
+
+class TsvStore:
+    """Saves the outputs of each image in its own tab delimited file."""
+
+    def __init__(self, output_base_dir, mask_scale=1.0, png_compression=None):
+        self.output_base_dir = output_base_dir
+        self.mask_scale = mask_scale
+        self.png_compression = png_compression
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, file_name, output_df, mask=None, on_saved=None):
+        """Save the outputs and the mask (if given) of an image. on_saved (if
+        given) is called with the file name once the outputs are saved."""
+        filesystem.save_output(filesystem.get_file_name(file_name), output_df,
+                               mask, self.output_base_dir, self.mask_scale,
+                               self.png_compression)
+        if on_saved is not None:
+            on_saved(file_name)
+
+    def is_up_to_date(self, file_name):
+        """Check if the outputs of the image exist and are newer than it."""
+        return filesystem.output_is_newer(file_name, self.output_base_dir)
+
+    def read(self):
+        """Iterate over the saved outputs as data-frames."""
+        data_dir = os.path.join(self.output_base_dir, "Output_Data")
+        for name in sorted(os.listdir(data_dir)):
+            if name.endswith(".out"):
+                # Values are parsed exactly as they were written.
+                yield pd.read_csv(os.path.join(data_dir, name), sep="\t",
+                                  dtype={"Barcode": str, "Filename": str},
+                                  float_precision="round_trip")
+
+    def close(self):
+        pass
+
+
+class ColumnarStore(TsvStore):
+    """Appends the outputs of all the images of a plate, with a Timepoint
+    column, to a single columnar file in Output_Data.
+
+    Outputs are written in chunks (e.g. row groups) to a temporary file while
+    the analysis proceeds. On closing, the outputs of the previous file for
+    images that were not analysed again are added, and the temporary file
+    replaces the previous one. The outputs of an image are only saved then.
+    """
+
+    _EXTENSION = None
+
+    def __init__(self, output_base_dir, mask_scale=1.0, png_compression=None):
+        super().__init__(output_base_dir, mask_scale, png_compression)
+        plate_name = os.path.basename(os.path.normpath(output_base_dir))
+        self.path = os.path.join(output_base_dir, "Output_Data",
+                                 plate_name + self._EXTENSION)
+        self._writer = None
+        self._written = set()
+        # Callbacks of the outputs written to the temporary file.
+        self._on_saved = []
+        # Images that have outputs in the previous file.
+        self._saved = set()
+        if os.path.isfile(self.path):
+            self._saved = set(self._read_file_names(self.path))
+
+    def write(self, file_name, output_df, mask=None, on_saved=None):
+        base_name = filesystem.get_file_name(file_name)
+        output_df = output_df.assign(Timepoint=get_timepoint(base_name))
+        with profiling.stage("write_data", base_name):
+            if self._writer is None:
+                self._writer = self._open_writer(self.path + ".tmp", output_df)
+            self._write(output_df)
+        self._written.update(output_df["Filename"].unique())
+        if mask is not None:
+            filesystem.save_mask(base_name, mask, self.output_base_dir,
+                                 self.mask_scale, self.png_compression)
+        if on_saved is not None:
+            self._on_saved.append((on_saved, file_name))
+
+    def is_up_to_date(self, file_name):
+        return (filesystem.get_file_name(file_name) in self._saved
+                and os.path.getmtime(self.path) >= os.path.getmtime(file_name))
+
+    def read(self):
+        if os.path.isfile(self.path):
+            for output_df in self._read_file(self.path):
+                yield output_df
+
+    def close(self):
+        if self._writer is None:
+            return
+        # Keep the outputs of images that were not analysed again.
+        if self._saved - self._written:
+            for output_df in self._read_file(self.path):
+                output_df = output_df[~output_df["Filename"].isin(
+                    self._written)]
+                if len(output_df):
+                    self._write(output_df)
+        self._close_writer()
+        self._writer = None
+        os.replace(self.path + ".tmp", self.path)
+        self._saved |= self._written
+        self._written = set()
+        on_saved, self._on_saved = self._on_saved, []
+        for callback, file_name in on_saved:
+            callback(file_name)
+
+    def _read_file_names(self, path):
+        for output_df in self._read_file(path):
+            for file_name in output_df["Filename"].unique():
+                yield file_name
+
+
+class ParquetStore(ColumnarStore):
+    """Saves all outputs of a plate in a Parquet file, a row group per
+    image."""
+
+    _EXTENSION = ".parquet"
+
+    def _open_writer(self, path, output_df):
+        self._schema = pyarrow.Schema.from_pandas(output_df,
+                                                  preserve_index=False)
+        return pyarrow.parquet.ParquetWriter(path, self._schema)
+
+    def _write(self, output_df):
+        self._writer.write_table(pyarrow.Table.from_pandas(
+            output_df, schema=self._schema, preserve_index=False))
+
+    def _close_writer(self):
+        self._writer.close()
+
+    def _read_file(self, path):
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        for i in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(i).to_pandas()
+
+    def _read_file_names(self, path):
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        for i in range(parquet_file.num_row_groups):
+            column = parquet_file.read_row_group(i, columns=["Filename"])
+            for file_name in column.column(0).unique().to_pylist():
+                yield file_name
+
+
+class FeatherStore(ParquetStore):
+    """Saves all outputs of a plate in a Feather (Arrow IPC) file, a record
+    batch per image."""
+
+    _EXTENSION = ".feather"
+
+    def _open_writer(self, path, output_df):
+        self._schema = pyarrow.Schema.from_pandas(output_df,
+                                                  preserve_index=False)
+        self._sink = pyarrow.OSFile(path, "wb")
+        return pyarrow.ipc.new_file(self._sink, self._schema)
+
+    def _close_writer(self):
+        self._writer.close()
+        self._sink.close()
+
+    def _read_file(self, path):
+        with pyarrow.memory_map(path) as source:
+            reader = pyarrow.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i).to_pandas()
+
+    _read_file_names = ColumnarStore._read_file_names
+
+
+class Hdf5Store(ColumnarStore):
+    """Saves all outputs of a plate in a HDF5 table (requires PyTables)."""
+
+    _EXTENSION = ".h5"
+    # Maximum length of the texts saved in the table.
+    _TEXT_SIZE = {"Barcode": 128, "Filename": 256}
+
+    def _open_writer(self, path, output_df):
+        return pd.HDFStore(path, mode="w")
+
+    def _write(self, output_df):
+        self._writer.append("outputs", output_df, format="table", index=False,
+                            min_itemsize=self._TEXT_SIZE)
+
+    def _close_writer(self):
+        self._writer.close()
+
+    def _read_file(self, path):
+        with pd.HDFStore(path, mode="r") as hdf:
+            for output_df in hdf.select("outputs", chunksize=100000):
+                yield output_df.reset_index(drop=True)
+
+
+class BackgroundStore:
+    """Saves the outputs of another store in a background thread, so that
+    writing them overlaps with the analysis of the next images.
+
+    At most queue_size outputs wait to be saved: `write` blocks when the
+    queue is full. Closing the store saves all the outputs in the queue
+    before closing the other store, and raises the first error found while
+    saving them (later outputs are not saved after an error, and their
+    on_saved callbacks are not called).
+    """
+
+    def __init__(self, store, queue_size=4):
+        self.store = store
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._failed = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, file_name, output_df, mask=None, on_saved=None):
+        """Queue the outputs and the mask (if given) of an image. on_saved is
+        called from the background thread once they are saved."""
+        self._raise_error()
+        self._queue.put((file_name, output_df, mask, on_saved))
+
+    def is_up_to_date(self, file_name):
+        # Only called before writing, so the other store is not in use.
+        return self.store.is_up_to_date(file_name)
+
+    def read(self):
+        return self.store.read()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            self._raise_error()
+        finally:
+            self.store.close()
+
+    def _run(self):
+        while True:
+            outputs = self._queue.get()
+            if outputs is None:
+                return
+            if self._failed:
+                logger.error("Outputs of %s not saved after a previous error.",
+                             outputs[0])
+                continue
+            try:
+                self.store.write(*outputs)
+            except Exception as error:
+                logger.error("Saving outputs of %s failed: %s", outputs[0],
+                             error)
+                self._error = error
+                self._failed = True
+
+    def _raise_error(self):
+        """Raise the error found while saving outputs, only once."""
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+def convert_outputs(output_base_dir, from_format, to_format):
+    """Convert the outputs of a plate from one format to another.
+    Masks of the spots are not modified."""
+    store_class(to_format)
+    source = open_store(output_base_dir, from_format)
+    with open_store(output_base_dir, to_format) as target:
+        for output_df in source.read():
+            # The Timepoint is added again by columnar stores.
+            output_df = output_df.drop(columns="Timepoint", errors="ignore")
+            for file_name, image_df in output_df.groupby("Filename",
+                                                         sort=False):
+                target.write(file_name, image_df.reset_index(drop=True))
@@ -0,0 +1,150 @@
+"""Timing of the stages of the analysis of each image, to find out why the
+analysis of a plate is slow. Stages are only timed after calling `enable`.
+"""
+
+import contextlib
+import cProfile
+import logging
+import os
+import threading
+import time
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Stages timed for each image, in the order they happen.
+STAGES = [
+    "decode", "stabilize", "blur", "threshold", "mask", "normalize", "measure",
+    "dataframe", "write_data", "write_png"
+]
+# Key of the timings of the stages of the plate (find_grid, calibration).
+PLATE = ""
+
+_enabled = False
+_lock = threading.Lock()
+# Seconds spent in each stage, per image (or PLATE).
+_timings = {}
+
+
+def enable(enabled=True):
+    """Start (or stop) timing the stages in this process."""
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Forget the timings recorded so far."""
+    with _lock:
+        _timings.clear()
+
+
+@contextlib.contextmanager
+def stage(name, file_name=PLATE):
+    """Time the code run inside the context as the given stage of the image
+    (or of the plate). Nothing is done if timing is not enabled."""
+    if not _enabled:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add({name: time.perf_counter() - start_time}, file_name)
+
+
+def add(timings, file_name=PLATE):
+    """Add the seconds spent in each stage (a dictionary) of an image, e.g.
+    the timings recorded by a worker process."""
+    if not timings:
+        return
+    key = _key(file_name)
+    with _lock:
+        image_timings = _timings.setdefault(key, {})
+        for name, seconds in timings.items():
+            image_timings[name] = image_timings.get(name, 0) + seconds
+
+
+def pop(file_name):
+    """Remove and return the timings of an image (empty if none)."""
+    with _lock:
+        return _timings.pop(_key(file_name), {})
+
+
+def _key(file_name):
+    # Stages of an image are timed with its path or its name without
+    # extension, depending on the function.
+    return os.path.basename(os.path.splitext(file_name)[0])
+
+
+def timing_tables():
+    """Return the seconds spent in each stage by each image (one row per
+    image, with the total), and a summary of each stage with percentiles
+    across images. Stages of the plate are added to the summary."""
+    with _lock:
+        timings = {key: dict(value) for key, value in _timings.items()}
+    plate = timings.pop(PLATE, {})
+
+    images = pd.DataFrame.from_dict(timings, orient="index")
+    images = images.reindex(
+        columns=[s for s in STAGES if s in images.columns] +
+        [s for s in images.columns if s not in STAGES]).fillna(0)
+    images.index.name = "Filename"
+    images = images.sort_index()
+    images["total"] = images.sum(axis=1)
+
+    summary = images.describe(percentiles=[0.5, 0.9, 0.99]).T
+    summary.insert(1, "sum", images.sum())
+    summary = summary.drop(columns="std")
+    summary.index.name = "stage"
+    for name, seconds in plate.items():
+        summary.loc[name] = {column: seconds for column in summary.columns}
+        summary.loc[name, "count"] = 1
+    summary["count"] = summary["count"].astype(int)
+    return images, summary
+
+
+def save(output_base_dir):
+    """Save the timing tables in Output_Data (profile_images.tsv and
+    profile_summary.tsv), and log the stages that took longest."""
+    if not _timings:
+        logger.info("No stages were timed.")
+        return
+    images, summary = timing_tables()
+    data_dir = os.path.join(output_base_dir, "Output_Data")
+    images.to_csv(os.path.join(data_dir, "profile_images.tsv"), sep="\t",
+                  float_format="%.6f")
+    summary.to_csv(os.path.join(data_dir, "profile_summary.tsv"), sep="\t",
+                   float_format="%.6f")
+
+    stages = summary.drop(index="total", errors="ignore")
+    total = stages["sum"].sum()
+    logger.info("Time spent in each stage (saved in %s):", data_dir)
+    for name, row in stages.sort_values("sum", ascending=False).iterrows():
+        logger.info("  {:<12} {:8.2f} s ({:4.1f}%), median {:.4f} s".format(
+            name, row["sum"], 100 * row["sum"] / total if total else 0,
+            row["50%"]))
+
+
+@contextlib.contextmanager
+def cprofile(path=None):
+    """Profile the code run inside the context with cProfile and save the
+    statistics in the given path. Only the calling thread is profiled: images
+    read in the background and worker processes are not included.
+    Nothing is done if no path is given."""
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        logger.info("Profile saved in %s. Inspect it with: "
+                    "python -m pstats %s", path, path)
@@ -0,0 +1,125 @@
+"""Quantiles of 8-bit images computed from their histograms of 256 levels,
+which is much faster than sorting (or partitioning) the pixels.
+
+The value of each level can be given by a lookup table, e.g. the normalized
+intensity of each gray level, to get the quantiles of the values of the
+pixels instead of their levels.
+"""
+
+import cv2
+import numpy as np
+
+# Number of levels of 8-bit images.
+_LEVELS = 256
+
+# Number of pixels whose histograms are computed together.
+_CHUNK_PIXELS = 1 << 18
+
+
+def image_quantiles(im, q, levels=None, precise=True):
+    """Quantiles q of all the pixels of an 8-bit image, as
+    `np.quantile(levels[im], q)` (see `histogram_quantiles`)."""
+    pixels = np.asarray(im).ravel()
+    counts = np.zeros(_LEVELS, dtype=np.intp)
+    # Pixels are converted to wider integers by np.bincount a few at a time.
+    for start in range(0, len(pixels), _CHUNK_PIXELS):
+        counts += np.bincount(pixels[start:start + _CHUNK_PIXELS],
+                              minlength=_LEVELS)
+    return histogram_quantiles(counts[np.newaxis], q, levels, precise)[:, 0]
+
+
+def image_histogram(im):
+    """Histogram of the 256 levels of a 2-D 8-bit image, computed by OpenCV
+    a few rows at a time so that its counts (in single precision) are exact.
+    """
+    counts = np.zeros(_LEVELS, dtype=np.intp)
+    step = max(_CHUNK_PIXELS // max(im.shape[1], 1), 1)
+    for start in range(0, im.shape[0], step):
+        chunk = cv2.calcHist([im[start:start + step]], [0], None, [_LEVELS],
+                             [0, _LEVELS])
+        counts += chunk.ravel().astype(np.intp)
+    return counts
+
+
+def block_quantiles(blocks, q, levels=None, valid=None, precise=True):
+    """Quantiles q over the last axis of 8-bit blocks of pixels (e.g. the
+    patches of a grid), as `np.quantile(levels[blocks], q, axis=-1,
+    keepdims=True)`. If given, only the pixels where `valid` is True are
+    considered, as `np.nanquantile` does with missing values.
+    The histograms of many blocks are computed together with a single
+    `np.bincount`. Return an array of shape (len(q), ..., 1).
+    """
+    blocks = np.asarray(blocks)
+    lead = blocks.shape[:-1]
+    n_blocks = int(np.prod(lead))
+    blocks = blocks.reshape(n_blocks, -1)
+    if valid is not None:
+        valid = np.asarray(valid).reshape(n_blocks, -1)
+    counts = np.empty((n_blocks, _LEVELS), dtype=np.intp)
+    # np.bincount needs the levels as wider integers: they are converted for
+    # a few blocks at a time, so that the memory needed stays small.
+    step = max(_CHUNK_PIXELS // max(blocks.shape[1], 1), 1)
+    offsets = np.arange(step)[:, np.newaxis] * (_LEVELS + 1)
+    for start in range(0, n_blocks, step):
+        codes = blocks[start:start + step].astype(np.intp)
+        if valid is not None:
+            # Pixels that are not valid are counted in an extra level.
+            codes[~valid[start:start + step]] = _LEVELS
+        codes += offsets[:len(codes)]
+        chunk = np.bincount(codes.ravel(),
+                            minlength=len(codes) * (_LEVELS + 1))
+        chunk = chunk.reshape(-1, _LEVELS + 1)
+        counts[start:start + step] = chunk[:, :_LEVELS]
+    result = histogram_quantiles(counts, q, levels, precise)
+    return result.reshape((len(result), ) + lead + (1, ))
+
+
+def histogram_quantiles(counts, q, levels=None, precise=True):
+    """Quantiles q of the values given by the histograms `counts` of shape
+    (histograms, 256), where the value of each level is given by `levels`
+    (by default, the level itself). Return an array of shape
+    (len(q), histograms), NaN for empty histograms.
+
+    If precise is True, quantiles are interpolated linearly between the two
+    closest values, exactly as `np.quantile` does by default. Otherwise, the
+    lower of these values is taken, as `np.quantile(..., method="lower")`.
+    """
+    if levels is None:
+        values = np.arange(_LEVELS, dtype=np.float64)
+    else:
+        # Levels are sorted by their value, which can be in any order.
+        levels = np.asarray(levels)
+        order = np.argsort(levels, kind="stable")
+        values, counts = levels[order], counts[:, order]
+    cumulative = np.cumsum(counts, axis=1)
+    n = cumulative[:, -1]
+    q = np.asarray(q, dtype=np.float64)
+
+    # Position of each quantile in the sorted values of each histogram.
+    virtual = (n - 1)[np.newaxis] * q[:, np.newaxis]
+    previous = np.floor(virtual)
+    lower = np.clip(previous, 0, n - 1).astype(np.intp)
+    upper = np.clip(previous + 1, 0, n - 1).astype(np.intp)
+
+    def value(rank):
+        # The value of a rank is that of the first level whose cumulative
+        # count is larger than it.
+        index = np.sum(cumulative[np.newaxis] <= rank[..., np.newaxis],
+                       axis=-1)
+        return values[np.minimum(index, _LEVELS - 1)]
+
+    below = value(lower)
+    if precise:
+        above = value(upper)
+        # Linear interpolation as np.quantile, which is more accurate
+        # starting from the closest value.
+        gamma = virtual - previous
+        diff = above - below
+        result = np.where(gamma >= 0.5, above - diff * (1 - gamma),
+                          below + diff * gamma)
+    else:
+        result = np.array(below, dtype=np.float64)
+    result = result.astype(values.dtype if values.dtype.kind == "f" else
+                           np.float64)
+    result[:, n == 0] = np.nan
+    return result
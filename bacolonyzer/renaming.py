@@ -0,0 +1,237 @@
+"""Functions to rename the images of a directory after the date and time they
+were taken, as a batch that can be audited and reverted with a manifest.
+"""
+
+import collections
+import concurrent.futures
+import csv
+import datetime
+import os
+import struct
+
+# EXIF tags: pointer to the EXIF sub-IFD and date and time of the original.
+_EXIF_IFD = 0x8769
+_DATE_TIME_ORIGINAL = 0x9003
+
+_MANIFEST_COLUMNS = ["old_name", "new_name", "timestamp"]
+
+
+def read_timestamp(file_path):
+    """Date and time the image was taken (EXIF DateTimeOriginal), or None if
+    it is missing. Only the header of JPEG and TIFF images is read; other
+    formats are opened with Pillow."""
+    extension = os.path.splitext(file_path.lower())[1]
+    try:
+        with open(file_path, "rb") as image_file:
+            if extension in {".jpg", ".jpeg"}:
+                value = _jpeg_date_time(image_file)
+            elif extension in {".tif", ".tiff"}:
+                value = _tiff_date_time(image_file, 0)
+            else:
+                value = _pillow_date_time(image_file)
+        if value is None:
+            return None
+        return datetime.datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def read_timestamps(file_paths, threads=8):
+    """Read the timestamps of many images in parallel (see `read_timestamp`).
+    Reading the headers is limited by the disk or network, not the CPU."""
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads or None) as executor:
+        return list(executor.map(read_timestamp, file_paths))
+
+
+def _jpeg_date_time(image_file):
+    """Find the EXIF segment (APP1) of a JPEG file, reading only the headers
+    of the segments before the image data."""
+    if image_file.read(2) != b"\xff\xd8":
+        raise ValueError("Not a JPEG file.")
+    while True:
+        marker = image_file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise ValueError("Corrupted JPEG file.")
+        # Start of the image data, or end of the image: there is no EXIF.
+        if marker[1] in {0xDA, 0xD9}:
+            return None
+        length, = struct.unpack(">H", image_file.read(2))
+        if marker[1] == 0xE1:
+            segment = image_file.read(length - 2)
+            if segment.startswith(b"Exif\x00\x00"):
+                return _tiff_date_time(_BytesReader(segment), 6)
+        else:
+            image_file.seek(length - 2, os.SEEK_CUR)
+
+
+class _BytesReader:
+    """Minimal file-like view of bytes, to parse an EXIF segment as a file."""
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def seek(self, position):
+        self.position = position
+
+    def read(self, size):
+        data = self.data[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+
+def _tiff_date_time(tiff_file, start):
+    """Read DateTimeOriginal from the TIFF structure that starts at the given
+    position of the file (offsets are relative to it)."""
+    tiff_file.seek(start)
+    header = tiff_file.read(8)
+    byte_order = {b"II": "<", b"MM": ">"}.get(header[:2])
+    if byte_order is None:
+        raise ValueError("Not a TIFF structure.")
+    ifd0, = struct.unpack(byte_order + "I", header[4:8])
+    exif_ifd = _ifd_entries(tiff_file, start, ifd0, byte_order).get(_EXIF_IFD)
+    if exif_ifd is None:
+        return None
+    offset, = struct.unpack(byte_order + "I", exif_ifd[2])
+    entry = _ifd_entries(tiff_file, start, offset,
+                         byte_order).get(_DATE_TIME_ORIGINAL)
+    if entry is None:
+        return None
+    _, count, value = entry
+    if count > 4:
+        offset, = struct.unpack(byte_order + "I", value)
+        tiff_file.seek(start + offset)
+        value = tiff_file.read(count)
+    return value[:count].split(b"\x00")[0].decode("ascii")
+
+
+def _ifd_entries(tiff_file, start, offset, byte_order):
+    """Entries of an IFD as a dictionary: tag -> (type, count, raw value)."""
+    tiff_file.seek(start + offset)
+    count, = struct.unpack(byte_order + "H", tiff_file.read(2))
+    data = tiff_file.read(12 * count)
+    entries = {}
+    for i in range(count):
+        tag, kind, n = struct.unpack(byte_order + "HHI",
+                                     data[12 * i:12 * i + 8])
+        entries[tag] = (kind, n, data[12 * i + 8:12 * i + 12])
+    return entries
+
+
+def _pillow_date_time(image_file):
+    from PIL import Image
+
+    with Image.open(image_file) as image:
+        return image.getexif().get_ifd(_EXIF_IFD).get(_DATE_TIME_ORIGINAL)
+
+
+def plan_renames(file_paths, new_names):
+    """Pair each file with its new name (in the same directory) and check the
+    batch with `check_renames`. Return a list of tuples (old path, new path).
+    """
+    return check_renames([(path, os.path.join(os.path.dirname(path), name))
+                          for path, name in zip(file_paths, new_names)])
+
+
+def check_renames(plan):
+    """Check a batch of renames (old path, new path) before renaming anything.
+    Raise RuntimeError if a file is missing, if two files would get the same
+    name, or if a file would replace one that is not renamed.
+    Return the renames of the files whose name changes."""
+    missing = sorted(old for old, _ in plan if not os.path.isfile(old))
+    targets = collections.Counter(os.path.normcase(os.path.abspath(new))
+                                  for _, new in plan)
+    sources = {os.path.normcase(os.path.abspath(old)) for old, _ in plan}
+    duplicates = sorted(
+        new for _, new in plan
+        if targets[os.path.normcase(os.path.abspath(new))] > 1)
+    existing = sorted(
+        new for _, new in plan
+        if os.path.normcase(os.path.abspath(new)) not in sources
+        and os.path.exists(new))
+    if missing or duplicates or existing:
+        message = ["Nothing was renamed."]
+        if missing:
+            message.append("These files don't exist: {}".format(
+                ", ".join(missing)))
+        if duplicates:
+            message.append("Several files would be renamed to: {}".format(
+                ", ".join(sorted(set(duplicates)))))
+        if existing:
+            message.append("These files already exist: {}".format(
+                ", ".join(existing)))
+        raise RuntimeError("\n".join(message))
+    # Files that keep their name are not renamed.
+    return [(old, new) for old, new in plan
+            if os.path.abspath(old) != os.path.abspath(new)]
+
+
+def apply_renames(plan):
+    """Rename the files as planned by `check_renames`. If some files are
+    renamed to the old name of another file of the batch, all of them are
+    first given temporary names."""
+    sources = {os.path.abspath(old) for old, _ in plan}
+    if any(os.path.abspath(new) in sources for _, new in plan):
+        temporary = [(old, "{}.renaming{}".format(old, i))
+                     for i, (old, _) in enumerate(plan)]
+        for old, tmp in temporary:
+            os.rename(old, tmp)
+        plan = [(tmp, new) for (_, tmp), (_, new) in zip(temporary, plan)]
+    for old, new in plan:
+        os.rename(old, new)
+
+
+def new_manifest_path(directory, now=None):
+    """Path of a new manifest in the directory, named after the date and time
+    (now, if not given). A number is added to the name if a manifest of the
+    same second already exists, e.g. when a renaming is reverted at once."""
+    now = now or datetime.datetime.now()
+    base = os.path.join(
+        directory,
+        "rename_manifest_{}".format(now.strftime("%Y-%m-%d_%H-%M-%S")))
+    manifest_path = base + ".tsv"
+    number = 1
+    while os.path.exists(manifest_path):
+        number += 1
+        manifest_path = "{}_{}.tsv".format(base, number)
+    return manifest_path
+
+
+def save_manifest(manifest_path, plan, timestamps=None):
+    """Save the planned renaming as a tab delimited file with the old and new
+    names (relative to the directory of the manifest) and the timestamp of
+    each file (a dictionary old path -> datetime, if given), to audit the
+    renaming or to revert it with `read_manifest`.
+    Raise RuntimeError if the manifest already exists: it is never replaced,
+    so that every renaming can still be reverted."""
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    timestamps = timestamps or {}
+    try:
+        manifest_file = open(manifest_path, "x", newline="")
+    except FileExistsError:
+        raise RuntimeError("Nothing was renamed. The manifest already "
+                           "exists: {}".format(manifest_path))
+    with manifest_file:
+        writer = csv.writer(manifest_file, delimiter="\t")
+        writer.writerow(_MANIFEST_COLUMNS)
+        for old, new in plan:
+            timestamp = timestamps.get(old)
+            writer.writerow([
+                os.path.relpath(old, directory),
+                os.path.relpath(new, directory),
+                timestamp.isoformat() if timestamp else ""
+            ])
+
+
+def read_manifest(manifest_path):
+    """Read a manifest saved by `save_manifest`.
+    Return a list of tuples (old path, new path)."""
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, newline="") as manifest_file:
+        reader = csv.DictReader(manifest_file, delimiter="\t")
+        if reader.fieldnames != _MANIFEST_COLUMNS:
+            raise ValueError(
+                "{} is not a manifest of rename_images.".format(manifest_path))
+        return [(os.path.join(directory, row["old_name"]),
+                 os.path.join(directory, row["new_name"])) for row in reader]
@@ -0,0 +1,247 @@
+"""Stabilization of the images of a time series: the movement of each image
+with respect to the first one is estimated and undone.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import os
+
+import cv2
+import numpy as np
+from bacolonyzer import filesystem
+
+logger = logging.getLogger(__name__)
+
+# Parameters of the detection of the features that are tracked.
+_FEATURES = dict(maxCorners=400,
+                 qualityLevel=0.001,
+                 minDistance=20,
+                 blockSize=5,
+                 useHarrisDetector=True)
+
+# Largest distance (pixels, at the tracking scale) between a feature and its
+# position given by a transform to be consistent with it.
+_THRESHOLD = 3.0
+
+# Largest movement of the images (pixels at full resolution) that is taken
+# as noise of the tracking.
+_PRECISION = 0.5
+
+
+class Stabilizer:
+    """Estimate the transform of each image of a series with respect to a
+    reference image (usually the first one).
+
+    Features are detected once in a key frame (initially the reference) and
+    tracked from the key frame to each image, starting from their position in
+    the previous image. Transforms are thus estimated against the key frame
+    instead of being accumulated from image to image, which drifts. Features
+    are detected again, in the current image which becomes the new key frame,
+    only when less than `min_tracked` of them are tracked consistently.
+
+    A transform is rejected if less than `min_inliers` of the features
+    detected in the key frame agree with it, or if it rotates the reference
+    by more than `max_rotation` degrees or scales it by more than
+    `max_scale` (a plate doesn't move that much). Features are then detected
+    again in the previous image, which is closer to the current one, and if
+    the transform is still rejected the previous transform is kept. The
+    previous transform is kept as well, exactly, if the new one moves the
+    image by less than half a pixel, so that images that don't move are not
+    warped because of the noise of the tracking.
+
+    Images can be tracked at a reduced scale (e.g. 0.5), which is faster.
+    Transforms are always given at full resolution.
+    """
+
+    def __init__(self, reference, scale=1.0, min_tracked=0.5, min_inliers=0.2,
+                 max_rotation=5.0, max_scale=0.003):
+        self.scale = scale
+        self.min_tracked = min_tracked
+        self.min_inliers = min_inliers
+        self.max_rotation = max_rotation
+        self.max_scale = max_scale
+        # Number of times the features were detected.
+        self.detections = 0
+        # Previous image and its transform.
+        self._shape = reference.shape
+        self._gray = self._resize(reference)
+        self._transform = np.eye(3)
+        self._set_key_frame(self._gray, self._transform)
+
+    def _resize(self, gray):
+        if self.scale == 1:
+            return gray
+        return cv2.resize(gray, None, fx=self.scale, fy=self.scale,
+                          interpolation=cv2.INTER_AREA)
+
+    def _set_key_frame(self, gray, transform):
+        """Detect the features of a new key frame, whose transform with respect
+        to the reference (3x3, at full resolution) is given."""
+        self._key_gray = gray
+        self._key_transform = transform
+        self._key_pts = cv2.goodFeaturesToTrack(gray, **_FEATURES)
+        if self._key_pts is None:
+            raise ValueError("No features found to stabilize the images.")
+        # Number of features detected, before dropping those not tracked.
+        self._detected = len(self._key_pts)
+        # Position of the features in the previous image, and transform from
+        # the key frame to the previous image (at the tracking scale).
+        self._pts = self._key_pts.copy()
+        self._matrix = np.eye(2, 3)
+        # Features are kept only if they are tracked in the next image.
+        self._pruned = False
+        self.detections += 1
+
+    def estimate(self, gray):
+        """Estimate the transform of the given grayscale image: a 2x3 matrix
+        mapping the coordinates of the reference to those of the image, to
+        stabilize it with `cv2.warpAffine(..., flags=cv2.WARP_INVERSE_MAP)`.
+        """
+        gray = self._resize(gray)
+        fit = self._track(gray)
+        if fit is None and self._key_gray is not self._gray:
+            logger.debug("Stabilization rejected, detecting features in the "
+                         "previous image.")
+            self._set_key_frame(self._gray, self._transform)
+            fit = self._track(gray)
+        if fit is None:
+            # The image can't be tracked: keep the previous transform.
+            logger.warning("Stabilization failed for an image, the previous "
+                           "transform is used.")
+            return self._transform[:2]
+
+        matrix, transform, pts, tracked, consistent = fit
+        self._transform = transform
+        self._matrix = matrix
+        self._gray = gray
+        if not self._pruned:
+            # Features that are not tracked consistently in the first image
+            # after the key frame (e.g. noise) are dropped.
+            self._key_pts = self._key_pts[consistent]
+            pts, tracked = pts[consistent], tracked[consistent]
+            consistent = consistent[consistent]
+            self._pruned = True
+        quality = np.count_nonzero(consistent) / len(self._key_pts)
+        if quality < self.min_tracked:
+            logger.debug("Only %.0f%% of the features were tracked, "
+                         "detecting new features.", quality * 100)
+            self._set_key_frame(gray, transform)
+        else:
+            # Features that were lost start from their expected position.
+            self._pts = cv2.transform(self._key_pts, matrix)
+            self._pts[consistent] = pts[consistent]
+        return transform[:2]
+
+    def _track(self, gray):
+        """Track the features of the key frame to the image. Return the
+        transform from the key frame to the image (at the tracking scale),
+        the transform from the reference (3x3, at full resolution), the
+        positions of the features, and which of them were tracked and are
+        consistent with the transform. None if the transform is rejected.
+        """
+        pts, status, _ = cv2.calcOpticalFlowPyrLK(
+            self._key_gray, gray, self._key_pts, self._pts.copy(),
+            flags=cv2.OPTFLOW_USE_INITIAL_FLOW)
+        tracked = status.ravel() == 1
+        if np.count_nonzero(tracked) < 2:
+            return None
+        matrix, inliers = cv2.estimateAffinePartial2D(
+            self._key_pts[tracked], pts[tracked],
+            ransacReprojThreshold=_THRESHOLD)
+        if matrix is None:
+            return None
+        consistent = np.zeros(len(tracked), dtype=bool)
+        consistent[tracked] = inliers.ravel() == 1
+
+        # Transform at full resolution: from the reference to the key frame,
+        # and then to the image.
+        transform = _to_3x3(rescale_transform(matrix,
+                                              self.scale)) @ self._key_transform
+        if _largest_shift(transform, self._transform,
+                          self._shape) < _PRECISION:
+            # The image didn't move since the previous one, the difference
+            # is the noise of the tracking.
+            matrix, transform = self._matrix, self._transform
+        if np.count_nonzero(consistent) < self.min_inliers * self._detected:
+            return None
+        scale = np.hypot(transform[0, 0], transform[1, 0])
+        rotation = np.degrees(np.arctan2(transform[1, 0], transform[0, 0]))
+        if (abs(scale - 1) > self.max_scale
+                or abs(rotation) > self.max_rotation):
+            return None
+        return matrix, transform, pts, tracked, consistent
+
+
+def _largest_shift(transform, other, shape):
+    """Largest distance between the positions of the corners of an image of
+    the given shape given by two transforms (3x3)."""
+    h, w = shape[:2]
+    corners = np.array([[0, 0, 1], [w, 0, 1], [0, h, 1], [w, h, 1]]).T
+    return np.hypot(*((transform - other) @ corners)[:2]).max()
+
+
+def _to_3x3(matrix):
+    return np.vstack([matrix, [0, 0, 1]])
+
+
+def rescale_transform(matrix, scale):
+    """Transform of the images at full resolution, given the transform of the
+    images downscaled by the given scale."""
+    matrix = np.array(matrix, dtype=np.float64)
+    matrix[:, 2] /= scale
+    return matrix
+
+
+def load_image_color_gray(img_path):
+    """Read an original image of the time-series as well as the
+    black-and-white version of this image.
+    """
+    img_color = cv2.imread(img_path, cv2.IMREAD_COLOR)
+    img_gray = cv2.cvtColor(img_color, cv2.COLOR_BGR2GRAY)
+    return img_color, img_gray
+
+
+def warp_image(image, transform, output_path=None):
+    """Undo the transform of an image (see `Stabilizer.estimate`), and save
+    the stabilized image if a path is given."""
+    h, w = image.shape[:2]
+    stabilized = cv2.warpAffine(image, transform, (w, h),
+                                flags=cv2.WARP_INVERSE_MAP)
+    if output_path is not None:
+        cv2.imwrite(output_path, stabilized)
+    return stabilized
+
+
+def stabilize_images(input_paths, output_paths, scale=1.0, jobs=1,
+                     prefetch=2):
+    """Stabilize the images of a series with respect to the first one and
+    save them in the output paths. Transforms are estimated one image after
+    another, while the images are warped and saved by a pool of `jobs`
+    threads (0 means one per core). The next `prefetch` images are read in
+    the background.
+    Yield the input path and the transform (2x3) of each image, in order.
+    """
+    images = filesystem.prefetch_images(input_paths, load_image_color_gray,
+                                        prefetch)
+    _, (reference, reference_gray) = next(images)
+    stabilizer = Stabilizer(reference_gray, scale)
+
+    jobs = jobs or os.cpu_count()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        # The first image is saved as it is.
+        pending = collections.deque(
+            [executor.submit(cv2.imwrite, output_paths[0], reference)])
+        yield input_paths[0], np.eye(2, 3)
+        for (input_path, (image, gray)), output_path in zip(
+                images, output_paths[1:]):
+            transform = stabilizer.estimate(gray)
+            pending.append(
+                executor.submit(warp_image, image, transform, output_path))
+            # Bound the number of images waiting to be saved.
+            while len(pending) > 2 * jobs:
+                pending.popleft().result()
+            yield input_path, transform
+        for future in pending:
+            future.result()
+    logger.debug("Features detected %s times.", stabilizer.detections)
@@ -0,0 +1,120 @@
+"""Analysis of the same images with many settings at once, to choose the
+settings of a series (e.g. the fraction of the grid or the segmentation).
+"""
+
+import collections
+import functools
+import itertools
+import logging
+import os
+
+import pandas as pd
+from bacolonyzer import analysis, filesystem, image_processing, profiling
+
+logger = logging.getLogger(__name__)
+
+# Settings of the analysis that are evaluated by a sweep.
+Configuration = collections.namedtuple(
+    "Configuration",
+    ["fraction", "low_contrasts", "sensitivity", "light_correction"])
+
+# Column of each setting in the outputs of a sweep.
+_COLUMNS = {
+    "fraction": "Fraction",
+    "low_contrasts": "LowContrasts",
+    "sensitivity": "Sensitivity",
+    "light_correction": "LightCorrection",
+}
+
+
+def configurations(fractions, low_contrasts, sensitivities, light_corrections):
+    """All the combinations of the given values of each setting."""
+    return [
+        Configuration(*values) for values in itertools.product(
+            fractions, low_contrasts, sensitivities, light_corrections)
+    ]
+
+
+def plate_setups(latest_image, nrow, ncol, configs, reference_image="",
+                 grid_by_peaks=False, search_scale=1.0, grid_threads=1,
+                 analysis_scale=1.0, low_memory=False):
+    """PlateSetup of each configuration, using the latest image. The grid is
+    located once per fraction, and the spots and the agar once per fraction,
+    segmentation and sensitivity."""
+    im_n = analysis.read_grid_image(latest_image)
+    if reference_image:
+        min_ref, max_ref = image_processing.calibration_maxmin(reference_image)
+    else:
+        min_ref, max_ref = 0, 255
+
+    grids = {}
+    masks = {}
+    setups = []
+    for config in configs:
+        if config.fraction not in grids:
+            logger.debug("Locating the grid with fraction %s", config.fraction)
+            with profiling.stage("find_grid"):
+                grids[config.fraction] = analysis.fit_grid(
+                    im_n, nrow, ncol, config.fraction, grid_by_peaks,
+                    search_scale, grid_threads)
+        grid = grids[config.fraction]
+        key = (config.fraction, config.low_contrasts, config.sensitivity)
+        if key not in masks:
+            masks[key] = analysis.grid_masks(im_n, grid, config.low_contrasts,
+                                             config.sensitivity)
+        setups.append(
+            analysis.plate_setup(dict(grid, **masks[key]),
+                                 min_ref,
+                                 max_ref,
+                                 light_correction=config.light_correction,
+                                 low_contrasts=config.low_contrasts,
+                                 analysis_scale=analysis_scale,
+                                 low_memory=low_memory,
+                                 sensitivity=config.sensitivity))
+    return setups
+
+
+def sweep_plate(images_paths, nrow, ncol, output_path, configs,
+                reference_image="", grid_by_peaks=False, search_scale=1.0,
+                grid_threads=1, analysis_scale=1.0, low_memory=False,
+                prefetch=2):
+    """Analyse the images with each of the configurations, and save the
+    outputs of all of them in a single tab delimited file. Each row has the
+    number of its configuration (starting at 1) and a column per setting.
+
+    Each image is decoded, blurred and thresholded automatically only once,
+    and these results are shared by all the configurations. The next
+    `prefetch` images are read in the background.
+    """
+    setups = plate_setups(images_paths[-1], nrow, ncol, configs,
+                          reference_image, grid_by_peaks, search_scale,
+                          grid_threads, analysis_scale, low_memory)
+    # All the setups blur the images in the same way.
+    blur_setup = setups[0]
+    otsu_needed = any(not setup.low_contrasts for setup in setups)
+    read_image = functools.partial(filesystem.read_gray, scale=analysis_scale)
+
+    # Outputs are written to a temporary file, so that a complete file is
+    # never replaced by an incomplete one.
+    with open(output_path + ".tmp", "w") as output_file:
+        header = True
+        for file_name, img in filesystem.prefetch_images(
+                images_paths, read_image, prefetch):
+            blurred = analysis.blur_image(file_name, blur_setup, img)
+            otsu = None
+            if otsu_needed:
+                otsu = analysis.otsu_threshold(file_name, blurred)
+            outputs = []
+            for number, (config, setup) in enumerate(zip(configs, setups), 1):
+                df, _ = analysis.analyse_image(file_name, setup, img, blurred,
+                                               otsu)
+                settings = {
+                    column: getattr(config, name)
+                    for name, column in _COLUMNS.items()
+                }
+                outputs.append(df.assign(Configuration=number, **settings))
+            pd.concat(outputs).to_csv(output_file, sep="\t", index=False,
+                                      header=header)
+            header = False
+            logger.debug("Sweep complete for %s", os.path.basename(file_name))
+    os.replace(output_path + ".tmp", output_path)
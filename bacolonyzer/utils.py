@@ -1,10 +1,14 @@
 """Functions to set the inputs that will be used.
 """
 
+import argparse
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Formats of the output data. See `output_store.open_store`.
+OUTPUT_FORMATS = ["tsv", "parquet", "feather", "hdf5", "columnar"]
+
 
 # Set input parameters for analysis
 def summarise(args):
@@ -22,6 +26,19 @@ def summarise(args):
     logger.debug("Searching for colony locations automatically.")
     logger.debug("Assuming that grid occupies at least {:.1f}%".format(
         args.fraction * 100))
+    if args.grid_search_scale < 1:
+        logger.debug("Searching grid first at {:.0f}% of the resolution.".format(
+            args.grid_search_scale * 100))
+
+    if args.mask_scale == 0:
+        logger.debug("Images of the spots won't be saved.")
+    elif args.mask_scale < 1:
+        logger.debug("Saving images of the spots at {:.0f}% of the "
+                     "resolution.".format(args.mask_scale * 100))
+
+    if args.analysis_scale < 1:
+        logger.debug("Analysing images at {:.0f}% of the resolution.".format(
+            args.analysis_scale * 100))
 
     logger.debug("Corrections:")
     if args.light_correction_off:
@@ -34,11 +51,17 @@ def summarise(args):
     else:
         logger.debug("Adaptive segmentation for low contrasts turned off.")
 
+    # Commands that watch a directory don't analyse a given series.
+    if not hasattr(args, "endpoint"):
+        return
     logger.debug("Analysis:")
     if args.endpoint:
         logger.debug("Analysing only last image in series.")
     else:
         logger.debug("Analysing the entire set of images in series.")
+    if args.jobs != 1:
+        logger.debug("Analysing images with %s parallel processes.",
+                     args.jobs or "all available")
 
 
 def get_grid_format(given_format):
@@ -85,3 +108,35 @@ def range_float(x):
     if x <= 0.0 or x >= 1.0:
         raise argparse.ArgumentTypeError("%r not in range (0.0, 1.0)" % (x, ))
     return x
+
+
+def scale_float(x):
+    """Check the float is in (0, 1] range."""
+    x = float(x)
+    if x <= 0.0 or x > 1.0:
+        raise argparse.ArgumentTypeError("%r not in range (0.0, 1.0]" % (x, ))
+    return x
+
+
+def mask_scale_float(x):
+    """Check the float is in [0, 1] range."""
+    x = float(x)
+    if x < 0.0 or x > 1.0:
+        raise argparse.ArgumentTypeError("%r not in range [0.0, 1.0]" % (x, ))
+    return x
+
+
+def non_negative_int(x):
+    """Check the integer is not negative."""
+    x = int(x)
+    if x < 0:
+        raise argparse.ArgumentTypeError("%r is a negative number" % (x, ))
+    return x
+
+
+def positive_int(x):
+    """Check the integer is positive."""
+    x = int(x)
+    if x < 1:
+        raise argparse.ArgumentTypeError("%r is not a positive number" % (x, ))
+    return x
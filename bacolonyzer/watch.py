@@ -0,0 +1,246 @@
+"""Functions to analyse the images of a directory as soon as they are written,
+e.g. by a scanner taking pictures of a plate.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+
+from bacolonyzer import analysis, filesystem, output_store
+
+try:
+    import inotify_simple
+except ImportError:  # inotify is optional and only available on Linux.
+    inotify_simple = None
+
+logger = logging.getLogger(__name__)
+
+
+class DirectoryWatcher(threading.Thread):
+    """Thread that puts the new images of a directory in a queue once they
+    have been completely written.
+
+    Images are complete when inotify reports that they were closed after
+    writing (or moved into the directory). Otherwise, and when inotify is not
+    available, they are complete when their size and modification time have
+    not changed for `settle_time` seconds. The queue is bounded: the watcher
+    waits while it is full.
+    """
+
+    def __init__(self, directory, images_queue, known=(), interval=1.0,
+                 settle_time=2.0):
+        super().__init__(daemon=True)
+        self.directory = directory
+        self.images_queue = images_queue
+        self.interval = interval
+        self.settle_time = settle_time
+        self.stopped = threading.Event()
+        # Images already queued or analysed.
+        self._known = set(known)
+        # Images being written: path -> (size, mtime, time since unchanged).
+        self._writing = {}
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        inotify = None
+        if inotify_simple is not None:
+            flags = inotify_simple.flags
+            inotify = inotify_simple.INotify()
+            inotify.add_watch(self.directory,
+                              flags.CLOSE_WRITE | flags.MOVED_TO)
+        else:
+            logger.debug("inotify not available, polling %s every %s s.",
+                         self.directory, self.interval)
+        try:
+            while not self.stopped.is_set():
+                if inotify is not None:
+                    for event in inotify.read(timeout=self.interval * 1000):
+                        path = os.path.join(self.directory, event.name)
+                        if filesystem.is_image(path):
+                            self._put(path)
+                else:
+                    self.stopped.wait(self.interval)
+                # Check also the images that inotify may have missed, e.g.
+                # images that were being written before starting to watch.
+                self._check_written()
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def _check_written(self):
+        """Queue the new images whose size and modification time are stable."""
+        now = time.time()
+        for path in filesystem.get_all_images(self.directory):
+            if path in self._known:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:  # The image was removed.
+                self._writing.pop(path, None)
+                continue
+            previous = self._writing.get(path)
+            if previous is None or previous[:2] != (stat.st_size,
+                                                    stat.st_mtime):
+                self._writing[path] = (stat.st_size, stat.st_mtime, now)
+            elif stat.st_size > 0 and now - previous[2] >= self.settle_time:
+                self._put(path)
+
+    def _put(self, path):
+        """Queue an image, waiting while the queue is full."""
+        if path in self._known:
+            return
+        while not self.stopped.is_set():
+            try:
+                self.images_queue.put(path, timeout=self.interval)
+            except queue.Full:
+                continue
+            self._known.add(path)
+            self._writing.pop(path, None)
+            return
+
+
+def _is_settled(path, settle_time):
+    """Check if an image has not been modified for settle_time seconds."""
+    try:
+        stat = os.stat(path)
+    except OSError:  # The image was removed.
+        return False
+    return stat.st_size > 0 and time.time() - stat.st_mtime >= settle_time
+
+
+def watch_plate(
+    directory,
+    nrow,
+    ncol,
+    stop_event,
+    light_correction=False,
+    fraction=0.8,
+    reference_image="",
+    low_contrasts=False,
+    grid_by_peaks=False,
+    search_scale=1.0,
+    grid_threads=1,
+    recompute_grid=False,
+    crop_first=False,
+    analysis_scale=1.0,
+    low_memory=False,
+    queue_size=8,
+    interval=1.0,
+    settle_time=2.0,
+    output_format="tsv",
+    mask_scale=1.0,
+    png_compression=None,
+    write_queue=4,
+    sensitivity=0.05,
+    integral_metrics=False,
+):
+    """Analyse the images of a directory as soon as they are written, until
+    the stop_event is set. Images without up to date outputs are analysed
+    first, except those modified in the last settle_time seconds, which are
+    analysed once they are complete. The grid, the masks and the calibration
+    are kept in memory. Columnar output files are completed when watching
+    stops.
+    """
+    # Fail before watching if the outputs can't be saved.
+    output_store.store_class(output_format)
+    images_queue = queue.Queue(maxsize=queue_size)
+    existing = filesystem.get_all_images(directory)
+    ignored = [os.path.abspath(reference_image)] if reference_image else []
+    existing = [f for f in existing if f not in ignored]
+    # Images modified recently may still be being written: the watcher queues
+    # them once they are complete.
+    existing = [f for f in existing if _is_settled(f, settle_time)]
+    watcher = DirectoryWatcher(directory, images_queue, existing + ignored,
+                               interval, settle_time)
+    watcher.start()
+
+    record = filesystem.load_analysis_record(directory)
+    store = output_store.open_store(directory, output_format, mask_scale,
+                                    png_compression, write_queue)
+    try:
+        # Keep the grid of previous analyses so that their outputs are valid.
+        grid_image = None
+        if not recompute_grid:
+            grid_image = analysis.previous_grid_image(record, directory)
+        if grid_image is None and existing:
+            grid_image = existing[-1]
+        while grid_image is None and not stop_event.is_set():
+            logger.debug("Waiting for the first image in %s...", directory)
+            try:
+                grid_image = images_queue.get(timeout=interval)
+            except queue.Empty:
+                continue
+            existing.append(grid_image)
+        if grid_image is None:
+            return
+
+        logger.debug("Computing position of the grid on %s", grid_image)
+        setup = analysis.locate_plate(
+            grid_image,
+            nrow,
+            ncol,
+            directory,
+            light_correction=light_correction,
+            fraction=fraction,
+            reference_image=reference_image,
+            low_contrasts=low_contrasts,
+            grid_by_peaks=grid_by_peaks,
+            search_scale=search_scale,
+            grid_threads=grid_threads,
+            recompute_grid=recompute_grid,
+            crop_first=crop_first,
+            analysis_scale=analysis_scale,
+            low_memory=low_memory,
+            sensitivity=sensitivity,
+            integral_metrics=integral_metrics,
+        )
+        fingerprint = analysis.setup_fingerprint(setup)
+        record["grid_image"] = os.path.basename(grid_image)
+        record_output = analysis.output_recorder(record, fingerprint)
+
+        def saved(file_name):
+            # Called by the thread saving the outputs, if any, which is the
+            # only one saving the record until the store is closed.
+            record_output(file_name)
+            filesystem.save_analysis_record(directory, record)
+
+        def analyse(file_name):
+            df, mask = analysis.analyse_image(file_name, setup)
+            store.write(file_name, df, mask, on_saved=saved)
+            logger.debug("Analysis complete for %s%s",
+                         os.path.basename(file_name),
+                         analysis._memory_message())
+
+        for file_name in analysis.outdated_images(existing, store, record,
+                                                  fingerprint):
+            if stop_event.is_set():
+                break
+            analyse(file_name)
+
+        logger.debug("Watching %s for new images.", directory)
+        while not stop_event.is_set():
+            try:
+                file_name = images_queue.get(timeout=interval)
+            except queue.Empty:
+                continue
+            analyse(file_name)
+
+        # Stop watching, but analyse the complete images already queued.
+        watcher.stop()
+        watcher.join()
+        while True:
+            try:
+                analyse(images_queue.get_nowait())
+            except queue.Empty:
+                break
+    finally:
+        watcher.stop()
+        try:
+            store.close()
+        finally:
+            filesystem.save_analysis_record(directory, record)
+    logger.debug("Stopped watching %s.", directory)
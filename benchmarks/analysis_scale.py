@@ -0,0 +1,126 @@
+"""Benchmark of the reduced-resolution analysis (`--analysis_scale`).
+
+The images of a directory are analysed at full resolution and at each of the
+given scales. For every scale, the time per image and the drift of each output
+column with respect to the full resolution results are reported:
+
+* max_abs / mean_abs: maximum and mean absolute difference.
+* rel_mean_abs: mean absolute difference relative to the mean absolute value
+  at full resolution.
+* corr: Pearson correlation with the full resolution results.
+
+Example:
+
+    python benchmarks/analysis_scale.py -d /path/to/images -g 16x24 \
+        --scales 0.5 0.25 0.125
+
+The grid is located once at full resolution, as `bacolonyzer analyse` does.
+Outputs are written to a temporary directory and the images are not modified.
+"""
+
+import argparse
+import logging
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from bacolonyzer import analysis, filesystem, utils
+
+logger = logging.getLogger(__name__)
+
+_COLUMNS = ["Intensity", "Area", "ColonyMean", "ColonyVariance",
+            "BackgroundMean"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "-d", "--directory", default=".", help="Directory with the images.")
+    parser.add_argument(
+        "-g", "--grid_format", nargs="+", default=["8x12"],
+        help="Grid format, e.g. 8x12. Default: 8x12.")
+    parser.add_argument(
+        "--scales", type=utils.scale_float, nargs="+",
+        default=[0.5, 0.25, 0.125],
+        help="Scales compared with the full resolution. "
+        "Default: 0.5 0.25 0.125.")
+    parser.add_argument(
+        "-c", "--light_correction_off", action="store_false",
+        help="Disable the lighting correction.")
+    parser.add_argument(
+        "-l", "--low_contrasts", action="store_true",
+        help="Use the adaptive segmentation for low contrasts.")
+    parser.add_argument(
+        "-o", "--output", default=None,
+        help="Save the report as a tab delimited file.")
+    return parser.parse_args()
+
+
+def analyse_at_scale(images_paths, nrow, ncol, output_dir, scale, args):
+    """Analyse the images at the given scale. Return the outputs of all the
+    images and the seconds spent per image (the grid is not included)."""
+    setup = analysis.locate_plate(images_paths[-1], nrow, ncol, output_dir,
+                                  light_correction=args.light_correction_off,
+                                  low_contrasts=args.low_contrasts,
+                                  analysis_scale=scale)
+    start_time = time.perf_counter()
+    outputs = [df for _, df, _ in analysis.analyse_images(images_paths, setup)]
+    seconds = (time.perf_counter() - start_time) / len(images_paths)
+    return pd.concat(outputs, ignore_index=True), seconds
+
+
+def drift(reference, outputs):
+    """Differences of each output column with the reference outputs."""
+    report = {}
+    for column in _COLUMNS:
+        ref, out = reference[column].values, outputs[column].values
+        diff = np.abs(out - ref)
+        # Columns that are ~0 (e.g. BackgroundMean with light correction)
+        # have no meaningful relative drift.
+        scale = np.mean(np.abs(ref))
+        report[column] = {
+            "max_abs": diff.max(),
+            "mean_abs": diff.mean(),
+            "rel_mean_abs": diff.mean() / scale if scale > 1e-9 else np.nan,
+            "corr": (np.corrcoef(ref, out)[0, 1]
+                     if ref.std() and out.std() else np.nan),
+        }
+    return report
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    nrow, ncol = utils.get_grid_format(args.grid_format)
+    directory = filesystem.get_directory(args.directory)
+    images_paths = filesystem.get_all_images(directory)
+    if not images_paths:
+        raise ValueError("No images found in {}.".format(directory))
+
+    rows = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        filesystem.arrange_directories(output_dir)
+        reference, ref_seconds = analyse_at_scale(
+            images_paths, nrow, ncol, output_dir, 1.0, args)
+        logger.info("Full resolution: %.3f s per image", ref_seconds)
+        for scale in args.scales:
+            outputs, seconds = analyse_at_scale(
+                images_paths, nrow, ncol, output_dir, scale, args)
+            logger.info("Scale %s: %.3f s per image (%.1fx faster)", scale,
+                        seconds, ref_seconds / seconds)
+            for column, values in drift(reference, outputs).items():
+                rows.append(dict(scale=scale, column=column,
+                                 seconds_per_image=seconds,
+                                 speedup=ref_seconds / seconds, **values))
+
+    report = pd.DataFrame(rows)
+    with pd.option_context("display.width", 120):
+        print(report.to_string(index=False, float_format="{:.4g}".format))
+    if args.output:
+        report.to_csv(args.output, sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    main()
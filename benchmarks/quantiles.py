@@ -0,0 +1,116 @@
+"""Benchmark of the 1% and 99% quantiles used to clip images and patches.
+
+A synthetic plate (see `synthetic.py`) is clipped as BaColonyzer does, with
+the quantiles computed by:
+
+* np.quantile: sorting (partitioning) the pixels, as done previously.
+* histogram: `quantiles`, from the histograms of the 256 gray levels,
+  interpolated exactly as np.quantile.
+* histogram (fast): the same, without interpolation.
+
+The quantiles are computed for the whole image (as for the latest image and
+the reference image) and for every patch of the grid at once, in double and
+single precision (--low_memory). For each method, the time per image and the
+largest difference with np.quantile are reported.
+
+Example:
+
+    python benchmarks/quantiles.py -f 1536 -w 4000 --repeat 5
+"""
+
+import argparse
+import sys
+import time
+import types
+
+import numpy as np
+
+import synthetic
+from bacolonyzer import analysis, quantiles
+
+_Q = [0.01, 0.99]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.split("\n\n", 1)[1])
+    parser.add_argument("-f", "--format", type=int, default=96,
+                        choices=sorted(synthetic.FORMATS),
+                        help="Number of spots of the plate. Default: 96.")
+    parser.add_argument("-w", "--width", type=int, default=2400,
+                        help="Width of the image in pixels. Default: 2400.")
+    parser.add_argument("--reference", type=int, nargs=2, default=[12, 243],
+                        metavar=("MIN", "MAX"),
+                        help="Calibration of the normalization. "
+                        "Default: 12 243.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Times each method is run, the fastest is "
+                        "reported. Default: 3.")
+    return parser.parse_args()
+
+
+def timed(function, repeat):
+    """Result of the function and its fastest time in milliseconds."""
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start_time)
+    return np.asarray(result), min(times) * 1000
+
+
+def main():
+    args = parse_args()
+    nrow, ncol = synthetic.FORMATS[args.format]
+    img = synthetic.plate_image(nrow, ncol, args.width)
+    # Geometry of the grid of the synthetic plate.
+    pitch = args.width / (ncol + 2)
+    margin = int(round(pitch))
+    d = int(pitch)
+    grid = img[margin:margin + nrow * d, margin:margin + ncol * d]
+    print("{}x{} image, {} patches of {}x{} pixels".format(
+        img.shape[1], img.shape[0], nrow * ncol, d, d))
+    print("{:<32} {:>10} {:>12}".format("quantiles", "time (ms)",
+                                        "difference"))
+
+    def report(name, expected, result, milliseconds):
+        difference = np.max(np.abs(result - expected))
+        print("{:<32} {:>10.2f} {:>12.3g}".format(name, milliseconds,
+                                                  difference))
+
+    expected, ms = timed(lambda: np.quantile(img.ravel(), _Q), args.repeat)
+    report("image: np.quantile", expected, expected, ms)
+    for precise, method in [(True, "histogram"), (False, "histogram (fast)")]:
+        result, ms = timed(
+            lambda: quantiles.image_quantiles(img, _Q, precise=precise),
+            args.repeat)
+        report("image: " + method, expected, result, ms)
+
+    min_ref, max_ref = args.reference
+    codes = analysis.grid_blocks(grid, nrow, ncol, d, d)
+    for low_memory in [False, True]:
+        setup = types.SimpleNamespace(min_ref=np.uint8(min_ref),
+                                      max_ref=np.uint8(max_ref),
+                                      low_memory=low_memory)
+        levels = analysis.normalized_levels(setup)
+        patches = levels[codes]
+        precision = "single" if low_memory else "double"
+        expected, ms = timed(
+            lambda: np.quantile(patches, _Q, axis=-1, keepdims=True),
+            args.repeat)
+        report("patches ({}): np.quantile".format(precision), expected,
+               expected, ms)
+        for precise, method in [(True, "histogram"),
+                                (False, "histogram (fast)")]:
+            result, ms = timed(
+                lambda: quantiles.block_quantiles(codes, _Q, levels,
+                                                  precise=precise),
+                args.repeat)
+            report("patches ({}): {}".format(precision, method), expected,
+                   result, ms)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
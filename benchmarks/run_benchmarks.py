@@ -0,0 +1,248 @@
+"""Benchmarks of the stages of the analysis on synthetic plates.
+
+For each plate format, a time series of synthetic plates (see `synthetic.py`)
+is written to a temporary directory, and each stage of the analysis is timed
+separately and end to end:
+
+* read: decode an image in grayscale.
+* get_position_grid: template matching of the grid on the latest image.
+* locate_plate: locate the grid, the spots and the agar (grid cache ignored).
+* analyse_image: analyse an image once the grid is located.
+* measure_outputs: measure all the spots of an analysed image.
+* measure_outputs_integral: the same with `--integral_metrics`.
+* analyse_images: analyse all the images of the series one by one.
+* end_to_end: `analyse_timeseries_qfa` on the whole series, saving outputs.
+
+The minimum and median time of the repetitions are reported, together with
+the peak memory allocated by each stage (traced with tracemalloc in a separate
+run, OpenCV allocations are not included) and the peak resident memory of the
+process. Results are saved as JSON to compare them across commits:
+
+    python benchmarks/run_benchmarks.py -o before.json
+    git checkout my-branch
+    python benchmarks/run_benchmarks.py -o after.json --compare before.json
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Progress bars of the grid search are not shown.
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+import cv2
+import numpy as np
+
+import synthetic
+from bacolonyzer import analysis, filesystem, image_processing
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.split("\n\n", 1)[1])
+    parser.add_argument(
+        "-f", "--formats", type=int, nargs="+", default=[96, 384],
+        choices=sorted(synthetic.FORMATS),
+        help="Plate formats to benchmark. Default: 96 384.")
+    parser.add_argument(
+        "-w", "--width", type=int, default=1600,
+        help="Width of the images in pixels. Default: 1600.")
+    parser.add_argument(
+        "-n", "--images", type=int, default=4,
+        help="Number of images of each series. Default: 4.")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=3,
+        help="Number of times each stage is timed. Default: 3.")
+    parser.add_argument(
+        "-o", "--output", default=None,
+        help="Save the results in this JSON file.")
+    parser.add_argument(
+        "--compare", nargs="+", metavar="JSON",
+        help="Compare the results with a previous JSON file. If two files "
+        "are given, they are compared without running the benchmarks.")
+    args = parser.parse_args()
+    if args.compare and len(args.compare) > 2:
+        parser.error("--compare accepts one or two files.")
+    return args
+
+
+def measure(function, repeat):
+    """Time the function `repeat` times, and trace the memory it allocates
+    in another run. Return a dictionary with the results."""
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+    return {
+        "times": times,
+        "min": min(times),
+        "median": float(np.median(times)),
+        "peak_traced_mb": peak / (1 << 20),
+    }
+
+
+def benchmark_format(plate_format, args):
+    """Benchmark all the stages for a plate format."""
+    nrow, ncol = synthetic.FORMATS[plate_format]
+    stages = {}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = synthetic.write_series(directory, args.images, plate_format,
+                                       args.width)
+        filesystem.arrange_directories(directory)
+        latest = paths[-1]
+        img = filesystem.read_gray(latest)
+
+        stages["read"] = measure(lambda: filesystem.read_gray(latest),
+                                 args.repeat)
+
+        # The latest image is prepared as in `analysis.find_grid`.
+        im_n = np.clip(img, *np.quantile(img.ravel(), [0.01, 0.99]))
+        im_n = np.array(im_n, dtype=np.uint8)
+        stages["get_position_grid"] = measure(
+            lambda: image_processing.get_position_grid(im_n, nrow, ncol, 0.8),
+            args.repeat)
+
+        def locate():
+            return analysis.locate_plate(latest, nrow, ncol, directory,
+                                         light_correction=True,
+                                         recompute_grid=True)
+
+        stages["locate_plate"] = measure(locate, args.repeat)
+        setup = locate()
+
+        stages["analyse_image"] = measure(
+            lambda: analysis.analyse_image(latest, setup, img), args.repeat)
+
+        # Inputs of measure_outputs, as prepared by `analysis.analyse_image`.
+        _, mask = analysis.analyse_image(latest, setup, img)
+        codes = img[setup.min_loc[1]:setup.min_loc[1] + setup.pat_h,
+                    setup.min_loc[0]:setup.min_loc[0] + setup.pat_w]
+        arr = (codes - setup.min_ref) / (setup.max_ref - setup.min_ref)
+        levels = analysis.normalized_levels(setup)
+        stages["measure_outputs"] = measure(
+            lambda: analysis.measure_outputs(
+                arr, mask, setup.pat_h, setup.pat_w, nrow, ncol, latest,
+                setup.spots, setup.light_correction, codes=codes,
+                levels=levels),
+            args.repeat)
+        # The integral metrics only need the gray levels.
+        stages["measure_outputs_integral"] = measure(
+            lambda: analysis.measure_outputs(
+                codes, mask, setup.pat_h, setup.pat_w, nrow, ncol, latest,
+                setup.spots, setup.light_correction, integral=True,
+                codes=codes, levels=levels),
+            args.repeat)
+
+        stages["analyse_images"] = measure(
+            lambda: list(analysis.analyse_images(paths, setup, prefetch=0)),
+            args.repeat)
+
+        stages["end_to_end"] = measure(
+            lambda: analysis.analyse_timeseries_qfa(
+                paths, nrow, ncol, directory, light_correction=True,
+                recompute_grid=True),
+            args.repeat)
+
+    return {
+        "format": plate_format,
+        "grid": [nrow, ncol],
+        "image_shape": list(img.shape),
+        "images": args.images,
+        "stages": stages,
+    }
+
+
+def metadata():
+    """Information about the code and the computer used."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def print_results(results):
+    print("Commit: {}".format(results["meta"]["commit"] or "unknown"))
+    print("{:>6} {:<24} {:>10} {:>10} {:>12}".format(
+        "format", "stage", "min (s)", "median (s)", "traced (MB)"))
+    for case in results["cases"]:
+        for stage, values in case["stages"].items():
+            print("{:>6} {:<24} {:>10.4f} {:>10.4f} {:>12.1f}".format(
+                case["format"], stage, values["min"], values["median"],
+                values["peak_traced_mb"]))
+    print("Peak resident memory: {:.0f} MB".format(results["peak_rss_mb"]))
+
+
+def print_comparison(baseline, current):
+    """Print the ratio of the median times (current / baseline)."""
+    print("Comparing {} (baseline) with {}".format(
+        baseline["meta"]["commit"][:10] or "unknown",
+        current["meta"]["commit"][:10] or "unknown"))
+    print("{:>6} {:<24} {:>10} {:>10} {:>7}".format(
+        "format", "stage", "baseline", "current", "ratio"))
+    base_cases = {case["format"]: case for case in baseline["cases"]}
+    for case in current["cases"]:
+        base_case = base_cases.get(case["format"])
+        if base_case is None:
+            continue
+        for stage, values in case["stages"].items():
+            if stage not in base_case["stages"]:
+                continue
+            base = base_case["stages"][stage]["median"]
+            print("{:>6} {:<24} {:>10.4f} {:>10.4f} {:>7.2f}".format(
+                case["format"], stage, base, values["median"],
+                values["median"] / base))
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0]) as baseline_file:
+            baseline = json.load(baseline_file)
+        with open(args.compare[1]) as current_file:
+            print_comparison(baseline, json.load(current_file))
+        return
+
+    results = {
+        "meta": metadata(),
+        "cases": [benchmark_format(f, args) for f in args.formats],
+        "peak_rss_mb": analysis.peak_memory() or 0,
+    }
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=1)
+    if args.compare:
+        with open(args.compare[0]) as baseline:
+            print_comparison(json.load(baseline), results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
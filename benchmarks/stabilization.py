@@ -0,0 +1,169 @@
+"""Benchmark of the stabilization of images on a synthetic drifting series.
+
+A synthetic plate (see `synthetic.py`) grows while it is moved by a random
+walk of small translations and rotations, with new noise in each image. The
+known movements are compared with those estimated by:
+
+* frame_to_frame: the previous method of `bacolonyzer stabilize_images`,
+  which detects features in each image, tracks them to the next one and
+  accumulates the transforms.
+* reference (scale): `stabilization.Stabilizer`, which tracks the features of
+  a key frame, at the given scales.
+
+For each method, the number of images per second and the alignment error
+(distance in pixels between the true and the estimated position of points
+spread over the image) are reported. The end-to-end `stabilize_images`
+pipeline, which also warps and saves the images, is timed too.
+
+Example:
+
+    python benchmarks/stabilization.py -n 40 -w 2400 --scales 1 0.5
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# Progress bars are not shown.
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+import cv2
+import numpy as np
+
+import synthetic
+from bacolonyzer import stabilization, utils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.split("\n\n", 1)[1])
+    parser.add_argument("-n", "--images", type=int, default=30,
+                        help="Number of images of the series. Default: 30.")
+    parser.add_argument("-w", "--width", type=int, default=1600,
+                        help="Width of the images in pixels. Default: 1600.")
+    parser.add_argument("--shift", type=float, default=2.0,
+                        help="Standard deviation of the translation between "
+                        "consecutive images (pixels). Default: 2.")
+    parser.add_argument("--rotation", type=float, default=0.05,
+                        help="Standard deviation of the rotation between "
+                        "consecutive images (degrees). Default: 0.05.")
+    parser.add_argument("--scales", type=utils.scale_float, nargs="+",
+                        default=[1.0, 0.5, 0.25],
+                        help="Scales of the images used by the stabilizer. "
+                        "Default: 1 0.5 0.25.")
+    parser.add_argument("-j", "--jobs", type=int, default=2,
+                        help="Threads that warp and save the images in the "
+                        "end-to-end pipeline. Default: 2.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the random movements. Default: 0.")
+    return parser.parse_args()
+
+
+def drifting_series(args):
+    """Images of the series (BGR) and the true transform of each image."""
+    rng = np.random.default_rng(args.seed)
+    growth = synthetic.logistic_growth(args.images)
+    angle, shift = 0.0, np.zeros(2)
+    images, transforms = [], []
+    for t in range(args.images):
+        if t:
+            angle += rng.normal(0, args.rotation)
+            shift += rng.normal(0, args.shift, 2)
+        # Labels around the agar give corners to track, as in real plates.
+        plate = synthetic.plate_image(8, 12, args.width, growth[t],
+                                      noise_seed=t + 1, labels=True)
+        h, w = plate.shape
+        transform = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1)
+        transform[:, 2] += shift
+        image = cv2.warpAffine(plate, transform, (w, h),
+                               borderMode=cv2.BORDER_REPLICATE)
+        images.append(cv2.cvtColor(image, cv2.COLOR_GRAY2BGR))
+        transforms.append(transform)
+    return images, transforms
+
+
+def frame_to_frame(grays):
+    """Transforms estimated as by the previous `stabilize_images`."""
+    M = np.eye(2, 3, dtype=np.float32)
+    transforms = [M.copy()]
+    prev_gray = grays[0]
+    for curr_gray in grays[1:]:
+        prev_pts = cv2.goodFeaturesToTrack(prev_gray, maxCorners=400,
+                                           qualityLevel=0.001,
+                                           minDistance=20, blockSize=5,
+                                           useHarrisDetector=True)
+        curr_pts, status, _ = cv2.calcOpticalFlowPyrLK(
+            prev_gray, curr_gray, prev_pts, None)
+        idx = np.where(status == 1)[0]
+        M_iter, _ = cv2.estimateAffinePartial2D(prev_pts[idx], curr_pts[idx])
+        M[:2, :2] = np.dot(M[:2, :2], M_iter[:2, :2])
+        M[:, 2:] += M_iter[:, 2:]
+        transforms.append(M.copy())
+        prev_gray = curr_gray
+    return transforms
+
+
+def reference(grays, scale):
+    stabilizer = stabilization.Stabilizer(grays[0], scale)
+    return [np.eye(2, 3)] + [stabilizer.estimate(g) for g in grays[1:]]
+
+
+def alignment_error(true_transforms, transforms, shape):
+    """Mean and maximum distance (pixels) between the true and the estimated
+    positions of a grid of points of the image, over all the images."""
+    h, w = shape
+    x, y = np.meshgrid(np.linspace(0, w, 5), np.linspace(0, h, 5))
+    points = np.stack([x.ravel(), y.ravel(), np.ones(x.size)])
+    errors = np.concatenate([
+        np.hypot(*(np.asarray(true) @ points - np.asarray(est) @ points))
+        for true, est in zip(true_transforms, transforms)
+    ])
+    return errors.mean(), errors.max()
+
+
+def main():
+    args = parse_args()
+    images, true_transforms = drifting_series(args)
+    grays = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) for image in images]
+    shape = grays[0].shape
+    print("{} images of {}x{} pixels".format(len(images), shape[1], shape[0]))
+    print("{:<24} {:>10} {:>12} {:>11}".format("method", "images/s",
+                                               "mean error", "max error"))
+
+    methods = [("frame_to_frame", frame_to_frame)] + [
+        ("reference ({:g})".format(s), lambda g, s=s: reference(g, s))
+        for s in args.scales
+    ]
+    for name, method in methods:
+        start_time = time.perf_counter()
+        transforms = method(grays)
+        seconds = time.perf_counter() - start_time
+        mean_error, max_error = alignment_error(true_transforms, transforms,
+                                                shape)
+        print("{:<24} {:>10.1f} {:>10.2f}px {:>9.2f}px".format(
+            name, (len(grays) - 1) / seconds, mean_error, max_error))
+
+    # End-to-end pipeline: read, estimate, warp and save.
+    with tempfile.TemporaryDirectory() as directory:
+        input_paths = []
+        for t, image in enumerate(images):
+            path = os.path.join(directory, "in_{:04d}.png".format(t))
+            cv2.imwrite(path, image)
+            input_paths.append(path)
+        output_paths = [p.replace("in_", "out_") for p in input_paths]
+        for scale in args.scales:
+            start_time = time.perf_counter()
+            for _ in stabilization.stabilize_images(input_paths, output_paths,
+                                                    scale, args.jobs):
+                pass
+            seconds = time.perf_counter() - start_time
+            print("stabilize_images ({:g}, {} jobs): {:.1f} images/s".format(
+                scale, args.jobs, len(input_paths) / seconds))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
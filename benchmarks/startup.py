@@ -0,0 +1,87 @@
+"""Check that the command line of BaColonyzer starts quickly.
+
+`bacolonyzer --help` (and the help of each command) is run in a new Python
+process, timing the import of BaColonyzer and the parsing of the arguments.
+The check fails if it takes longer than the budget, or if any of the heavy
+dependencies (OpenCV, NumPy, pandas, SciPy, Pillow, tqdm) is imported: these
+must only be imported by the command that runs.
+
+Example:
+
+    python benchmarks/startup.py --budget 0.2
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ["cv2", "numpy", "pandas", "scipy", "PIL", "tqdm"]
+
+COMMANDS = [
+    "analyse", "analyse_batch", "convert_outputs", "rename_images",
+    "stabilize_images", "sweep", "watch"
+]
+
+# Run in a new process, so that nothing is imported in advance.
+_SCRIPT = """
+import json, sys, time
+start_time = time.perf_counter()
+from bacolonyzer.commands import entrypoint
+sys.argv = ["bacolonyzer"] + {args!r}
+try:
+    entrypoint.run()
+except SystemExit:
+    pass
+seconds = time.perf_counter() - start_time
+heavy = sorted({{m.split(".")[0] for m in sys.modules}} & set({heavy!r}))
+sys.stderr.write(json.dumps({{"seconds": seconds, "heavy": heavy}}))
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "-b", "--budget", type=float, default=0.2,
+        help="Maximum seconds to import BaColonyzer and show the help. "
+        "Default: 0.2.")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5,
+        help="Number of runs of each help. The fastest one is checked. "
+        "Default: 5.")
+    return parser.parse_args()
+
+
+def startup(args, repeat):
+    """Fastest time of `bacolonyzer <args>` and the heavy modules it
+    imported."""
+    results = []
+    for _ in range(repeat):
+        process = subprocess.run(
+            [sys.executable, "-c",
+             _SCRIPT.format(args=args, heavy=HEAVY_MODULES)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+            check=True)
+        results.append(json.loads(process.stderr.splitlines()[-1]))
+    return (min(r["seconds"] for r in results),
+            sorted(set().union(*(r["heavy"] for r in results))))
+
+
+def main():
+    args = parse_args()
+    failed = False
+    for help_args in [["--help"]] + [[c, "--help"] for c in COMMANDS]:
+        seconds, heavy = startup(help_args, args.repeat)
+        errors = []
+        if seconds > args.budget:
+            errors.append("slower than {:.3f} s".format(args.budget))
+        if heavy:
+            errors.append("imports " + ", ".join(heavy))
+        failed = failed or bool(errors)
+        print("bacolonyzer {:<26} {:.3f} s  {}".format(
+            " ".join(help_args), seconds, "; ".join(errors) or "ok"))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
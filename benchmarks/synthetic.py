@@ -0,0 +1,120 @@
+"""Synthetic QFA plates to benchmark BaColonyzer without sample data.
+
+Each plate is a grayscale image of a dark background, a lighter rectangle of
+agar and a grid of round spots. Spots grow over the time series following a
+logistic curve, up to a different final size per spot. A lighting gradient
+and Gaussian noise can be added to mimic real scans, as well as labels
+above the agar, which give corners that don't change to track.
+
+Example:
+
+    python benchmarks/synthetic.py -d /tmp/plate_384 -f 384 -w 3000 -n 10
+"""
+
+import argparse
+import os
+
+import cv2
+import numpy as np
+
+# Number of rows and columns of the usual plate formats.
+FORMATS = {96: (8, 12), 384: (16, 24), 1536: (32, 48)}
+
+
+def plate_image(nrow=8, ncol=12, width=2400, growth=1.0, gradient=0.2,
+                noise=4.0, seed=0, noise_seed=None, labels=False):
+    """Build the image of a plate of the given width (in pixels).
+    growth (0 to 1) scales the radius of all spots, gradient is the relative
+    change of the illumination from the left to the right of the image, and
+    noise is the standard deviation of the Gaussian noise. The seed sets the
+    size and color of the spots, and noise_seed (by default, seed) the noise.
+    If labels is True, text is written above the agar, as on real plates.
+    """
+    pitch = width / (ncol + 2)
+    margin = int(round(pitch))
+    height = int(round(pitch * (nrow + 2)))
+    img = np.full((height, width), 40, dtype=np.float32)
+    # Agar, slightly larger than the grid.
+    border = margin // 4
+    img[margin - border:height - margin + border,
+        margin - border:width - margin + border] = 70
+    # Spots of random maximum size and color.
+    rng = np.random.default_rng(seed)
+    sizes = rng.uniform(0.5, 1.0, (nrow, ncol))
+    colors = rng.uniform(120, 220, (nrow, ncol))
+    for i in range(nrow):
+        for j in range(ncol):
+            radius = int(pitch * 0.35 * sizes[i, j] * growth)
+            if radius > 0:
+                center = (int(margin + (j + 0.5) * pitch),
+                          int(margin + (i + 0.5) * pitch))
+                cv2.circle(img, center, radius, float(colors[i, j]), -1)
+    if gradient:
+        img *= np.linspace(1 - gradient / 2, 1 + gradient / 2, width,
+                           dtype=np.float32)
+    if noise:
+        rng = np.random.default_rng(seed if noise_seed is None else noise_seed)
+        img += rng.normal(0, noise, img.shape).astype(np.float32)
+    img = np.clip(img, 0, 255).astype(np.uint8)
+    if labels:
+        for i, text in enumerate(["QFA 0001", "S. aureus", "37 C", "A1"]):
+            position = (int(width * (0.05 + 0.3 * i)), int(height * 0.04) + 10)
+            cv2.putText(img, text, position, cv2.FONT_HERSHEY_SIMPLEX,
+                        width / 1600, 200, max(width // 800, 1))
+    return img
+
+
+def logistic_growth(n_images, rate=8.0):
+    """Relative size of the spots in each image of a series of n_images."""
+    t = np.linspace(0, 1, n_images)
+    return 1 / (1 + np.exp(-rate * (t - 0.5)))
+
+
+def write_series(directory, n_images=4, plate_format=96, width=2400,
+                 gradient=0.2, noise=4.0, extension=".png", seed=0,
+                 labels=False):
+    """Write a time series of plates in the directory, named as
+    `bacolonyzer rename_images` does (one image per hour).
+    Return the paths of the images."""
+    nrow, ncol = FORMATS[plate_format]
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for t, growth in enumerate(logistic_growth(n_images)):
+        # The same spots grow in all the images, with different noise.
+        img = plate_image(nrow, ncol, width, growth, gradient, noise,
+                          seed=seed, noise_seed=seed + t + 1, labels=labels)
+        path = os.path.join(
+            directory,
+            "QFA0000000001_2020-01-{:02d}_{:02d}-00-00{}".format(
+                1 + t // 24, t % 24, extension))
+        cv2.imwrite(path, img)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-d", "--directory", required=True,
+                        help="Directory where the images are written.")
+    parser.add_argument("-f", "--format", type=int, choices=sorted(FORMATS),
+                        default=96, help="Plate format. Default: 96.")
+    parser.add_argument("-w", "--width", type=int, default=2400,
+                        help="Width of the images in pixels. Default: 2400.")
+    parser.add_argument("-n", "--images", type=int, default=4,
+                        help="Number of images of the series. Default: 4.")
+    parser.add_argument("--gradient", type=float, default=0.2,
+                        help="Lighting gradient. Default: 0.2.")
+    parser.add_argument("--noise", type=float, default=4.0,
+                        help="Standard deviation of the noise. Default: 4.")
+    parser.add_argument("--extension", default=".png",
+                        help="Image format. Default: .png.")
+    parser.add_argument("--labels", action="store_true",
+                        help="Write labels above the agar.")
+    args = parser.parse_args()
+    write_series(args.directory, args.images, args.format, args.width,
+                 args.gradient, args.noise, args.extension,
+                 labels=args.labels)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Progress bars are not shown.
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+# The synthetic plates of the benchmarks are used by the tests.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                "benchmarks"))
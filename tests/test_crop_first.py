@@ -0,0 +1,30 @@
+"""Processing only the grid region (--crop_first) gives the outputs of the
+analysis of the full images, except the Area without --low_contrasts (see
+the docs)."""
+
+import numpy as np
+import pytest
+
+import synthetic
+from bacolonyzer import analysis, filesystem
+
+SAME = ["Intensity", "ColonyMean", "ColonyVariance", "BackgroundMean"]
+
+
+@pytest.mark.parametrize("low_contrasts", [False, True])
+def test_crop_first(tmp_path, low_contrasts):
+    directory = str(tmp_path)
+    paths = synthetic.write_series(directory, n_images=6, width=600)
+    filesystem.arrange_directories(directory)
+    setup = analysis.locate_plate(paths[-1], 8, 12, directory,
+                                  low_contrasts=low_contrasts)
+    cropped = setup._replace(crop_first=True)
+    for path in paths:
+        expected, expected_mask = analysis.analyse_image(path, setup)
+        result, mask = analysis.analyse_image(path, cropped)
+        for column in SAME:
+            np.testing.assert_array_equal(result[column], expected[column],
+                                          err_msg=column)
+        if low_contrasts:
+            np.testing.assert_array_equal(result["Area"], expected["Area"])
+            np.testing.assert_array_equal(mask, expected_mask)
@@ -0,0 +1,21 @@
+"""The coarse-to-fine search of the grid finds the same grid as the
+exhaustive search at full resolution."""
+
+import numpy as np
+import pytest
+
+import synthetic
+from bacolonyzer import image_processing
+
+
+@pytest.mark.parametrize("plate_format", [96, 384])
+def test_coarse_to_fine_search(plate_format):
+    nrow, ncol = synthetic.FORMATS[plate_format]
+    img = synthetic.plate_image(nrow, ncol, width=960)
+    im = np.clip(img, *np.quantile(img, [0.01, 0.99])).astype(np.uint8)
+    _, min_loc, pat_h, pat_w = image_processing.get_position_grid(
+        im, nrow, ncol, 0.8, search_scale=1, threads=0)
+    _, coarse_loc, coarse_h, coarse_w = image_processing.get_position_grid(
+        im, nrow, ncol, 0.8, search_scale=0.25, threads=0)
+    assert (coarse_h, coarse_w) == (pat_h, pat_w)
+    assert np.all(np.abs(np.subtract(coarse_loc, min_loc)) <= 1)
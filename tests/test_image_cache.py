@@ -0,0 +1,30 @@
+"""The image cache is kept within its maximum size."""
+
+import os
+
+import numpy as np
+
+from bacolonyzer import image_cache
+
+
+def cache_size(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory))
+
+
+def test_images_used_least_recently_are_removed(tmp_path):
+    cache = image_cache.ImageCache(str(tmp_path), 3 << 20)
+    for i in range(5):
+        cache.save("image_{}".format(i), np.full(1 << 20, i, dtype=np.uint8))
+    assert cache_size(tmp_path) <= 3 << 20
+    assert cache.load("image_0") is None
+    np.testing.assert_array_equal(cache.load("image_4"), 4)
+
+
+def test_cache_reopened_with_a_smaller_size(tmp_path):
+    cache = image_cache.ImageCache(str(tmp_path), 16 << 20)
+    for i in range(8):
+        cache.save("image_{}".format(i), np.zeros(1 << 20, dtype=np.uint8))
+    assert cache_size(tmp_path) > 8 << 20
+
+    image_cache.ImageCache(str(tmp_path), 3 << 20)
+    assert cache_size(tmp_path) <= 3 << 20
@@ -0,0 +1,31 @@
+"""The analysis in single precision (--low_memory) gives the outputs of the
+default analysis up to the bound given in the docs."""
+
+import numpy as np
+import pytest
+
+import synthetic
+from bacolonyzer import analysis, filesystem
+
+COLUMNS = ["Intensity", "Area", "ColonyMean", "ColonyVariance",
+           "BackgroundMean"]
+
+
+@pytest.mark.parametrize("light_correction", [False, True])
+@pytest.mark.parametrize("reference", [(0, 255), (12, 243)])
+def test_low_memory(tmp_path, light_correction, reference):
+    directory = str(tmp_path)
+    paths = synthetic.write_series(directory, n_images=4, width=600)
+    filesystem.arrange_directories(directory)
+    setup = analysis.locate_plate(paths[-1], 8, 12, directory,
+                                  light_correction=light_correction)
+    # The calibration of a reference image is given as 8-bit integers.
+    setup = setup._replace(min_ref=np.uint8(reference[0]),
+                           max_ref=np.uint8(reference[1]))
+    low_memory = setup._replace(low_memory=True)
+    for path in paths:
+        expected, _ = analysis.analyse_image(path, setup)
+        result, _ = analysis.analyse_image(path, low_memory)
+        for column in COLUMNS:
+            np.testing.assert_allclose(result[column], expected[column],
+                                       rtol=0, atol=2e-7, err_msg=column)
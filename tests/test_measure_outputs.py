@@ -0,0 +1,171 @@
+"""The metrics of all the spots, computed at once by `measure_outputs`, are
+compared with those of the original loop over the spots. With
+--integral_metrics, the loop clips all the patches to the quantiles of the
+whole grid."""
+
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import synthetic
+from bacolonyzer import analysis, filesystem
+
+FILE_NAME = "QFA0000000001_2020-01-01_00-00-00.png"
+COLUMNS = ["Intensity", "Area", "ColonyMean", "ColonyVariance",
+           "BackgroundMean"]
+
+# The original loop takes the mean of patches without agar.
+pytestmark = pytest.mark.filterwarnings(
+    "ignore:Mean of empty slice", "ignore:invalid value encountered")
+
+
+def measure_loop(im, mask, pat_h, pat_w, nrow, ncol, file_name, spots,
+                 correction, quants=None):
+    """Original measure_outputs, measuring one spot after another. Patches
+    are clipped to the given quantiles, or to their own ones."""
+    allrows, allcols, allintensities, allareas = [], [], [], []
+    allcolonymeans, allcolonyvariance, allbackgroundmeans = [], [], []
+    d_x = int(pat_h / nrow)
+    d_y = int(pat_w / ncol)
+    for i in range(nrow):
+        for j in range(ncol):
+            p_x = j * d_x
+            p_y = i * d_y
+            patch = im[p_y:p_y + d_y, p_x:p_x + d_x]
+            mask_patch = mask[p_y:p_y + d_y, p_x:p_x + d_x]
+            spots_patch = spots[p_y:p_y + d_y, p_x:p_x + d_x]
+
+            if quants is None:
+                patch = np.clip(patch, *np.quantile(patch, [0.01, 0.99]))
+            else:
+                patch = np.clip(patch, *quants)
+
+            area_patch = np.sum(mask_patch) / patch.size
+            if correction:
+                backgr = np.mean(patch[~spots_patch])
+                if np.isnan(backgr):
+                    backgr = 0
+            else:
+                backgr = 0
+
+            tile = patch - backgr
+            spot_intensities = tile[spots_patch]
+            if spot_intensities.size > 1:
+                colony_mean_patch = np.mean(spot_intensities)
+                colony_variance_patch = np.var(spot_intensities)
+            else:
+                colony_mean_patch = colony_variance_patch = 0
+            intens_patch = np.sum(tile) / tile.size
+            bkgrnd = tile[~spots_patch]
+            if bkgrnd.size > 1:
+                background_mean_patch = np.mean(bkgrnd)
+            else:
+                background_mean_patch = 0
+
+            allrows.append(i + 1)
+            allcols.append(j + 1)
+            allintensities.append(intens_patch)
+            allareas.append(area_patch)
+            allcolonymeans.append(colony_mean_patch)
+            allcolonyvariance.append(colony_variance_patch)
+            allbackgroundmeans.append(background_mean_patch)
+
+    fname = filesystem.get_file_name(file_name)
+    brcod = re.sub(r"\D[\d]+-[\d]+-[\d]+.*", "", fname)
+    return pd.DataFrame({
+        "Row": allrows,
+        "Column": allcols,
+        "Intensity": allintensities,
+        "Area": allareas,
+        "ColonyMean": allcolonymeans,
+        "ColonyVariance": allcolonyvariance,
+        "BackgroundMean": allbackgroundmeans,
+        "Barcode": [brcod] * len(allrows),
+        "Filename": [fname] * len(allrows),
+    })
+
+
+def synthetic_grid(plate_format, width=720, growth=0.8):
+    """Grid region of a synthetic plate, with its mask, spots and geometry
+    (pat_h, pat_w, nrow, ncol)."""
+    nrow, ncol = synthetic.FORMATS[plate_format]
+    img = synthetic.plate_image(nrow, ncol, width, growth)
+    pitch = width / (ncol + 2)
+    margin = int(round(pitch))
+    d = int(pitch)
+    grid = img[margin:margin + nrow * d, margin:margin + ncol * d]
+    spots = grid >= 100
+    # Some spots are empty, and some are fully covered by their colony.
+    spots[:d, :d] = False
+    spots[-d:, -d:] = True
+    mask = spots.astype(np.uint8) * 255
+    return grid, mask, spots, (d * nrow, d * ncol, nrow, ncol)
+
+
+def histogram_levels(grid, histogram):
+    """Gray levels of the image and their values, if the quantiles are
+    computed from histograms."""
+    if not histogram:
+        return {}
+    return {"codes": grid, "levels": np.arange(256) / 255}
+
+
+@pytest.mark.parametrize("plate_format", [96, 384])
+@pytest.mark.parametrize("correction", [False, True])
+@pytest.mark.parametrize("histogram", [False, True])
+def test_same_outputs_as_loop(plate_format, correction, histogram):
+    grid, mask, spots, geometry = synthetic_grid(plate_format)
+    im = grid / 255
+    expected = measure_loop(im, mask, *geometry, FILE_NAME, spots, correction)
+    result = analysis.measure_outputs(im, mask, *geometry, FILE_NAME, spots,
+                                      correction,
+                                      **histogram_levels(grid, histogram))
+    assert list(result.columns) == list(expected.columns)
+    for column in ["Row", "Column", "Barcode", "Filename"]:
+        assert list(result[column]) == list(expected[column])
+    for column in COLUMNS:
+        np.testing.assert_allclose(result[column], expected[column],
+                                   rtol=1e-9, atol=1e-12, err_msg=column)
+
+
+@pytest.mark.parametrize("correction", [False, True])
+@pytest.mark.parametrize("histogram", [False, True])
+def test_patches_outside_of_the_image(correction, histogram):
+    # The last row and column of patches are cut by the border of the image.
+    grid, mask, spots, geometry = synthetic_grid(96)
+    h, w = grid.shape
+    grid = grid[:h - 7, :w - 11]
+    im = grid / 255
+    mask, spots = mask[:h - 7, :w - 11], spots[:h - 7, :w - 11]
+    expected = measure_loop(im, mask, *geometry, FILE_NAME, spots, correction)
+    result = analysis.measure_outputs(im, mask, *geometry, FILE_NAME, spots,
+                                      correction,
+                                      **histogram_levels(grid, histogram))
+    for column in COLUMNS:
+        np.testing.assert_allclose(result[column], expected[column],
+                                   rtol=1e-9, atol=1e-12, err_msg=column)
+
+
+@pytest.mark.parametrize("plate_format", [96, 384])
+@pytest.mark.parametrize("correction", [False, True])
+@pytest.mark.parametrize("cut", [0, 9])
+@pytest.mark.parametrize("min_ref,max_ref", [(0, 255), (np.uint8(80),
+                                                         np.uint8(243))])
+def test_integral_metrics(plate_format, correction, cut, min_ref, max_ref):
+    grid, mask, spots, geometry = synthetic_grid(plate_format)
+    h, w = grid.shape
+    grid, mask = grid[:h - cut, :w - cut], mask[:h - cut, :w - cut]
+    spots = spots[:h - cut, :w - cut]
+    # Levels below min_ref wrap around, as in the analysis.
+    levels = (np.arange(256, dtype=np.uint8) - min_ref) / (max_ref - min_ref)
+    im = levels[grid]
+    expected = measure_loop(im, mask, *geometry, FILE_NAME, spots, correction,
+                            np.quantile(im, [0.01, 0.99]))
+    result = analysis.measure_outputs(im, mask, *geometry, FILE_NAME, spots,
+                                      correction, integral=True, codes=grid,
+                                      levels=levels)
+    for column in COLUMNS:
+        np.testing.assert_allclose(result[column], expected[column],
+                                   rtol=1e-9, atol=1e-12, err_msg=column)
@@ -0,0 +1,152 @@
+"""Outputs are only recorded once they are saved, are read back as they
+were written in every format, and a missing dependency is found before the
+analysis starts."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bacolonyzer import analysis, output_store
+
+# Package needed by each columnar format.
+_DEPENDENCIES = {"parquet": "pyarrow", "feather": "pyarrow", "hdf5": "tables"}
+
+
+class FailingStore(output_store.TsvStore):
+    """Fails to save the outputs of the given images."""
+
+    def __init__(self, output_base_dir, failing):
+        super().__init__(output_base_dir)
+        self.failing = failing
+
+    def write(self, file_name, output_df, mask=None, on_saved=None):
+        if file_name in self.failing:
+            raise OSError("No space left on device")
+        super().write(file_name, output_df, mask, on_saved)
+
+
+def outputs(file_name):
+    return pd.DataFrame({"Intensity": [0.5], "Barcode": ["plate"],
+                         "Filename": [file_name]})
+
+
+@pytest.mark.parametrize("output_format", ["tsv", "hdf5"])
+def test_saved_outputs_are_recorded(tmp_path, output_format):
+    if output_format == "hdf5":
+        pytest.importorskip("tables")
+    (tmp_path / "Output_Data").mkdir()
+    saved = []
+    names = ["plate_{}".format(i) for i in range(4)]
+    with output_store.open_store(str(tmp_path), output_format,
+                                 write_queue=2) as store:
+        for name in names:
+            store.write(name, outputs(name), on_saved=saved.append)
+    assert saved == names
+
+
+def test_outputs_not_saved_after_an_error(tmp_path):
+    (tmp_path / "Output_Data").mkdir()
+    saved = []
+    store = output_store.BackgroundStore(
+        FailingStore(str(tmp_path), failing={"plate_1"}), queue_size=8)
+    with pytest.raises(OSError):
+        for i in range(4):
+            name = "plate_{}".format(i)
+            store.write(name, outputs(name), on_saved=saved.append)
+        store.close()
+    store.close()
+    # The outputs queued after the error are dropped, and not recorded.
+    assert saved == ["plate_0"]
+    assert sorted(p.name for p in (tmp_path / "Output_Data").iterdir()) == [
+        "plate_0.out"
+    ]
+
+
+def image_outputs(file_name, seed):
+    """Outputs of an image of a 2x3 plate, as `analysis.measure_outputs`."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "Row": np.repeat(np.arange(1, 3), 3),
+        "Column": np.tile(np.arange(1, 4), 2),
+        "Intensity": rng.random(6),
+        "Area": rng.random(6),
+        "ColonyMean": rng.random(6),
+        "ColonyVariance": rng.random(6),
+        "BackgroundMean": rng.random(6),
+        "Barcode": ["plate"] * 6,
+        "Filename": [file_name] * 6,
+    })
+
+
+def image_names(n):
+    return ["plate_2024-01-0{}_10-00-00".format(i + 1) for i in range(n)]
+
+
+def read_all(store):
+    return pd.concat(list(store.read()), ignore_index=True)
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "feather", "hdf5"])
+def test_columnar_round_trip(tmp_path, output_format):
+    pytest.importorskip(_DEPENDENCIES[output_format])
+    (tmp_path / "Output_Data").mkdir()
+    names = image_names(3)
+    with output_store.open_store(str(tmp_path), output_format) as store:
+        for seed, name in enumerate(names):
+            store.write(name, image_outputs(name, seed))
+    expected = pd.concat([
+        image_outputs(name, seed).assign(
+            Timepoint=output_store.get_timepoint(name))
+        for seed, name in enumerate(names)
+    ], ignore_index=True)
+    store = output_store.open_store(str(tmp_path), output_format)
+    pd.testing.assert_frame_equal(read_all(store), expected)
+
+    # Outputs of the images that are not analysed again are kept.
+    with output_store.open_store(str(tmp_path), output_format) as store:
+        store.write(names[1], image_outputs(names[1], 10))
+    expected = expected[expected["Filename"] != names[1]]
+    expected = pd.concat([
+        image_outputs(names[1], 10).assign(
+            Timepoint=output_store.get_timepoint(names[1])), expected
+    ], ignore_index=True)
+    store = output_store.open_store(str(tmp_path), output_format)
+    pd.testing.assert_frame_equal(read_all(store), expected)
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "feather", "hdf5"])
+def test_convert_outputs(tmp_path, output_format):
+    pytest.importorskip(_DEPENDENCIES[output_format])
+    data_dir = tmp_path / "Output_Data"
+    data_dir.mkdir()
+    names = image_names(3)
+    with output_store.open_store(str(tmp_path), "tsv") as store:
+        for seed, name in enumerate(names):
+            store.write(name, image_outputs(name, seed))
+    tsv = {path.name: path.read_text() for path in data_dir.iterdir()}
+    expected = read_all(output_store.open_store(str(tmp_path), "tsv"))
+
+    output_store.convert_outputs(str(tmp_path), "tsv", output_format)
+    store = output_store.open_store(str(tmp_path), output_format)
+    pd.testing.assert_frame_equal(
+        read_all(store).drop(columns="Timepoint"), expected)
+
+    # Converting them back gives the same tab delimited files.
+    for path in data_dir.glob("*.out"):
+        path.unlink()
+    output_store.convert_outputs(str(tmp_path), output_format, "tsv")
+    assert {
+        path.name: path.read_text()
+        for path in data_dir.glob("*.out")
+    } == tsv
+
+
+def test_missing_dependency(tmp_path, monkeypatch):
+    monkeypatch.setattr(output_store, "pyarrow", None)
+    with pytest.raises(ValueError, match="pyarrow"):
+        output_store.store_class("parquet")
+    # The analysis fails before the images are read.
+    images = [str(tmp_path / "missing_{}.jpg".format(i)) for i in range(2)]
+    with pytest.raises(ValueError, match="pyarrow"):
+        analysis.analyse_timeseries_qfa(images, 8, 12, str(tmp_path),
+                                        output_format="feather")
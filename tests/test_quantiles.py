@@ -0,0 +1,59 @@
+"""Quantiles computed from histograms are those of np.quantile."""
+
+import numpy as np
+import pytest
+
+from bacolonyzer import quantiles
+
+Q = [0.01, 0.5, 0.99]
+
+
+@pytest.fixture(params=[1 << 18, 1000])
+def chunk_pixels(request, monkeypatch):
+    # Histograms computed in a single chunk or in many.
+    monkeypatch.setattr(quantiles, "_CHUNK_PIXELS", request.param)
+
+
+def test_image_quantiles(chunk_pixels):
+    im = np.random.default_rng(0).integers(20, 230, (300, 400), np.uint8)
+    np.testing.assert_array_equal(quantiles.image_quantiles(im, Q),
+                                  np.quantile(im, Q))
+
+
+def test_image_histogram(chunk_pixels):
+    im = np.random.default_rng(2).integers(0, 256, (300, 400), np.uint8)
+    np.testing.assert_array_equal(quantiles.image_histogram(im),
+                                  np.bincount(im.ravel(), minlength=256))
+
+
+@pytest.mark.parametrize("min_ref,max_ref", [(0, 255), (np.uint8(12),
+                                                         np.uint8(243))])
+def test_block_quantiles(chunk_pixels, min_ref, max_ref):
+    blocks = np.random.default_rng(1).integers(0, 256, (3, 8, 12, 150),
+                                               np.uint8)
+    # Levels below min_ref wrap around, so their values are not sorted.
+    levels = (np.arange(256, dtype=np.uint8) - min_ref) / (max_ref - min_ref)
+    expected = np.quantile(levels[blocks], Q, axis=-1, keepdims=True)
+    result = quantiles.block_quantiles(blocks, Q, levels)
+    assert result.shape == expected.shape
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_block_quantiles_of_valid_pixels(chunk_pixels):
+    rng = np.random.default_rng(2)
+    blocks = rng.integers(0, 256, (8, 12, 150), np.uint8)
+    valid = rng.random(blocks.shape) < 0.7
+    valid[0, 0] = False
+    levels = np.arange(256) / 255
+    values = np.where(valid, levels[blocks], np.nan)
+    with pytest.warns(RuntimeWarning):  # The patch without valid pixels.
+        expected = np.nanquantile(values, Q, axis=-1, keepdims=True)
+    result = quantiles.block_quantiles(blocks, Q, levels, valid=valid)
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_fast_quantiles(chunk_pixels):
+    blocks = np.random.default_rng(3).integers(0, 256, (8, 12, 150), np.uint8)
+    expected = np.quantile(blocks, Q, axis=-1, keepdims=True, method="lower")
+    result = quantiles.block_quantiles(blocks, Q, precise=False)
+    np.testing.assert_array_equal(result, expected)
@@ -0,0 +1,141 @@
+"""The date and time of the images are read from their EXIF headers, and a
+batch of renames is checked, applied and reverted without losing any file
+or manifest."""
+
+import argparse
+import datetime
+
+import pytest
+from PIL import Image, TiffImagePlugin
+
+from bacolonyzer import commands, renaming
+
+_EXIF_IFD = 0x8769
+_DATE_TIME_ORIGINAL = 0x9003
+_DATE_TIME = datetime.datetime(2019, 8, 11, 12, 30, 5)
+
+
+def write_image(path, date_time=None):
+    """Small image saved by Pillow, with the EXIF date and time if given."""
+    # Other tags come before the date and time, as in the images of cameras.
+    tags = {0x010F: "Scanner"}
+    if date_time is not None:
+        tags[_EXIF_IFD] = {
+            _DATE_TIME_ORIGINAL: date_time.strftime("%Y:%m:%d %H:%M:%S")
+        }
+    image = Image.new("L", (16, 8), 128)
+    if path.suffix.lower() == ".tif":
+        # The EXIF IFD of TIFF images is only saved as a TIFF tag.
+        info = TiffImagePlugin.ImageFileDirectory_v2()
+        for tag, value in tags.items():
+            info[tag] = value
+        image.save(str(path), tiffinfo=info)
+    else:
+        exif = Image.Exif()
+        for tag, value in tags.items():
+            exif[tag] = value
+        image.save(str(path), exif=exif)
+    return str(path)
+
+
+@pytest.mark.parametrize("extension", [".jpg", ".JPEG", ".tif", ".png"])
+def test_read_timestamp(tmp_path, extension):
+    path = write_image(tmp_path / ("plate" + extension), _DATE_TIME)
+    assert renaming.read_timestamp(path) == _DATE_TIME
+
+
+@pytest.mark.parametrize("extension", [".jpg", ".tif", ".png"])
+def test_missing_timestamp(tmp_path, extension):
+    path = write_image(tmp_path / ("plate" + extension))
+    assert renaming.read_timestamp(path) is None
+    # Files that are not images don't have a timestamp either.
+    other = tmp_path / ("other" + extension)
+    other.write_bytes(b"not an image")
+    assert renaming.read_timestamp(str(other)) is None
+
+
+def test_read_timestamps(tmp_path):
+    paths = [
+        write_image(tmp_path / "plate_{}.jpg".format(i),
+                    _DATE_TIME + datetime.timedelta(hours=i))
+        for i in range(5)
+    ]
+    assert renaming.read_timestamps(paths, threads=2) == [
+        _DATE_TIME + datetime.timedelta(hours=i) for i in range(5)
+    ]
+
+
+def files(directory, *names):
+    paths = []
+    for name in names:
+        path = directory / name
+        path.write_text(name)
+        paths.append(str(path))
+    return paths
+
+
+def test_collisions(tmp_path):
+    a, b, c = files(tmp_path, "a.jpg", "b.jpg", "c.jpg")
+    with pytest.raises(RuntimeError, match="don't exist"):
+        renaming.plan_renames([a, str(tmp_path / "missing.jpg")],
+                              ["x.jpg", "y.jpg"])
+    with pytest.raises(RuntimeError, match="Several files"):
+        renaming.plan_renames([a, b], ["x.jpg", "x.jpg"])
+    # c is not renamed, so it would be replaced.
+    with pytest.raises(RuntimeError, match="already exist"):
+        renaming.plan_renames([a, b], ["c.jpg", "y.jpg"])
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "a.jpg", "b.jpg", "c.jpg"
+    ]
+
+
+def test_swap_and_revert(tmp_path):
+    a, b, c = files(tmp_path, "a.jpg", "b.jpg", "c.jpg")
+    # c keeps its name, and a and b swap their names.
+    plan = renaming.plan_renames([a, b, c], ["b.jpg", "a.jpg", "c.jpg"])
+    assert plan == [(a, b), (b, a)]
+    manifest = renaming.new_manifest_path(str(tmp_path))
+    renaming.save_manifest(manifest, plan)
+    renaming.apply_renames(plan)
+    assert (tmp_path / "a.jpg").read_text() == "b.jpg"
+    assert (tmp_path / "b.jpg").read_text() == "a.jpg"
+
+    revert = renaming.check_renames([
+        (new, old) for old, new in renaming.read_manifest(manifest)
+    ])
+    renaming.apply_renames(revert)
+    for name in ["a.jpg", "b.jpg", "c.jpg"]:
+        assert (tmp_path / name).read_text() == name
+
+
+def test_manifests_are_not_replaced(tmp_path):
+    a, = files(tmp_path, "a.jpg")
+    now = datetime.datetime(2019, 8, 11, 12, 30, 0)
+    first = renaming.new_manifest_path(str(tmp_path), now)
+    renaming.save_manifest(first, [(a, str(tmp_path / "b.jpg"))])
+    # A renaming in the same second, e.g. reverting it, gets a new manifest.
+    second = renaming.new_manifest_path(str(tmp_path), now)
+    assert second != first
+    assert second.endswith("rename_manifest_2019-08-11_12-30-00_2.tsv")
+    with pytest.raises(RuntimeError, match="already exists"):
+        renaming.save_manifest(first, [(str(tmp_path / "b.jpg"), a)])
+    assert renaming.read_manifest(first) == [(a, str(tmp_path / "b.jpg"))]
+
+
+def rename_images(*arguments):
+    parser = argparse.ArgumentParser()
+    commands.RenameImagesCommand().register_parser(parser.add_subparsers())
+    args = parser.parse_args(("rename_images", ) + arguments)
+    args.func(args)
+
+
+def test_revert_in_the_same_second(tmp_path):
+    names = ["scan_{}.jpg".format(i) for i in range(3)]
+    files(tmp_path, *names)
+    rename_images("-d", str(tmp_path), "-p", "plate_", "-m", "-s",
+                  "2019-08-11 12:30", "--no_dry_run")
+    manifest, = tmp_path.glob("rename_manifest_*.tsv")
+    rename_images("--revert", str(manifest), "--no_dry_run")
+    # Both manifests are kept, and all the files have their names back.
+    assert len(list(tmp_path.glob("rename_manifest_*.tsv"))) == 2
+    assert sorted(p.name for p in tmp_path.glob("*.jpg")) == names
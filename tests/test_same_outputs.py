@@ -0,0 +1,127 @@
+"""The options that make the analysis faster save the same outputs as the
+default analysis, one image after another in a single process."""
+
+import io
+import os
+
+import pandas as pd
+import pytest
+
+import synthetic
+from bacolonyzer import analysis, filesystem, sweep
+
+_WIDTH = 600
+
+
+def plate_series(tmp_path, name, n_images=4, seed=0):
+    """Directory with a series of synthetic plates, ready to be analysed."""
+    directory = str(tmp_path / name)
+    paths = synthetic.write_series(directory, n_images=n_images, width=_WIDTH,
+                                   seed=seed)
+    filesystem.arrange_directories(directory)
+    return directory, paths
+
+
+def saved_outputs(directory):
+    """Contents of the output files of each image."""
+    data = os.path.join(directory, "Output_Data")
+    outputs = {}
+    for name in sorted(os.listdir(data)):
+        if name.endswith(".out"):
+            with open(os.path.join(data, name)) as output_file:
+                outputs[name] = output_file.read()
+    return outputs
+
+
+def serial_outputs(tmp_path, seed=0, **kwargs):
+    """Outputs of the default analysis of the series."""
+    directory, paths = plate_series(tmp_path, "serial_{}".format(seed),
+                                    seed=seed)
+    analysis.analyse_timeseries_qfa(paths, 8, 12, directory, **kwargs)
+    return saved_outputs(directory)
+
+
+def test_parallel_jobs(tmp_path):
+    directory, paths = plate_series(tmp_path, "parallel")
+    analysis.analyse_timeseries_qfa(paths, 8, 12, directory, jobs=2)
+    outputs = saved_outputs(directory)
+    assert len(outputs) == len(paths)
+    assert outputs == serial_outputs(tmp_path)
+
+
+def test_analyse_batch(tmp_path):
+    plates = [plate_series(tmp_path, "plate_{}".format(seed), seed=seed)
+              for seed in range(2)]
+    failures = analysis.analyse_plates(plates, 8, 12, jobs=2, chunk_size=3)
+    assert failures == {}
+    for seed, (directory, _) in enumerate(plates):
+        assert saved_outputs(directory) == serial_outputs(tmp_path, seed)
+
+
+@pytest.mark.parametrize("search_scale", [1.0, 0.5])
+def test_grid_threads(tmp_path, search_scale):
+    directory, paths = plate_series(tmp_path, "threads")
+    analysis.analyse_timeseries_qfa(paths, 8, 12, directory, grid_threads=2,
+                                    search_scale=search_scale)
+    assert saved_outputs(directory) == serial_outputs(
+        tmp_path, search_scale=search_scale)
+
+
+def test_grid_cache(tmp_path, monkeypatch):
+    expected = serial_outputs(tmp_path)
+    directory, paths = plate_series(tmp_path, "cache")
+    analysis.analyse_timeseries_qfa(paths, 8, 12, directory)
+    assert os.path.isfile(
+        os.path.join(directory, "Output_Data", "grid_cache.npz"))
+
+    # The grid of the first analysis is reused, not searched again.
+    def find_grid(*args, **kwargs):
+        raise AssertionError("The grid cache was not used.")
+
+    monkeypatch.setattr(analysis, "find_grid", find_grid)
+    analysis.analyse_timeseries_qfa(paths, 8, 12, directory)
+    assert saved_outputs(directory) == expected
+
+
+def test_incremental(tmp_path, monkeypatch):
+    expected = serial_outputs(tmp_path)
+    directory, paths = plate_series(tmp_path, "incremental")
+    analysis.analyse_timeseries_qfa(paths, 8, 12, directory, incremental=True)
+    assert saved_outputs(directory) == expected
+
+    analysed = []
+    analyse_image = analysis.analyse_image
+
+    def tracked(file_name, *args, **kwargs):
+        analysed.append(os.path.basename(file_name))
+        return analyse_image(file_name, *args, **kwargs)
+
+    monkeypatch.setattr(analysis, "analyse_image", tracked)
+    # Nothing changed: no image is analysed again.
+    analysis.analyse_timeseries_qfa(paths, 8, 12, directory, incremental=True)
+    assert analysed == []
+    # Only the image modified after its outputs is analysed again.
+    future = os.path.getmtime(paths[1]) + 60
+    os.utime(paths[1], (future, future))
+    analysis.analyse_timeseries_qfa(paths, 8, 12, directory, incremental=True)
+    assert analysed == [os.path.basename(paths[1])]
+    assert saved_outputs(directory) == expected
+
+
+def test_sweep(tmp_path):
+    directory, paths = plate_series(tmp_path, "sweep")
+    configs = sweep.configurations([0.8], [False, True], [0.05],
+                                   [False, True])
+    output_path = os.path.join(directory, "Output_Data", "sweep.tsv")
+    sweep.sweep_plate(paths, 8, 12, output_path, configs)
+    swept = pd.read_csv(output_path, sep="\t", float_precision="round_trip")
+    for number, config in enumerate(configs, 1):
+        outputs = serial_outputs(tmp_path / str(number), **config._asdict())
+        expected = pd.concat([
+            pd.read_csv(io.StringIO(text), sep="\t",
+                        float_precision="round_trip")
+            for text in outputs.values()
+        ], ignore_index=True)
+        result = swept[swept["Configuration"] == number]
+        result = result[expected.columns].reset_index(drop=True)
+        pd.testing.assert_frame_equal(result, expected, check_exact=True)
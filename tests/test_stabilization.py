@@ -0,0 +1,83 @@
+"""The stabilizer estimates the movements of the plate, keeps exactly the
+transform of images that don't move and rejects implausible transforms.
+The analysis of a static series is the same with and without --stabilize.
+"""
+
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+import synthetic
+from bacolonyzer import analysis, filesystem, stabilization
+
+_WIDTH = 1200
+
+
+def series(n_images):
+    """Grayscale images of a growing plate that doesn't move."""
+    return [
+        synthetic.plate_image(width=_WIDTH, growth=growth, noise_seed=t + 1,
+                              labels=True)
+        for t, growth in enumerate(synthetic.logistic_growth(n_images))
+    ]
+
+
+def corner_error(transform, expected, shape):
+    corners = np.array([[0, 0, 1], [shape[1], 0, 1], [0, shape[0], 1],
+                        [shape[1], shape[0], 1]]).T
+    return np.hypot(*(np.asarray(transform) @ corners -
+                      np.asarray(expected) @ corners)).max()
+
+
+@pytest.mark.parametrize("scale", [1.0, 0.5])
+def test_known_movement(scale):
+    images = series(4)
+    h, w = images[0].shape
+    stabilizer = stabilization.Stabilizer(images[0], scale)
+    for t, image in enumerate(images[1:], 1):
+        expected = cv2.getRotationMatrix2D((w / 2, h / 2), 0.2 * t, 1)
+        expected[:, 2] += (3 * t, -2 * t)
+        moved = cv2.warpAffine(image, expected, (w, h),
+                               borderMode=cv2.BORDER_REPLICATE)
+        transform = stabilizer.estimate(moved)
+        assert corner_error(transform, expected, (h, w)) < 0.5
+
+
+@pytest.mark.parametrize("scale", [1.0, 0.5])
+def test_static_series(scale):
+    images = series(8)
+    stabilizer = stabilization.Stabilizer(images[0], scale)
+    for image in images[1:]:
+        assert np.array_equal(stabilizer.estimate(image), np.eye(2, 3))
+
+
+def test_implausible_transform():
+    images = series(3)
+    stabilizer = stabilization.Stabilizer(images[0])
+    assert np.array_equal(stabilizer.estimate(images[1]), np.eye(2, 3))
+    # The plate turned upside down: the previous transform is kept.
+    assert np.array_equal(stabilizer.estimate(cv2.flip(images[2], -1)),
+                          np.eye(2, 3))
+
+
+def test_analysis_of_static_series(tmp_path):
+    outputs = {}
+    for stabilize in [False, True]:
+        directory = str(tmp_path / str(stabilize))
+        paths = synthetic.write_series(directory, n_images=6, width=800,
+                                       labels=True)
+        filesystem.arrange_directories(directory)
+        analysis.analyse_timeseries_qfa(paths, 8, 12, directory,
+                                        stabilize=stabilize)
+        data = os.path.join(directory, "Output_Data")
+        outputs[stabilize] = {
+            name: open(os.path.join(data, name)).read()
+            for name in os.listdir(data) if name.endswith(".out")
+        }
+    assert len(outputs[True]) == 6
+    assert outputs[True] == outputs[False]
+    record = filesystem.load_stabilization_record(directory)
+    for transform in record["transforms"].values():
+        assert np.array_equal(transform, np.eye(2, 3))
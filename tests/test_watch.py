@@ -0,0 +1,127 @@
+"""A scanner is simulated by a thread that writes images in chunks, slowly,
+into a directory that is watched."""
+
+import os
+import queue
+import threading
+import time
+
+import cv2
+import pandas as pd
+import pytest
+
+import synthetic
+from bacolonyzer import analysis, filesystem, watch
+
+N_IMAGES = 4
+# Time between the chunks written by the scanner, shorter than the time that
+# the images must be unchanged to be complete.
+CHUNK_DELAY = 0.05
+SETTLE_TIME = 0.4
+
+
+@pytest.fixture(params=["inotify", "polling"])
+def watch_mode(request, monkeypatch):
+    if request.param == "polling":
+        monkeypatch.setattr(watch, "inotify_simple", None)
+    elif watch.inotify_simple is None:
+        pytest.skip("inotify_simple is not installed")
+    return request.param
+
+
+class Scanner(threading.Thread):
+    """Writes a series of images into a directory in chunks, and records
+    when the last chunk of each image was written."""
+
+    def __init__(self, directory, n_images=N_IMAGES, chunks=5):
+        super().__init__(daemon=True)
+        self.directory = directory
+        self.n_images = n_images
+        self.chunks = chunks
+        self.completed = {}
+
+    def run(self):
+        for t in range(self.n_images):
+            img = synthetic.plate_image(width=240, growth=(t + 1) / 4)
+            data = cv2.imencode(".png", img)[1].tobytes()
+            path = os.path.join(
+                self.directory,
+                "QFA0000000001_2020-01-01_{:02d}-00-00.png".format(t))
+            size = len(data) // self.chunks + 1
+            with open(path, "wb") as image_file:
+                for start in range(0, len(data), size):
+                    image_file.write(data[start:start + size])
+                    image_file.flush()
+                    time.sleep(CHUNK_DELAY)
+                self.completed[path] = time.time()
+
+
+def test_watcher_queues_complete_images_once(tmp_path, watch_mode):
+    directory = str(tmp_path)
+    images_queue = queue.Queue(maxsize=2)
+    watcher = watch.DirectoryWatcher(directory, images_queue, interval=0.05,
+                                     settle_time=SETTLE_TIME)
+    scanner = Scanner(directory)
+    watcher.start()
+    scanner.start()
+
+    queued = []
+    deadline = time.time() + 30
+    while len(queued) < N_IMAGES and time.time() < deadline:
+        try:
+            path = images_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        queued.append((path, time.time()))
+    scanner.join()
+    # No image is queued again.
+    time.sleep(3 * SETTLE_TIME)
+    watcher.stop()
+    watcher.join()
+    assert images_queue.empty()
+
+    assert sorted(path for path, _ in queued) == sorted(scanner.completed)
+    for path, queued_time in queued:
+        assert queued_time >= scanner.completed[path]
+
+
+def test_watch_plate_analyses_each_image_once(tmp_path, monkeypatch,
+                                              watch_mode):
+    directory = str(tmp_path)
+    filesystem.arrange_directories(directory)
+    analysed = []
+
+    def analyse_image(file_name, setup):
+        # The image is complete: it can be decoded.
+        assert cv2.imread(file_name, cv2.IMREAD_GRAYSCALE) is not None
+        analysed.append(file_name)
+        return pd.DataFrame({"Filename": [filesystem.get_file_name(file_name)]
+                             }), None
+
+    monkeypatch.setattr(analysis, "locate_plate", lambda *a, **k: "setup")
+    monkeypatch.setattr(analysis, "setup_fingerprint", lambda setup: "setup")
+    monkeypatch.setattr(analysis, "analyse_image", analyse_image)
+
+    stop_event = threading.Event()
+    watcher = threading.Thread(
+        target=watch.watch_plate,
+        args=(directory, 8, 12, stop_event),
+        kwargs={"interval": 0.05, "settle_time": SETTLE_TIME, "queue_size": 2},
+        daemon=True)
+    scanner = Scanner(directory)
+    watcher.start()
+    scanner.start()
+    scanner.join()
+    deadline = time.time() + 30
+    while len(analysed) < N_IMAGES and time.time() < deadline:
+        time.sleep(0.05)
+    time.sleep(3 * SETTLE_TIME)
+    stop_event.set()
+    watcher.join(timeout=30)
+    assert not watcher.is_alive()
+
+    assert sorted(analysed) == sorted(scanner.completed)
+    for file_name in analysed:
+        assert os.path.isfile(
+            os.path.join(directory, "Output_Data",
+                         filesystem.get_file_name(file_name) + ".out"))